@@ -1,85 +1,318 @@
 """Admin CLI to approve or deny access requests directly via MongoDB.
 
 Usage:
-  python admin_approve.py approve <username> [--role user]
-  python admin_approve.py deny <username> [--reason "...]
+  python admin_approve.py approve <username> [<username> ...] [--role user]
+  python admin_approve.py deny <username> [--reason "..."]
+  python admin_approve.py revoke <username> [<username> ...]
+
+Bulk modes select requests from a file of usernames (one per line, `#`
+comments, `-` for stdin) or by status and creation date:
+  python admin_approve.py approve --file cohort.txt --dry-run
+  python admin_approve.py approve --status pending --since 2025-01-01 --until 2025-02-01
+  python admin_approve.py deny --status pending --until 2024-12-31 --reason "expired" --report denied.json
+
+--since/--until are UTC unless they carry an offset (2025-01-01T09:00+02:00),
+which is converted to UTC before matching `created_at`.
+
+All matching requests are read in one query (per 1000 usernames). Existing
+users are checked in one more, and the changes are applied with one bulk
+write per collection. On a replica set or mongos the writes run in a single
+transaction (unless --no-transaction); on a standalone server they run
+unordered and the report lists anything that failed. --dry-run prints the
+planned changes and writes nothing.
 
 This script requires the backend .env MONGO_URL and MONGO_DB_NAME to be set.
 """
-import os
+import argparse
+import json
 import sys
-from dotenv import load_dotenv
-import pymongo
 from datetime import datetime
 
-load_dotenv()
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from db import manager
+from auth import revoke_user
+from cli_utils import parse_time, read_usernames
 
-MONGO_URL = os.environ.get('MONGO_URL')
-DB_NAME = os.environ.get('MONGO_DB_NAME', 'fraud_detection')
-if not MONGO_URL:
+CHUNK = 1000
+
+if not manager.url:
     print('MONGO_URL not set in environment. Fill backend/.env or your environment variables.')
     sys.exit(1)
 
-client = pymongo.MongoClient(MONGO_URL)
-db = client[DB_NAME]
+db = manager.get_db()
+if db is None:
+    print('Could not connect to MongoDB. Run test_mongo.py for details.')
+    sys.exit(1)
 
 
-def approve(username, role='user'):
-    req = db.access_requests.find_one({'username': username})
-    if not req:
-        print('Access request not found for', username)
-        return
+# -- selection -----------------------------------------------------------
+
+def find_requests(usernames=None, status=None, since=None, until=None):
+    """Matching access requests, and the requested usernames that have none."""
+    if usernames is not None:
+        found = []
+        for i in range(0, len(usernames), CHUNK):
+            query = {'username': {'$in': usernames[i:i + CHUNK]}}
+            if status:
+                query['status'] = status
+            found.extend(db.access_requests.find(query))
+        seen = {r['username'] for r in found}
+        return found, [u for u in usernames if u not in seen]
+
+    query = {'status': status}
+    if since or until:
+        query['created_at'] = {}
+        if since:
+            query['created_at']['$gte'] = since
+        if until:
+            query['created_at']['$lt'] = until
+    return list(db.access_requests.find(query).sort('created_at', 1)), []
+
+
+def existing_users(requests):
+    """Usernames and emails of approved users that clash with `requests`."""
+    usernames = [r['username'] for r in requests]
+    emails = [r['email'] for r in requests if r.get('email')]
+    taken_names, taken_emails = set(), set()
+    for i in range(0, max(len(usernames), len(emails)), CHUNK):
+        clauses = [{'username': {'$in': usernames[i:i + CHUNK]}}]
+        if emails[i:i + CHUNK]:
+            clauses.append({'email': {'$in': emails[i:i + CHUNK]}})
+        for user in db.approved_users.find({'$or': clauses}, {'username': 1, 'email': 1}):
+            taken_names.add(user['username'])
+            if user.get('email'):
+                taken_emails.add(user['email'])
+    return taken_names, taken_emails
 
-    existing = db.approved_users.find_one({'$or': [{'username': username}, {'email': req.get('email')}]})
-    if existing:
-        print('User already exists in approved_users. Marking request approved for audit.')
-        db.access_requests.update_one({'username': username}, {'$set': {'status': 'approved', 'updated_at': datetime.utcnow(), 'approved_at': datetime.utcnow()}})
-        return
 
-    new_user = {
+# -- planning ------------------------------------------------------------
+
+def plan_approve(requests, role='user'):
+    """Split requests into users to create, requests to just mark approved, and skips."""
+    taken_names, taken_emails = existing_users(requests)
+    create, mark, skip = [], [], []
+    for req in requests:
+        email = req.get('email')
+        if req['username'] in taken_names or (email and email in taken_emails):
+            # Same as the single-user path: keep the request approved for audit
+            if req.get('status') == 'approved':
+                skip.append((req, 'already approved'))
+            else:
+                mark.append(req)
+            continue
+        create.append(req)
+        taken_names.add(req['username'])
+        if email:
+            taken_emails.add(email)
+    return {'create': create, 'mark': mark, 'skip': skip, 'role': role}
+
+
+def plan_deny(requests, reason=None):
+    deny, skip = [], []
+    for req in requests:
+        if req.get('status') == 'denied':
+            skip.append((req, 'already denied'))
+        else:
+            deny.append(req)
+    return {'deny': deny, 'skip': skip, 'reason': reason}
+
+
+def print_plan(action, plan, missing):
+    if action == 'approve':
+        for req in plan['create']:
+            print(f"+ approved_users   {req['username']} <{req.get('email')}> role={plan['role']}")
+            print(f"~ access_requests  {req['username']}: {req.get('status')} -> approved")
+        for req in plan['mark']:
+            print(f"~ access_requests  {req['username']}: {req.get('status')} -> approved (user already exists)")
+    else:
+        for req in plan['deny']:
+            print(f"~ access_requests  {req['username']}: {req.get('status')} -> denied")
+    for req, why in plan['skip']:
+        print(f"= {req['username']}: {why}")
+    for username in missing:
+        print(f"? {username}: access request not found")
+
+
+# -- applying ------------------------------------------------------------
+
+def supports_transactions():
+    """Transactions need a replica set member or mongos."""
+    try:
+        hello = db.client.admin.command('hello')
+    except Exception:
+        return False
+    return bool(hello.get('setName')) or hello.get('msg') == 'isdbgrid'
+
+
+def _write_approve(plan, session=None):
+    """Insert new users and mark their requests approved; returns (created, marked, failures)."""
+    now = datetime.utcnow()
+    inserts = [InsertOne({
         'username': req['username'],
         'email': req.get('email'),
-        'password': req['password'],
-        'role': role,
-        'created_at': datetime.utcnow()
+        'password': req['password'],  # Already hashed when the request was created
+        'role': plan['role'],
+        'created_at': now,
+    }) for req in plan['create']]
+
+    failures = []
+    created = list(plan['create'])
+    if inserts:
+        try:
+            db.approved_users.bulk_write(inserts, ordered=False, session=session)
+        except BulkWriteError as e:
+            if session is not None:
+                raise
+            failed = {err['index']: err.get('errmsg', 'write failed') for err in e.details.get('writeErrors', [])}
+            failures = [(plan['create'][i], msg) for i, msg in failed.items()]
+            created = [req for i, req in enumerate(plan['create']) if i not in failed]
+
+    approved = created + plan['mark']
+    updates = [UpdateOne({'_id': req['_id']},
+                         {'$set': {'status': 'approved', 'updated_at': now, 'approved_at': now}})
+               for req in approved]
+    if updates:
+        db.access_requests.bulk_write(updates, ordered=False, session=session)
+    return created, plan['mark'], failures
+
+
+def _write_deny(plan, session=None):
+    now = datetime.utcnow()
+    update = {'status': 'denied', 'updated_at': now, 'denied_at': now}
+    if plan['reason']:
+        update['denied_reason'] = plan['reason']
+    ids = [req['_id'] for req in plan['deny']]
+    for i in range(0, len(ids), CHUNK):
+        db.access_requests.update_many({'_id': {'$in': ids[i:i + CHUNK]}}, {'$set': update}, session=session)
+    return plan['deny']
+
+
+def apply(action, plan, use_transaction=True):
+    write = _write_approve if action == 'approve' else _write_deny
+    if use_transaction and supports_transactions():
+        with db.client.start_session() as session:
+            return session.with_transaction(lambda s: write(plan, session=s)), True
+    return write(plan), False
+
+
+def _names(requests):
+    return [r['username'] for r in requests]
+
+
+def report(action, plan, missing, result=None, transaction=False, dry_run=False):
+    summary = {
+        'action': action,
+        'dry_run': dry_run,
+        'transaction': transaction,
+        'not_found': missing,
+        'skipped': [{'username': r['username'], 'reason': why} for r, why in plan['skip']],
     }
-    db.approved_users.insert_one(new_user)
-    db.access_requests.update_one({'username': username}, {'$set': {'status': 'approved', 'updated_at': datetime.utcnow(), 'approved_at': datetime.utcnow()}})
-    print('Approved and created user', username)
+    if action == 'approve':
+        created, marked, failures = result if result else (plan['create'], plan['mark'], [])
+        summary.update(created=_names(created), marked_approved=_names(marked),
+                       failed=[{'username': r['username'], 'error': msg} for r, msg in failures])
+    else:
+        summary['denied'] = _names(result if result is not None else plan['deny'])
+    return summary
+
+
+def print_summary(summary):
+    verb = 'Would' if summary['dry_run'] else 'Done:'
+    counts = {k: len(v) for k, v in summary.items() if isinstance(v, list)}
+    print(f"\n{verb} {summary['action']}: " + ', '.join(f"{k.replace('_', ' ')} {n}" for k, n in counts.items())
+          + (' (in one transaction)' if summary['transaction'] else ''))
+    for failure in summary.get('failed', []):
+        print(f"  failed {failure['username']}: {failure['error']}")
+
+
+def bulk(action, usernames=None, status=None, since=None, until=None, role='user', reason=None,
+         dry_run=False, use_transaction=True):
+    requests, missing = find_requests(usernames, status, since, until)
+    plan = plan_approve(requests, role) if action == 'approve' else plan_deny(requests, reason)
+    print_plan(action, plan, missing)
+    if dry_run:
+        summary = report(action, plan, missing, dry_run=True)
+    else:
+        try:
+            result, transaction = apply(action, plan, use_transaction)
+        except PyMongoError as e:
+            print(f'\nBulk {action} failed: {str(e)}')
+            print('Transaction aborted; nothing was written.' if use_transaction and supports_transactions()
+                  else 'Some changes may have been written; re-run with --dry-run to see what is left.')
+            raise SystemExit(1)
+        summary = report(action, plan, missing, result, transaction)
+    print_summary(summary)
+    return summary
+
+
+# -- single user -----------------------------------------------------------
+
+def approve(username, role='user'):
+    bulk('approve', [username], role=role)
 
 
 def deny(username, reason=None):
-    req = db.access_requests.find_one({'username': username})
-    if not req:
-        print('Access request not found for', username)
+    bulk('deny', [username], reason=reason)
+
+
+def revoke(username):
+    if not revoke_user(db, username):
+        print('Approved user not found for', username)
         return
-    update = {'status': 'denied', 'updated_at': datetime.utcnow(), 'denied_at': datetime.utcnow()}
-    if reason:
-        update['denied_reason'] = reason
-    db.access_requests.update_one({'username': username}, {'$set': update})
-    print('Denied access request for', username)
+    db.access_requests.update_one({'username': username}, {'$set': {'status': 'revoked', 'updated_at': datetime.utcnow()}})
+    print('Revoked access for', username)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Approve, deny or revoke access requests.')
+    parser.add_argument('command', choices=('approve', 'deny', 'revoke'))
+    parser.add_argument('usernames', nargs='*')
+    parser.add_argument('--file', help="file of usernames, one per line ('-' for stdin)")
+    parser.add_argument('--status', help='select requests with this status (default pending for date filters)')
+    parser.add_argument('--since', help='select requests created at or after this ISO date (UTC unless it has an offset)')
+    parser.add_argument('--until', help='select requests created before this ISO date (UTC unless it has an offset)')
+    parser.add_argument('--role', default='user')
+    parser.add_argument('--reason')
+    parser.add_argument('--dry-run', action='store_true', help='print the changes without writing them')
+    parser.add_argument('--no-transaction', action='store_true', help='never wrap the writes in a transaction')
+    parser.add_argument('--report', help='also write the summary as JSON to this file')
+    args = parser.parse_intermixed_args(argv)
+
+    usernames = list(args.usernames)
+    if args.file:
+        usernames += [u for u in read_usernames(args.file) if u not in usernames]
+    by_filter = not usernames and (args.status or args.since or args.until)
+    if not usernames and not by_filter:
+        parser.error('give usernames, --file, or --status/--since/--until')
+
+    if args.command == 'revoke':
+        if by_filter:
+            parser.error('revoke takes usernames or --file')
+        for username in usernames:
+            revoke(username)
+        return 0
+
+    try:
+        since = parse_time(args.since, None)
+        until = parse_time(args.until, None)
+    except ValueError as e:
+        parser.error(str(e))
+    if since and until and since >= until:
+        parser.error('--since must be before --until')
+    if since or until:
+        print(f"Selecting requests created from {since or 'the start'} to {until or 'now'} (UTC)")
+    summary = bulk(args.command, None if by_filter else usernames,
+                   status=args.status or ('pending' if by_filter else None), since=since, until=until,
+                   role=args.role, reason=args.reason, dry_run=args.dry_run,
+                   use_transaction=not args.no_transaction)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+        print(f'Wrote {args.report}')
+    return 1 if summary.get('failed') else 0
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 3:
-        print('Usage: python admin_approve.py <approve|deny> <username> [--role ROLE] [--reason "text"]')
-        sys.exit(1)
-
-    cmd = sys.argv[1]
-    username = sys.argv[2]
-    role = 'user'
-    reason = None
-
-    # parse optional flags
-    for i in range(3, len(sys.argv)):
-        if sys.argv[i] == '--role' and i+1 < len(sys.argv):
-            role = sys.argv[i+1]
-        if sys.argv[i] == '--reason' and i+1 < len(sys.argv):
-            reason = sys.argv[i+1]
-
-    if cmd == 'approve':
-        approve(username, role)
-    elif cmd == 'deny':
-        deny(username, reason)
-    else:
-        print('Unknown command', cmd)
+    sys.exit(main())
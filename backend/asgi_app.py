@@ -0,0 +1,443 @@
+"""Async (ASGI) serving mode for the API.
+
+The routes that mostly wait on I/O are served natively on asyncio, using
+motor (db.get_async_db) and an httpx-based model proxy
+(model_client.AsyncModelClient):
+
+  POST /api/auth/login
+  GET  /api/classifications        (JSON pages; format=ndjson goes to Flask)
+  POST /api/classifications        (sync write mode; queued saves go to Flask)
+  GET  /api/feedback, POST /api/feedback
+  POST /api/classify               (remote model; MODEL_BACKEND=embedded goes to Flask)
+
+Every other request, and the cases noted above, is handed to the Flask app
+in mongo_connection.py, which runs on a thread pool inside the same
+process. Both paths reuse the same helpers (auth.py, pagination.py,
+predictions.py, rollups.py, serialization.py), so request and response
+contracts are identical and the frontend does not change. Password checks
+(scrypt) and CSV parsing run in threads, so they never block the event loop.
+
+Run with an ASGI server, e.g.:
+  uvicorn asgi_app:app --host 0.0.0.0 --port 5000 --workers 2
+  gunicorn asgi_app:app -k uvicorn.workers.UvicornWorker -w 2
+
+Requires motor, httpx, starlette, python-multipart and a2wsgi (see
+requirements.txt). `python benchmark.py run --spawn uvicorn` compares this
+mode with the gunicorn worker model; see README.
+
+Configuration (environment variables):
+  ASGI_FLASK_THREADS   threads running delegated Flask requests per worker (default 16)
+"""
+import csv
+import os
+from datetime import datetime
+
+from a2wsgi import WSGIMiddleware
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response
+
+import http_cache
+import rate_limit
+from auth import (verify_token, check_password, hash_password, is_hashed, issue_token, token_ttl,
+                  login_enabled, access_denied, token_cache)
+from db import manager as mongo_manager, get_db
+from graph_layout import schedule_layouts
+from indexes import ensure_indexes_once
+from inference import embedded_enabled
+from ingest_queue import async_writes_enabled
+from metrics import registry as metrics_registry, metrics_enabled
+from model_client import AsyncModelClient, iter_csv_rows, ModelServiceError
+from mongo_connection import app as flask_app
+from pagination import (parse_page_args, build_projection, keyset_query, split_page,
+                        PaginationError, CURSOR_HEADER)
+from predictions import save_run_async
+from rollups import update_rollups_async, rollup_failed
+from serialization import dumps, NDJSON_MIMETYPE
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def json_response(body, status=200, headers=None):
+    return Response(dumps(body, sort_keys=True) + '\n', status_code=status, headers=headers,
+                    media_type='application/json')
+
+
+def wants_ndjson(request):
+    if request.query_params.get('format') == 'ndjson':
+        return True
+    return NDJSON_MIMETYPE in request.headers.get('accept', '')
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+async def authorize(request, role=None):
+    """Async twin of auth.login_required; returns (principal, error response or None)."""
+    header = request.headers.get('authorization', '')
+    token = None
+    if header.lower().startswith('bearer '):
+        token = header[7:].strip() or None
+    # verify_token may refresh the revocation list from Mongo, so keep it off the loop
+    principal = await run_in_threadpool(verify_token, token) if token else None
+    denied = access_denied(token, principal, role)
+    if denied:
+        error, status = denied
+        return None, json_response({'error': error}, status)
+    return principal, None
+
+
+def database():
+    return mongo_manager.get_async_db()
+
+
+async def list_page(collection, query, request, **projection_options):
+    """JSON page of a list endpoint, as list_documents() in mongo_connection.py.
+
+    Same ETag, 304 and response cache as http_cache.cached_page.
+    """
+    limit, page_cursor, fields, summary = parse_page_args(request.query_params)
+    projection = build_projection(fields, summary=summary, **projection_options)
+    etag = None
+    if http_cache.cache_enabled():
+        etag = http_cache.make_etag(collection.name, query, request.query_params.multi_items(),
+                                    await http_cache.collection_state_async(collection, query))
+        if http_cache.not_modified(request.headers.get('if-none-match'), etag):
+            return Response(status_code=304, headers={'ETag': etag, 'Cache-Control': 'private, no-cache',
+                                                      'Vary': 'Accept-Encoding'})
+        encoding = http_cache.negotiate(request.headers.get('accept-encoding'))
+        cached = http_cache.response_cache.get((collection.name, etag, encoding))
+        if cached is not None:
+            body, used, next_cursor = cached
+            return page_response(body, used, next_cursor, etag)
+
+    cursor = (collection.find(keyset_query(query, page_cursor), projection)
+              .sort([('created_at', -1), ('_id', -1)])
+              .limit(limit + 1))
+    docs, next_cursor = split_page(await cursor.to_list(None), limit)
+    if etag is None:
+        return json_response(docs, headers={CURSOR_HEADER: next_cursor} if next_cursor else None)
+
+    body = (dumps(docs, sort_keys=True) + '\n').encode('utf-8')
+    used = encoding if encoding and http_cache.worth_compressing(body, 'application/json') else None
+    if used:
+        body = await run_in_threadpool(http_cache.compress, body, used)
+    if len(body) <= _env_int('HTTP_RESPONSE_CACHE_MAX_BYTES', 1 << 20):
+        http_cache.response_cache.set((collection.name, etag, encoding), (body, used, next_cursor))
+    return page_response(body, used, next_cursor, etag)
+
+
+def page_response(body, encoding, next_cursor, etag):
+    headers = {'ETag': etag, 'Cache-Control': 'private, no-cache', 'Vary': 'Accept-Encoding'}
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    if next_cursor:
+        headers[CURSOR_HEADER] = next_cursor
+    return Response(body, headers=headers, media_type='application/json')
+
+
+# -- routes ------------------------------------------------------------------
+
+async def login(request):
+    if not login_enabled():
+        return json_response({'error': 'Login is disabled: AUTH_SECRET_KEY is not set'}, 503)
+    db = database()
+    if db is None:
+        return json_response({'error': 'Database connection failed'}, 500)
+
+    data = await read_json(request) or {}
+    username = (data.get('username') or '').strip()
+    password = data.get('password')
+    if not username or not password:
+        return json_response({'error': 'Username and password are required'}, 400)
+
+    approved_user = await db.approved_users.find_one({'username': username})
+    # Unknown users are checked too (against a dummy hash) so timing does not reveal accounts
+    stored = approved_user.get('password') if approved_user else None
+    if await run_in_threadpool(check_password, username, stored, password):
+        if not is_hashed(approved_user.get('password')):
+            # Upgrade accounts that still hold a plaintext password
+            hashed = await run_in_threadpool(hash_password, password)
+            await db.approved_users.update_one({'_id': approved_user['_id']}, {'$set': {'password': hashed}})
+        user_data = {
+            'username': approved_user['username'],
+            'email': approved_user.get('email'),
+            'role': approved_user.get('role', 'user')
+        }
+        return json_response({'success': True, 'message': 'Login successful', 'user': user_data,
+                              'token': issue_token(user_data), 'expires_in': token_ttl()})
+
+    pending_request = await db.access_requests.find_one({'username': username})
+    if pending_request and pending_request.get('status') == 'pending':
+        return json_response({'error': 'Your access request is still pending approval', 'status': 'pending'}, 403)
+
+    return json_response({'error': 'Invalid username or password', 'status': 'unauthorized',
+                          'requestAccess': True}, 401)
+
+
+async def submit_feedback(request):
+    principal, denied = await authorize(request)
+    if denied:
+        return denied
+    db = database()
+    if db is None:
+        return json_response({'error': 'Database connection failed'}, 500)
+
+    data = await read_json(request) or {}
+    if not data.get('rating') or not data.get('comments'):
+        return json_response({'error': 'Rating and comments are required'}, 400)
+    feedback = {
+        'name': data.get('name'),
+        'email': data.get('email'),
+        'rating': data.get('rating'),
+        'comments': data.get('comments'),
+        'username': principal['username'] if principal else data.get('username', 'Anonymous'),
+        'created_at': datetime.utcnow()
+    }
+    result = await db.platform_feedback.insert_one(feedback)
+    return json_response({'message': 'Feedback saved', 'id': str(result.inserted_id)}, 201)
+
+
+async def list_feedback(request):
+    if wants_ndjson(request):
+        return None
+    principal, denied = await authorize(request, role='admin')
+    if denied:
+        return denied
+    db = database()
+    if db is None:
+        return json_response({'error': 'Database connection failed'}, 500)
+
+    query = {}
+    if request.query_params.get('transactionId'):
+        query['transactionId'] = request.query_params['transactionId']
+    if request.query_params.get('username'):
+        query['username'] = request.query_params['username']
+    return await list_page(db.model_feedback, query, request)
+
+
+async def get_classifications(request):
+    if wants_ndjson(request):
+        return None
+    principal, denied = await authorize(request)
+    if denied:
+        return denied
+    db = database()
+    if db is None:
+        return json_response({'error': 'Database connection failed'}, 500)
+
+    username = request.query_params.get('username')
+    if principal and principal['role'] != 'admin':
+        # Regular users only see their own history
+        username = principal['username']
+    return await list_page(db.classifications, {'username': username} if username else {}, request,
+                           heavy=['predictions'])
+
+
+async def save_classification(request):
+    if async_writes_enabled() or request.query_params.get('async', '').lower() in ('1', 'true'):
+        # The write-behind queue lives in the Flask app's threads
+        return None
+    principal, denied = await authorize(request)
+    if denied:
+        return denied
+
+    data = await read_json(request) or {}
+    predictions = data.get('predictions', [])
+    # Trust the signed token over whatever username the body claims
+    username = principal['username'] if principal else data.get('username', 'Anonymous')
+    if not predictions or not isinstance(predictions, list):
+        return json_response({'error': 'No predictions provided'}, 400)
+
+    db = database()
+    if db is None:
+        return json_response({'error': 'Database connection failed'}, 500)
+
+    created_at = datetime.utcnow()
+    classification_id = await save_run_async(db, username, predictions, created_at)
+    try:
+        await update_rollups_async(db, username, predictions, created_at)
+    except Exception as e:
+        # The run itself is saved; `python rollups.py rebuild` repairs the stats
+        await run_in_threadpool(rollup_failed, get_db(), [classification_id], e, 'async')
+    await run_in_threadpool(schedule_layouts, get_db(), [classification_id])
+    http_cache.invalidate('classifications')
+
+    return json_response({
+        'message': 'Classification results saved successfully',
+        'id': str(classification_id),
+        'total_saved': len(predictions)
+    }, 201)
+
+
+_model_client = None
+
+
+async def classify_reviews(request):
+    global _model_client
+    if embedded_enabled():
+        # CPU-bound; the Flask route runs it (and its remote fallback) in a thread
+        return None
+    principal, denied = await authorize(request)
+    if denied:
+        return denied
+
+    form = await request.form()
+    try:
+        upload = form.get('file')
+        if upload is None or isinstance(upload, str):
+            return json_response({'error': 'No file uploaded'}, 400)
+        if _model_client is None:
+            _model_client = AsyncModelClient()
+        client = _model_client
+        if not client.configured:
+            return json_response({'error': 'Model endpoint not configured'}, 503)
+
+        fieldnames, rows = await run_in_threadpool(iter_csv_rows, upload.file)
+        if not fieldnames:
+            return json_response({'error': 'Uploaded CSV is empty'}, 400)
+        cache_before = client.cache.stats() if client.cache else None
+        predictions = await client.classify_rows(rows, fieldnames)
+        body = {'predictions': predictions, 'total': len(predictions), 'engine': 'remote'}
+        if cache_before:
+            after = client.cache.stats()
+            body['cache'] = {
+                'hits': (after['memory_hits'] + after['store_hits'])
+                        - (cache_before['memory_hits'] + cache_before['store_hits']),
+                'misses': after['misses'] - cache_before['misses'],
+            }
+        return json_response(body)
+    except ModelServiceError as e:
+        print(f"Model endpoint error: {str(e)}")
+        return json_response({'error': str(e)}, 502)
+    except (UnicodeDecodeError, csv.Error) as e:
+        return json_response({'error': f'Could not parse CSV: {str(e)}'}, 400)
+    finally:
+        await form.close()
+
+
+ROUTES = {
+    ('POST', '/api/auth/login'): login,
+    ('GET', '/api/classifications'): get_classifications,
+    ('POST', '/api/classifications'): save_classification,
+    ('GET', '/api/feedback'): list_feedback,
+    ('POST', '/api/feedback'): submit_feedback,
+    ('POST', '/api/classify'): classify_reviews,
+}
+
+
+# -- application -------------------------------------------------------------
+
+class AsyncApp:
+    """Dispatches native routes on the event loop and everything else to Flask."""
+
+    def __init__(self, flask_app, routes):
+        self.routes = routes
+        self.flask = WSGIMiddleware(flask_app, workers=max(1, _env_int('ASGI_FLASK_THREADS', 16)))
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        handler = self.routes.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+        if handler is not None:
+            request = Request(scope, receive)
+            started = metrics_registry.request_started() if metrics_enabled() else None
+            admission = response = None
+            try:
+                if rate_limit.rate_limit_enabled():
+                    admission = rate_limit.limiter.admit(scope['method'], scope['path'], self.identity(request))
+                response = await self.handle(handler, request)
+            except rate_limit.RateLimited as e:
+                response = json_response(e.body(), 429, e.headers())
+            finally:
+                if admission is not None:
+                    # A delegated request is admitted again by the Flask app
+                    admission.release(refund=response is None)
+            if started is not None:
+                # Delegated requests (no response) are recorded by the Flask app itself
+                metrics_registry.request_finished(started, scope['method'], scope['path'],
+                                                  response.status_code if response is not None else None)
+            if response is not None:
+                response = await self.compress(request, response)
+                self.cors(request, response)
+                await response(scope, receive, send)
+                return
+        await self.flask(scope, receive, send)
+
+    async def handle(self, handler, request):
+        try:
+            return await handler(request)
+        except PaginationError as e:
+            return json_response({'error': str(e)}, 400)
+        except Exception as e:
+            return json_response({'error': str(e)}, 500)
+
+    @staticmethod
+    def identity(request):
+        """rate_limit.identity without blocking: only tokens already verified count as users."""
+        header = request.headers.get('authorization', '')
+        token = header[7:].strip() if header.lower().startswith('bearer ') else None
+        principal = token_cache.get(token) if token else None
+        address = rate_limit.client_address(request.client.host if request.client else None,
+                                            request.headers.get('x-forwarded-for'))
+        return rate_limit.identity(principal, address)
+
+    @staticmethod
+    async def compress(request, response):
+        """Same negotiated compression as http_cache.compress_response in the Flask app."""
+        if 'content-encoding' in response.headers or response.status_code in (204, 304):
+            return response
+        body = response.body
+        if not http_cache.worth_compressing(body, response.media_type):
+            return response
+        encoding = http_cache.negotiate(request.headers.get('accept-encoding'))
+        if encoding is None:
+            return response
+        compressed = Response(await run_in_threadpool(http_cache.compress, body, encoding),
+                              status_code=response.status_code, media_type=response.media_type)
+        for name, value in response.headers.items():
+            if name not in ('content-length', 'content-type'):
+                compressed.headers.append(name, value)
+        compressed.headers['Content-Encoding'] = encoding
+        http_cache.add_vary(compressed.headers)
+        return compressed
+
+    @staticmethod
+    def cors(request, response):
+        """The headers flask-cors adds to the same routes (any origin, cursor header exposed)."""
+        origin = request.headers.get('origin')
+        if origin:
+            response.headers['Access-Control-Allow-Origin'] = origin
+            response.headers['Access-Control-Expose-Headers'] = f'{CURSOR_HEADER}, ETag'
+            response.headers.append('Vary', 'Origin')
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # Same one-off index bootstrap as the Flask app's before_request hook
+                await run_in_threadpool(ensure_indexes_once, get_db)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if _model_client is not None:
+                    await _model_client.aclose()
+                mongo_manager.close_async()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+app = AsyncApp(flask_app, ROUTES)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
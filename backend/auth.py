@@ -0,0 +1,275 @@
+"""Signed session tokens, password hashing and in-process verification caches.
+
+`/api/auth/login` checks the password once and returns a signed token
+(itsdangerous, HMAC). Later requests send it as `Authorization: Bearer
+<token>` and are verified locally without touching Mongo. Two bounded
+TTL/LRU caches keep the hot path cheap:
+
+  * verified tokens -> principal, so repeated calls skip signature checks;
+  * successful password checks, so repeated logins skip the scrypt/pbkdf2 hash.
+
+Revoking a user (`revoke_user`) removes them from approved_users, records a
+revocation in `token_revocations` and evicts their cache entries. Other
+worker processes pick revocations up within AUTH_REVOCATION_REFRESH_SECONDS.
+The role is read from approved_users rather than trusted from the token
+(cached for AUTH_ROLE_REFRESH_SECONDS), so demoting a user, or removing
+them, takes effect without revoking their tokens.
+
+Configuration (environment variables):
+  AUTH_SECRET_KEY                   signing key, shared by every worker; without it login is
+                                    disabled and every bearer token is rejected
+  AUTH_TOKEN_TTL_SECONDS            token lifetime (default 43200 = 12h)
+  AUTH_CACHE_TTL_SECONDS            cache entry lifetime (default 300)
+  AUTH_CACHE_SIZE                   max entries per cache (default 10000)
+  AUTH_REVOCATION_REFRESH_SECONDS   revocation poll interval (default 30)
+  AUTH_ROLE_REFRESH_SECONDS         how long a user's role is cached (default 60)
+  AUTH_REQUIRED                     reject requests without a token (default false);
+                                    admin-only routes need an admin token either way
+"""
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import request, jsonify, g
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+from werkzeug.security import check_password_hash, generate_password_hash
+
+import db as _db
+from ttl_cache import TTLCache
+
+HASH_PREFIXES = ('scrypt:', 'pbkdf2:')
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _secret_key():
+    key = os.environ.get('AUTH_SECRET_KEY', '').strip()
+    if not key or key.startswith('<'):
+        # Never derived from another credential: whoever knows it could mint admin tokens
+        print('AUTH_SECRET_KEY not set; login is disabled and bearer tokens are rejected')
+        return None
+    return key
+
+
+_secret = _secret_key()
+_serializer = URLSafeTimedSerializer(_secret, salt='aegis-auth') if _secret else None
+# Keys the in-process password cache only, so it need not be shared
+_password_cache_key = secrets.token_bytes(32)
+# Checked for unknown users, so they cost as much as a wrong password
+_dummy_hash = generate_password_hash(secrets.token_hex(16))
+token_cache = TTLCache(_env_int('AUTH_CACHE_SIZE', 10000), _env_int('AUTH_CACHE_TTL_SECONDS', 300))
+password_cache = TTLCache(_env_int('AUTH_CACHE_SIZE', 10000), _env_int('AUTH_CACHE_TTL_SECONDS', 300))
+role_cache = TTLCache(_env_int('AUTH_CACHE_SIZE', 10000), _env_int('AUTH_ROLE_REFRESH_SECONDS', 60))
+
+_revoked = {}               # username -> unix time of revocation
+_revoked_loaded_at = None
+_revoked_lock = threading.Lock()
+
+
+def token_ttl():
+    return _env_int('AUTH_TOKEN_TTL_SECONDS', 43200)
+
+
+def login_enabled():
+    """False without AUTH_SECRET_KEY: no tokens can be issued or verified."""
+    return _serializer is not None
+
+
+def auth_required():
+    return os.environ.get('AUTH_REQUIRED', 'false').lower() in ('1', 'true', 'yes')
+
+
+# -- passwords ---------------------------------------------------------
+def hash_password(password):
+    return generate_password_hash(password)
+
+
+def is_hashed(stored):
+    return isinstance(stored, str) and stored.startswith(HASH_PREFIXES)
+
+
+def check_password(username, stored, password):
+    """Verify `password` against the stored value (hash or legacy plaintext).
+
+    Without a stored value (unknown user) the password is still checked
+    against a dummy hash, so the response time does not reveal whether the
+    account exists.
+    """
+    if not password:
+        return False
+    if not stored:
+        check_password_hash(_dummy_hash, password)
+        return False
+    key = hmac.new(_password_cache_key, f'{username}\0{stored}\0{password}'.encode('utf-8'),
+                   hashlib.sha256).digest()
+    if password_cache.get(key):
+        return True
+    if is_hashed(stored):
+        ok = check_password_hash(stored, password)
+    else:
+        # Accounts created before passwords were hashed
+        ok = hmac.compare_digest(str(stored).encode('utf-8'), password.encode('utf-8'))
+    if ok:
+        password_cache.set(key, True)
+    return ok
+
+
+# -- tokens ------------------------------------------------------------
+def issue_token(user):
+    if _serializer is None:
+        raise RuntimeError('AUTH_SECRET_KEY is not set')
+    return _serializer.dumps({'u': user['username'], 'r': user.get('role', 'user')})
+
+
+def _utc_timestamp(value):
+    # Mongo hands back naive datetimes that are UTC
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _refresh_revocations(force=False):
+    global _revoked_loaded_at
+    interval = _env_int('AUTH_REVOCATION_REFRESH_SECONDS', 30)
+    now = time.monotonic()
+    if not force and _revoked_loaded_at is not None and now - _revoked_loaded_at < interval:
+        return
+    with _revoked_lock:
+        if not force and _revoked_loaded_at is not None and now - _revoked_loaded_at < interval:
+            return
+        _revoked_loaded_at = now
+        database = _db.get_db()
+        if database is None:
+            return
+        fresh = {}
+        for doc in database.token_revocations.find({}, {'_id': 0, 'username': 1, 'revoked_at': 1}):
+            fresh[doc['username']] = _utc_timestamp(doc['revoked_at'])
+        for username, revoked_at in fresh.items():
+            if _revoked.get(username) != revoked_at:
+                token_cache.discard_where(lambda k, v: v['username'] == username)
+        _revoked.clear()
+        _revoked.update(fresh)
+
+
+def current_role(username):
+    """The user's role in approved_users ('' if they are not approved), cached briefly.
+
+    None when Mongo cannot be reached; the role signed into the token is
+    used until it can.
+    """
+    cached = role_cache.get(username)
+    if cached is not None:
+        return cached
+    database = _db.get_db()
+    if database is None:
+        return None
+    try:
+        user = database.approved_users.find_one({'username': username}, {'role': 1})
+    except Exception as e:
+        print(f"Could not load the role of {username}: {str(e)}")
+        return None
+    role = user.get('role', 'user') if user else ''
+    role_cache.set(username, role)
+    return role
+
+
+def verify_token(token):
+    """Return the principal for a valid token, or None.
+
+    The role comes from approved_users (current_role), not the token, so a
+    changed role applies within AUTH_ROLE_REFRESH_SECONDS.
+    """
+    if not token or _serializer is None:
+        return None
+    _refresh_revocations()
+    principal = token_cache.get(token)
+    if principal is None:
+        try:
+            payload, issued = _serializer.loads(token, max_age=token_ttl(), return_timestamp=True)
+        except (BadSignature, SignatureExpired):
+            return None
+        issued_at = issued.timestamp()
+        revoked_at = _revoked.get(payload.get('u'))
+        if revoked_at is not None and issued_at <= revoked_at:
+            return None
+        principal = {'username': payload['u'], 'role': payload.get('r', 'user'),
+                     'expires_at': issued_at + token_ttl()}
+        token_cache.set(token, principal, ttl=principal['expires_at'] - time.time())
+
+    role = current_role(principal['username'])
+    if role == '':
+        # No longer an approved user
+        return None
+    if role is not None and role != principal['role']:
+        return dict(principal, role=role)
+    return principal
+
+
+def revoke_user(database, username):
+    """Remove a user from approved_users and invalidate their tokens everywhere."""
+    result = database.approved_users.delete_one({'username': username})
+    # Second resolution (tokens carry whole seconds): revoke everything issued so far
+    now = datetime.utcfromtimestamp(int(time.time()))
+    database.token_revocations.update_one({'username': username},
+                                          {'$set': {'username': username, 'revoked_at': now}},
+                                          upsert=True)
+    with _revoked_lock:
+        _revoked[username] = _utc_timestamp(now)
+    token_cache.discard_where(lambda k, v: v['username'] == username)
+    role_cache.discard_where(lambda k, v: k == username)
+    return result.deleted_count
+
+
+# -- request helpers ---------------------------------------------------
+def bearer_token():
+    header = request.headers.get('Authorization', '')
+    if header.lower().startswith('bearer '):
+        return header[7:].strip() or None
+    return None
+
+
+def current_principal():
+    """Principal for this request (cached on flask.g), or None."""
+    if 'principal' not in g:
+        g.principal = verify_token(bearer_token())
+    return g.principal
+
+
+def access_denied(token, principal, role=None):
+    """(error, status) when a request may not use a route, else None.
+
+    Bad tokens are always rejected, and routes declared with a `role` always
+    need a token holding it. AUTH_REQUIRED only decides whether anonymous
+    requests may use the other routes.
+    """
+    if token and principal is None:
+        return 'Invalid or expired token', 401
+    if principal is None:
+        if role or auth_required():
+            return 'Authentication required', 401
+        return None
+    if role and principal['role'] != role:
+        return 'Forbidden', 403
+    return None
+
+
+def login_required(role=None):
+    """Reject bad tokens, anonymous requests when AUTH_REQUIRED is on, and missing roles."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            denied = access_denied(bearer_token(), current_principal(), role)
+            if denied:
+                error, status = denied
+                return jsonify({'error': error}), status
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
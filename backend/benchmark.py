@@ -0,0 +1,532 @@
+"""Load and latency benchmark for the Flask API.
+
+Starts the app from mongo_connection.py in-process (or targets a running
+server with --url), seeds a throwaway database with synthetic users, access
+requests, classification runs and feedback, then drives concurrent
+scenarios and reports throughput and p50/p95/p99 latency per route:
+
+  login     POST /api/auth/login
+  save      POST /api/classifications (runs of --run-size predictions)
+  history   GET  /api/classifications?summary=true (as a regular user)
+  feedback  GET  /api/feedback (as an admin)
+  mixed     all of the above interleaved (weights 2:1:5:2)
+
+Results are written as JSON so two runs (e.g. before and after a commit) can
+be compared; `compare` exits 1 when any route regressed past the threshold.
+A scenario in which no request completed inside the measured window is
+reported as failed, and `run` then exits 1.
+Admission control (rate_limit.py) is off for the benchmarked server unless
+RATE_LIMIT_ENABLED is set.
+
+Stores:
+  --store memory   in-memory stand-in (needs `pip install mongomock`); no server required.
+                   mongomock scans collections linearly, so its numbers are only
+                   comparable with other memory-store runs, and it seeds a smaller
+                   dataset by default (see SEED_DEFAULTS)
+  --store mongod   MONGO_URL (default mongodb://localhost:27017), database
+                   BENCHMARK_DB_NAME (default aegis_benchmark), dropped and reseeded
+
+Usage:
+  python benchmark.py run --store memory --concurrency 8 --duration 10 --out bench.json
+  python benchmark.py run --store mongod --scenarios save,history --run-size 2000
+  python benchmark.py run --url http://localhost:5000 --store mongod   # e.g. against gunicorn
+
+Serving modes (--store mongod; the server runs as a child process and its
+resident memory, summed over all workers, is recorded in the report):
+  python benchmark.py run --store mongod --spawn gunicorn --workers 4 --out wsgi.json
+  python benchmark.py run --store mongod --spawn uvicorn --workers 1 --out asgi.json
+  python benchmark.py compare wsgi.json asgi.json
+Pick --workers so `server_rss_mb` comes out about equal to compare the two
+at the same memory budget.
+  python benchmark.py compare baseline.json bench.json --threshold 0.15
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import numpy as np
+import requests
+
+SCENARIOS = ('login', 'save', 'history', 'feedback', 'mixed')
+MIXED_WEIGHTS = {'login': 2, 'save': 1, 'history': 5, 'feedback': 2}
+PASSWORD = 'benchmark-password'
+ADMIN = 'bench-admin'
+# Seed sizes per store; mongomock's inserts and upserts scan every document
+SEED_DEFAULTS = {
+    'mongod': {'users': 50, 'access_requests': 200, 'runs': 200, 'run_size': 200, 'feedback': 1000},
+    'memory': {'users': 10, 'access_requests': 100, 'runs': 10, 'run_size': 50, 'feedback': 300},
+}
+
+
+# -- store and seed data -------------------------------------------------------
+
+def use_store(store):
+    """Point db.manager at the benchmark database; returns the database handle."""
+    from db import manager
+
+    if store == 'memory':
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit('--store memory needs mongomock: pip install mongomock')
+        os.environ['MONGO_URL'] = 'mongodb://in-memory'
+        os.environ['MONGO_DB_NAME'] = 'aegis_benchmark'
+        manager._client = mongomock.MongoClient()
+        manager._pid = os.getpid()
+        manager._healthy = True
+        manager._health_checked_at = float('inf')  # never re-ping the stand-in
+    else:
+        os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+        os.environ['MONGO_DB_NAME'] = os.environ.get('BENCHMARK_DB_NAME', 'aegis_benchmark')
+        if not manager.is_healthy(force=True):
+            sys.exit(f"Could not reach MongoDB at {os.environ['MONGO_URL']}")
+    return manager.get_client()[manager.db_name]
+
+
+def synthetic_predictions(rng, size, products=200, reviewers=None):
+    reviewers = reviewers or max(10, size // 3)
+    predictions = []
+    for i in range(size):
+        fraud = rng.random() < 0.2
+        p = rng.uniform(0.5, 1.0) if fraud else rng.uniform(0.0, 0.5)
+        predictions.append({
+            '_id': f'R{rng.getrandbits(40):010x}',
+            'reviewerID': f'U{rng.randrange(reviewers):05d}',
+            'asin': f'P{rng.randrange(products):05d}',
+            'category': rng.choice(('Electronics', 'Books', 'Home', 'Toys')),
+            'label': 'Fraud' if fraud else 'Benign',
+            'fraud_probability': round(p, 4),
+            'confidence': round(p if fraud else 1 - p, 4),
+        })
+    return predictions
+
+
+def seed(db, users=50, access_requests=200, runs=200, run_size=200, feedback=1000, seed_value=0):
+    """Drop and repopulate the benchmark collections; returns seeded usernames."""
+    from auth import hash_password
+    from indexes import apply_indexes
+    from predictions import save_run
+    from rollups import merge_rollups
+
+    rng = random.Random(seed_value)
+    for name in ('approved_users', 'access_requests', 'classifications', 'predictions',
+                 'classification_rollups', 'model_feedback', 'token_revocations'):
+        db[name].drop()
+    apply_indexes(db)
+
+    # One scrypt hash shared by every account keeps seeding fast
+    password_hash = hash_password(PASSWORD)
+    usernames = [f'bench-user-{i:04d}' for i in range(users)]
+    db.approved_users.insert_many(
+        [{'username': ADMIN, 'email': f'{ADMIN}@example.com', 'password': password_hash, 'role': 'admin'}]
+        + [{'username': u, 'email': f'{u}@example.com', 'password': password_hash, 'role': 'user'}
+           for u in usernames])
+
+    now = datetime.utcnow()
+    if access_requests:
+        db.access_requests.insert_many([{
+            'username': f'bench-request-{i:05d}',
+            'email': f'bench-request-{i:05d}@example.com',
+            'password': password_hash,
+            'status': rng.choice(('pending', 'pending', 'approved', 'denied')),
+            'created_at': now - timedelta(minutes=rng.randrange(60 * 24 * 30)),
+        } for i in range(access_requests)])
+
+    rollups = {}
+    for i in range(runs):
+        username = usernames[i % len(usernames)] if usernames else ADMIN
+        created_at = now - timedelta(minutes=rng.randrange(60 * 24 * 30))
+        predictions = synthetic_predictions(rng, run_size)
+        save_run(db, username, predictions, created_at)
+        merge_rollups([{'username': username, 'predictions': predictions, 'created_at': created_at}], rollups)
+    if rollups:
+        # The collection was just dropped: one insert instead of an upsert per rollup and run
+        db.classification_rollups.insert_many(list(rollups.values()))
+
+    if feedback:
+        db.model_feedback.insert_many([{
+            'transactionId': f'T{i:06d}',
+            'username': rng.choice(usernames) if usernames else ADMIN,
+            'rating': rng.randint(1, 5),
+            'comments': 'Synthetic benchmark feedback',
+            'created_at': now - timedelta(minutes=rng.randrange(60 * 24 * 30)),
+        } for i in range(feedback)])
+    return usernames
+
+
+# -- server ----------------------------------------------------------------------
+
+def start_server():
+    """Serve the app on a free local port from a background thread; returns its base URL."""
+    from werkzeug.serving import make_server
+    from mongo_connection import app
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='benchmark-server', daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}', server
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def spawn_server(kind, workers, threads):
+    """Start gunicorn (mongo_connection:app) or uvicorn (asgi_app:app) as a child process."""
+    port = free_port()
+    if kind == 'gunicorn':
+        cmd = [sys.executable, '-m', 'gunicorn', '-w', str(workers), '--threads', str(threads),
+               '-b', f'127.0.0.1:{port}', '--log-level', 'warning', 'mongo_connection:app']
+    else:
+        cmd = [sys.executable, '-m', 'uvicorn', 'asgi_app:app', '--workers', str(workers),
+               '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning', '--no-access-log']
+    proc = subprocess.Popen(cmd, cwd=os.path.dirname(os.path.abspath(__file__)), env=dict(os.environ))
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            sys.exit(f'{kind} exited with status {proc.returncode}')
+        try:
+            requests.get(f'{base_url}/api/test-connection', timeout=2)
+            return base_url, proc
+        except requests.RequestException:
+            time.sleep(0.25)
+    proc.terminate()
+    sys.exit(f'{kind} did not start within 60s')
+
+
+def process_tree_rss_mb(pid):
+    """Resident memory of `pid` and all its descendants (Linux /proc), or None."""
+    try:
+        parents = {}
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    with open(f'/proc/{entry}/stat') as f:
+                        # ppid is the 2nd field after the parenthesised command name
+                        parents[int(entry)] = int(f.read().rsplit(')', 1)[1].split()[1])
+                except (OSError, IndexError, ValueError):
+                    continue
+        tree, frontier = {pid}, [pid]
+        while frontier:
+            parent = frontier.pop()
+            children = [p for p, pp in parents.items() if pp == parent and p not in tree]
+            tree.update(children)
+            frontier.extend(children)
+        total_kb = 0
+        for p in tree:
+            try:
+                with open(f'/proc/{p}/status') as f:
+                    total_kb += next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+            except (OSError, StopIteration):
+                continue
+        return round(total_kb / 1024, 1)
+    except OSError:
+        return None
+
+
+# -- load generation -------------------------------------------------------------
+
+class Client:
+    """One virtual user: its own HTTP session and login token."""
+
+    def __init__(self, base_url, username, payloads, rng):
+        self.base_url = base_url
+        self.username = username
+        self.payloads = payloads
+        self.rng = rng
+        self.session = requests.Session()
+        self.token = None
+
+    def login(self):
+        response = self.session.post(f'{self.base_url}/api/auth/login',
+                                     json={'username': self.username, 'password': PASSWORD})
+        if response.status_code == 200:
+            self.token = response.json().get('token')
+            self.session.headers['Authorization'] = f'Bearer {self.token}'
+        return response
+
+    def call(self, scenario):
+        if scenario == 'login':
+            return self.login()
+        if scenario == 'save':
+            return self.session.post(f'{self.base_url}/api/classifications',
+                                     data=self.rng.choice(self.payloads),
+                                     headers={'Content-Type': 'application/json'})
+        if scenario == 'history':
+            return self.session.get(f'{self.base_url}/api/classifications',
+                                    params={'summary': 'true', 'limit': 20})
+        if scenario == 'feedback':
+            return self.session.get(f'{self.base_url}/api/feedback', params={'limit': 50})
+        raise ValueError(f'Unknown scenario {scenario}')
+
+
+def run_scenario(base_url, scenario, usernames, payloads, concurrency, duration, warmup, seed_value=0):
+    """Drive one scenario from `concurrency` threads; returns {route: latencies/errors}."""
+    results = defaultdict(lambda: {'latencies': [], 'errors': 0, 'statuses': defaultdict(int)})
+    window = {'start': None, 'end': 0.0}
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(concurrency)
+    choices = [name for name, weight in MIXED_WEIGHTS.items() for _ in range(weight)]
+
+    def worker(index):
+        rng = random.Random(seed_value * 1000 + index)
+        local = defaultdict(lambda: {'latencies': [], 'errors': 0, 'statuses': defaultdict(int)})
+        clients = {
+            'user': Client(base_url, usernames[index % len(usernames)] if usernames else ADMIN, payloads, rng),
+            'admin': Client(base_url, ADMIN, payloads, rng),
+        }
+        for client in clients.values():
+            client.login()
+        start_barrier.wait()
+        started = time.perf_counter()
+        record_from = started + warmup
+        deadline = record_from + duration
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            step = rng.choice(choices) if scenario == 'mixed' else scenario
+            client = clients['admin' if step == 'feedback' else 'user']
+            t0 = time.perf_counter()
+            try:
+                status = client.call(step).status_code
+            except requests.RequestException:
+                status = 0
+            elapsed = time.perf_counter() - t0
+            if t0 >= record_from:
+                entry = local[step]
+                entry['latencies'].append(elapsed)
+                entry['statuses'][status] += 1
+                if status == 0 or status >= 400:
+                    entry['errors'] += 1
+        with lock:
+            # Requests still running at the deadline are allowed to finish and count
+            window['start'] = record_from
+            window['end'] = max(window['end'], time.perf_counter(), deadline)
+            for route, entry in local.items():
+                results[route]['latencies'].extend(entry['latencies'])
+                results[route]['errors'] += entry['errors']
+                for status, count in entry['statuses'].items():
+                    results[route]['statuses'][status] += count
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    measured = window['end'] - window['start'] if window['start'] is not None else duration
+    return {route: summarize(entry, measured) for route, entry in results.items()}
+
+
+def summarize(entry, seconds):
+    latencies = np.asarray(entry['latencies']) * 1000.0
+    count = len(latencies)
+    stats = {
+        'requests': count,
+        'errors': entry['errors'],
+        'statuses': {str(k): v for k, v in sorted(entry['statuses'].items())},
+        'measured_seconds': round(seconds, 3),
+        'throughput_rps': round(count / seconds, 2) if seconds else None,
+    }
+    if count:
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        stats.update({
+            'mean_ms': round(float(latencies.mean()), 2),
+            'p50_ms': round(float(p50), 2),
+            'p95_ms': round(float(p95), 2),
+            'p99_ms': round(float(p99), 2),
+            'max_ms': round(float(latencies.max()), 2),
+        })
+    return stats
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(args):
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        sys.exit(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+    os.environ.setdefault('AUTH_SECRET_KEY', 'benchmark-secret')
+    # A few users hammering login and save would mostly measure 429s; set
+    # RATE_LIMIT_ENABLED=true to benchmark with admission control on
+    os.environ.setdefault('RATE_LIMIT_ENABLED', 'false')
+    for name, value in SEED_DEFAULTS[args.store].items():
+        if getattr(args, name) is None:
+            setattr(args, name, value)
+
+    db = use_store(args.store)
+    print(f'Seeding {args.store} store...')
+    t0 = time.perf_counter()
+    usernames = seed(db, args.users, args.access_requests, args.runs, args.run_size, args.feedback, args.seed)
+    seed_seconds = time.perf_counter() - t0
+
+    server = process = None
+    base_url = args.url
+    if args.spawn:
+        if args.store != 'mongod':
+            sys.exit('--spawn needs --store mongod (the server runs in another process)')
+        base_url, process = spawn_server(args.spawn, args.workers, args.threads)
+    elif not base_url:
+        base_url, server = start_server()
+
+    rng = random.Random(args.seed)
+    payloads = [json.dumps({'predictions': synthetic_predictions(rng, args.run_size)}) for _ in range(8)]
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'store': args.store,
+            'server': (f'{args.spawn} --workers {args.workers}'
+                       + (f' --threads {args.threads}' if args.spawn == 'gunicorn' else '')
+                       if args.spawn else args.url or 'in-process werkzeug (threaded)'),
+            'server_rss_mb': None,
+            'write_mode': os.environ.get('CLASSIFICATION_WRITE_MODE', 'sync'),
+            'rate_limit': os.environ.get('RATE_LIMIT_ENABLED'),
+            'concurrency': args.concurrency,
+            'duration_seconds': args.duration,
+            'warmup_seconds': args.warmup,
+            'seed': {'users': args.users, 'access_requests': args.access_requests, 'runs': args.runs,
+                     'run_size': args.run_size, 'feedback': args.feedback,
+                     'seconds': round(seed_seconds, 2)},
+        },
+        'scenarios': {},
+        'failed_scenarios': [],
+    }
+    try:
+        for scenario in scenarios:
+            print(f'Running {scenario} ({args.concurrency} threads, {args.duration}s)...')
+            routes = run_scenario(base_url, scenario, usernames, payloads, args.concurrency,
+                                  args.duration, args.warmup, args.seed)
+            report['scenarios'][scenario] = routes
+            if not any(stats['requests'] for stats in routes.values()):
+                report['failed_scenarios'].append(scenario)
+                print(f'  FAILED: no {scenario} request completed inside the {args.duration}s window '
+                      f'(is the store too slow for this dataset, or is every login failing?)')
+            if process is not None:
+                rss = process_tree_rss_mb(process.pid)
+                if rss is not None:
+                    report['meta']['server_rss_mb'] = max(rss, report['meta']['server_rss_mb'] or 0)
+                    print(f'  server resident memory {rss} MB')
+            for route, stats in sorted(routes.items()):
+                print(f"  {route:10s} {stats['requests']:7d} req  {stats['throughput_rps']:9.1f} rps  "
+                      f"p50 {stats.get('p50_ms', 0):8.1f}  p95 {stats.get('p95_ms', 0):8.1f}  "
+                      f"p99 {stats.get('p99_ms', 0):8.1f} ms  errors {stats['errors']}")
+    finally:
+        if server is not None:
+            server.shutdown()
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f'Wrote {args.out}')
+    if report['failed_scenarios']:
+        print(f"Failed scenarios: {', '.join(report['failed_scenarios'])}")
+        return 1
+    return 0
+
+
+# -- regression check --------------------------------------------------------------
+
+def compare(args):
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.candidate, encoding='utf-8') as f:
+        candidate = json.load(f)
+
+    for key in ('store', 'server', 'write_mode', 'concurrency', 'duration_seconds', 'seed'):
+        if baseline['meta'].get(key) != candidate['meta'].get(key):
+            print(f"warning: {key} differs ({baseline['meta'].get(key)} vs {candidate['meta'].get(key)})")
+    rss = (baseline['meta'].get('server_rss_mb'), candidate['meta'].get('server_rss_mb'))
+    if any(rss):
+        print(f'server resident memory: {rss[0]} MB vs {rss[1]} MB')
+
+    regressions = 0
+    print(f"{'scenario/route':24s} {'p95 base':>9s} {'p95 new':>9s} {'change':>8s} "
+          f"{'rps base':>9s} {'rps new':>9s} {'change':>8s}")
+    for scenario, routes in candidate['scenarios'].items():
+        for route, new in routes.items():
+            old = baseline['scenarios'].get(scenario, {}).get(route)
+            if not old or 'p95_ms' not in old or 'p95_ms' not in new:
+                continue
+            latency_change = (new['p95_ms'] - old['p95_ms']) / old['p95_ms'] if old['p95_ms'] else 0.0
+            rps_change = ((new['throughput_rps'] - old['throughput_rps']) / old['throughput_rps']
+                          if old['throughput_rps'] else 0.0)
+            regressed = latency_change > args.threshold or rps_change < -args.threshold
+            regressions += regressed
+            print(f"{scenario + '/' + route:24s} {old['p95_ms']:9.1f} {new['p95_ms']:9.1f} {latency_change:+8.1%} "
+                  f"{old['throughput_rps']:9.1f} {new['throughput_rps']:9.1f} {rps_change:+8.1%}"
+                  f"{'  REGRESSION' if regressed else ''}")
+    for scenario in candidate.get('failed_scenarios', []):
+        print(f"{scenario:24s} no requests completed  REGRESSION")
+        regressions += 1
+    print(f'{regressions} regression(s) beyond {args.threshold:.0%}')
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Aegis API')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('run', help='seed a store, drive the scenarios, write a JSON report')
+    p.add_argument('--store', choices=('memory', 'mongod'), default='memory')
+    p.add_argument('--url', help='benchmark a running server instead of an in-process one '
+                                 '(it must use the same database as --store)')
+    p.add_argument('--spawn', choices=('gunicorn', 'uvicorn'),
+                   help='run mongo_connection:app under gunicorn or asgi_app:app under uvicorn')
+    p.add_argument('--workers', type=int, default=2, help='server worker processes (with --spawn)')
+    p.add_argument('--threads', type=int, default=1, help='threads per gunicorn worker (with --spawn)')
+    p.add_argument('--scenarios', default=','.join(SCENARIOS))
+    p.add_argument('--concurrency', type=int, default=8)
+    p.add_argument('--duration', type=float, default=10, help='measured seconds per scenario')
+    p.add_argument('--warmup', type=float, default=1, help='unmeasured seconds before each scenario')
+    # Seed sizes default per store (SEED_DEFAULTS)
+    p.add_argument('--users', type=int)
+    p.add_argument('--access-requests', type=int)
+    p.add_argument('--runs', type=int)
+    p.add_argument('--run-size', type=int, help='predictions per classification run')
+    p.add_argument('--feedback', type=int)
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--out', default='benchmark-results.json')
+
+    p = sub.add_parser('compare', help='compare two reports; exit 1 on regressions')
+    p.add_argument('baseline')
+    p.add_argument('candidate')
+    p.add_argument('--threshold', type=float, default=0.15,
+                   help='allowed fractional p95 increase / throughput drop (default 0.15)')
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        return run(args)
+    return compare(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
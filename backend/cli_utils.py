@@ -0,0 +1,39 @@
+"""Small parsing helpers shared by the admin CLIs and the stats route.
+
+Kept free of database setup and side effects, so any script can import
+them without connecting to MongoDB.
+"""
+import sys
+from datetime import datetime, timezone
+
+
+def read_usernames(path):
+    """Usernames from a file (or stdin for '-'): one per line, first CSV field, '#' comments."""
+    f = sys.stdin if path == '-' else open(path, encoding='utf-8')
+    try:
+        names = []
+        for line in f:
+            name = line.split('#', 1)[0].split(',', 1)[0].strip()
+            if name and name not in names:
+                names.append(name)
+        return names
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def parse_time(value, default):
+    """ISO 8601 timestamp as a naive UTC datetime, or `default` if empty.
+
+    A UTC offset (or a trailing Z) is converted to UTC; a value without one
+    is taken as UTC already, like the stored `created_at` fields.
+    """
+    if not value:
+        return default
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError(f'Invalid timestamp: {value}')
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
@@ -0,0 +1,323 @@
+"""Process-wide pooled MongoDB connection manager.
+
+Every module in the backend should get its database handle through
+`get_db()` instead of building its own `pymongo.MongoClient`. The client is
+created lazily, once per process, and reused for every request. It is
+re-created after `os.fork()` so gunicorn workers never share sockets with
+the master process. The ASGI app (asgi_app.py) gets an asyncio client
+(motor) with the same options and listeners from `get_async_db()`.
+
+Configuration (environment variables, all optional except MONGO_URL):
+  MONGO_URL                          connection string
+  MONGO_DB_NAME                      database name (default fraud_detection)
+  MONGO_MAX_POOL_SIZE                max sockets per server (default 50)
+  MONGO_MIN_POOL_SIZE                sockets kept warm (default 0)
+  MONGO_MAX_IDLE_TIME_MS             close idle sockets after (default 60000)
+  MONGO_WAIT_QUEUE_TIMEOUT_MS        max wait for a free socket (default 5000)
+  MONGO_SERVER_SELECTION_TIMEOUT_MS  (default 10000)
+  MONGO_CONNECT_TIMEOUT_MS           (default 10000)
+  MONGO_SOCKET_TIMEOUT_MS            (default 30000)
+  MONGO_HEALTH_TTL_SECONDS           how long a ping result is trusted (default 15)
+"""
+import os
+import threading
+import time
+import traceback
+
+import certifi
+import pymongo
+from pymongo import monitoring, uri_parser
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:  # only the synchronous app is available
+    AsyncIOMotorClient = None
+from dotenv import load_dotenv
+
+load_dotenv(dotenv_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env'))
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    if value in (None, ''):
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        print(f"Ignoring invalid {name}={value!r}, using {default}")
+        return default
+
+
+def _uri_options(url):
+    """The URI's query options, keys lower-cased (`ssl` is reported as `tls`)."""
+    if not url:
+        return {}
+    try:
+        if url.startswith('mongodb+srv://'):
+            # parse_uri would resolve the SRV record here; only the options are needed
+            query = url.partition('?')[2]
+            return dict(uri_parser.split_options(query, validate=False)) if query else {}
+        return dict(uri_parser.parse_uri(url, validate=False)['options'])
+    except (ValueError, pymongo.errors.PyMongoError):
+        # MongoClient reports the malformed URI itself
+        return {}
+
+
+def _uses_tls(url, uri_options):
+    """TLS is on by default for mongodb+srv:// and otherwise only when tls/ssl is true."""
+    tls = str(uri_options.get('tls', '')).lower()
+    if url and url.startswith('mongodb+srv://'):
+        return tls != 'false'
+    return tls == 'true'
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """Counts connection pool events so they can be reported cheaply."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.created = 0
+            self.closed = 0
+            self.checked_out = 0
+            self.checked_in = 0
+            self.checkout_failed = 0
+            self.pools_cleared = 0
+
+    def _incr(self, field):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._incr('pools_cleared')
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._incr('created')
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._incr('closed')
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._incr('checkout_failed')
+
+    def connection_checked_out(self, event):
+        self._incr('checked_out')
+
+    def connection_checked_in(self, event):
+        self._incr('checked_in')
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'open_connections': self.created - self.closed,
+                'in_use': self.checked_out - self.checked_in,
+                'connections_created': self.created,
+                'connections_closed': self.closed,
+                'checkouts': self.checked_out,
+                'checkout_failures': self.checkout_failed,
+                'pools_cleared': self.pools_cleared,
+            }
+
+
+class MongoManager:
+    """Owns the single MongoClient for the current process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client = None
+        self._pid = None
+        self._async_client = None
+        self._async_pid = None
+        self._listeners = []
+        self.pool_stats = PoolStats()
+        self._healthy = None
+        self._health_checked_at = 0.0
+        self._health_error = None
+
+    # -- configuration -------------------------------------------------
+    @property
+    def url(self):
+        return os.environ.get('MONGO_URL')
+
+    @property
+    def db_name(self):
+        return os.environ.get('MONGO_DB_NAME', 'fraud_detection')
+
+    def client_options(self):
+        options = {
+            'maxPoolSize': _env_int('MONGO_MAX_POOL_SIZE', 50),
+            'minPoolSize': _env_int('MONGO_MIN_POOL_SIZE', 0),
+            'maxIdleTimeMS': _env_int('MONGO_MAX_IDLE_TIME_MS', 60000),
+            'waitQueueTimeoutMS': _env_int('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000),
+            'serverSelectionTimeoutMS': _env_int('MONGO_SERVER_SELECTION_TIMEOUT_MS', 10000),
+            'connectTimeoutMS': _env_int('MONGO_CONNECT_TIMEOUT_MS', 10000),
+            'socketTimeoutMS': _env_int('MONGO_SOCKET_TIMEOUT_MS', 30000),
+        }
+        # Use certifi CA bundle to avoid local OpenSSL CA issues (TLS URLs only)
+        uri_options = _uri_options(self.url)
+        if _uses_tls(self.url, uri_options) and 'tlscafile' not in uri_options:
+            options['tlsCAFile'] = certifi.where()
+        return options
+
+    def add_listener(self, listener):
+        """Register a pymongo event listener for clients created from now on."""
+        with self._lock:
+            if listener not in self._listeners:
+                self._listeners.append(listener)
+
+    # -- client lifecycle ----------------------------------------------
+    def get_client(self):
+        """Return the process-wide client, creating it on first use."""
+        if not self.url:
+            return None
+        pid = os.getpid()
+        client = self._client
+        if client is not None and self._pid == pid:
+            return client
+        with self._lock:
+            if self._client is None or self._pid != pid:
+                # A client inherited across fork() must not be used or closed
+                # in the child; just drop the reference and build a new one.
+                self.pool_stats.reset()
+                self._client = pymongo.MongoClient(
+                    self.url,
+                    event_listeners=[self.pool_stats] + list(self._listeners),
+                    **self.client_options()
+                )
+                self._pid = pid
+                self._healthy = None
+            return self._client
+
+    def get_async_client(self):
+        """Return the process-wide asyncio (motor) client, creating it on first use.
+
+        Must be called from the event loop that will use it (one per ASGI worker).
+        """
+        if not self.url:
+            return None
+        if AsyncIOMotorClient is None:
+            raise RuntimeError('The async app needs motor: pip install motor')
+        pid = os.getpid()
+        if self._async_client is None or self._async_pid != pid:
+            with self._lock:
+                if self._async_client is None or self._async_pid != pid:
+                    self._async_client = AsyncIOMotorClient(
+                        self.url,
+                        event_listeners=[self.pool_stats] + list(self._listeners),
+                        **self.client_options()
+                    )
+                    self._async_pid = pid
+        return self._async_client
+
+    def get_async_db(self):
+        client = self.get_async_client()
+        return client[self.db_name] if client is not None else None
+
+    def close_async(self):
+        with self._lock:
+            if self._async_client is not None and self._async_pid == os.getpid():
+                self._async_client.close()
+            self._async_client = None
+            self._async_pid = None
+
+    def get_db(self):
+        """Return the database handle, or None if Mongo is known to be down.
+
+        Unlike the old per-request probes this does not talk to the server on
+        every call; it trusts the last health check for MONGO_HEALTH_TTL_SECONDS.
+        """
+        client = self.get_client()
+        if client is None:
+            return None
+        if not self.is_healthy():
+            return None
+        return client[self.db_name]
+
+    def is_healthy(self, force=False):
+        ttl = _env_int('MONGO_HEALTH_TTL_SECONDS', 15)
+        now = time.monotonic()
+        if not force and self._healthy is not None and now - self._health_checked_at < ttl:
+            return self._healthy
+        client = self.get_client()
+        if client is None:
+            return False
+        try:
+            client.admin.command('ping')
+            self._healthy, self._health_error = True, None
+        except Exception as e:
+            print(f"MongoDB Connection Error: {str(e)}")
+            traceback.print_exc()
+            self._healthy, self._health_error = False, str(e)
+        self._health_checked_at = now
+        return self._healthy
+
+    def mark_unhealthy(self, error):
+        """Let callers report a connection failure seen outside the health check."""
+        self._healthy, self._health_error = False, str(error)
+        self._health_checked_at = time.monotonic()
+
+    def reset(self):
+        """Forget the current client (used after fork and on shutdown)."""
+        self._client = None
+        self._pid = None
+        self._async_client = None
+        self._async_pid = None
+        self._healthy = None
+
+    def close(self):
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self.reset()
+
+    def stats(self):
+        checked_ago = None
+        if self._health_checked_at:
+            checked_ago = round(time.monotonic() - self._health_checked_at, 3)
+        options = self.client_options()
+        return {
+            'pid': os.getpid(),
+            'client_created': self._client is not None and self._pid == os.getpid(),
+            'healthy': self._healthy,
+            'health_error': self._health_error,
+            'health_checked_seconds_ago': checked_ago,
+            'max_pool_size': options['maxPoolSize'],
+            'min_pool_size': options['minPoolSize'],
+            'wait_queue_timeout_ms': options['waitQueueTimeoutMS'],
+            'pool': self.pool_stats.snapshot(),
+        }
+
+
+manager = MongoManager()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=manager.reset)
+
+
+def get_client():
+    return manager.get_client()
+
+
+def get_db():
+    return manager.get_db()
+
+
+def get_async_db():
+    return manager.get_async_db()
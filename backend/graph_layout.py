@@ -0,0 +1,395 @@
+"""Precomputed force-directed layouts for review graphs.
+
+`/api/graph/<classification_id>` sends node coordinates with the graph, so
+the browser only has to draw it. Layouts are Fruchterman-Reingold style:
+spring attraction along edges, plus all-pairs repulsion approximated with a
+Barnes-Hut quadtree. The whole computation is vectorized with NumPy. The
+quadtree is one level of grid cells per depth, with mass and centre of mass
+per cell from `bincount`. The traversal keeps a (node, cell) frontier per
+level and opens only the cells too close to approximate.
+
+Layouts are stored in the `graph_layouts` collection under a content hash of
+the laid-out graph (node ids plus weighted edges), so the same graph is never
+laid out twice. A new graph from the same user starts from that user's
+latest layout. Nodes seen before keep their positions, new nodes start at
+the mean of their placed neighbours, and the simulation runs a short,
+cooler pass instead of a full one.
+
+Coordinates are returned in the unit square; the frontend scales them to
+its canvas.
+
+A cold layout of a large graph takes seconds, so it is computed when the
+run is saved: every save path queues the run on a background thread (one
+per process, each graph queued once), and `/api/graph` normally only reads
+the stored coordinates. A graph requested before its layout is ready (or
+saved before layouts existed) is laid out inside the request if it has at
+most GRAPH_LAYOUT_SYNC_MAX_NODES nodes. Larger ones are queued, and the
+request gets the graph without positions and `layout.pending`.
+
+Configuration (environment variables):
+  GRAPH_LAYOUT_MAX_NODES        nodes laid out per run, highest-risk first (default 2000)
+  GRAPH_LAYOUT_ON_SAVE          queue each saved run's layout (default true)
+  GRAPH_LAYOUT_SYNC_MAX_NODES   largest layout computed inside the request (default 300)
+  GRAPH_LAYOUT_MAX_PENDING      layouts queued for the background thread per process (default 16)
+  GRAPH_LAYOUT_ITERATIONS       iterations from scratch (default 100)
+  GRAPH_LAYOUT_WARM_ITERATIONS  iterations when warm-starting (default 30)
+  GRAPH_LAYOUT_THETA            Barnes-Hut opening angle (default 0.8)
+"""
+import hashlib
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+from bson.binary import Binary
+
+from review_graph import ReviewGraph
+from ttl_cache import TTLCache
+
+LAYOUT_VERSION = 'fr-bh-1'
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def content_hash(node_ids, src, dst, weights):
+    """Stable key for a graph: its node ids in order plus its weighted edge list."""
+    h = hashlib.sha256(LAYOUT_VERSION.encode('utf-8'))
+    h.update('\x1f'.join(node_ids).encode('utf-8'))
+    for array in (src, dst, weights):
+        h.update(b'\x1e')
+        h.update(np.ascontiguousarray(array, dtype=np.int64).tobytes())
+    return h.hexdigest()
+
+
+# -- Barnes-Hut repulsion ------------------------------------------------------
+
+def _quadtree(pos, depth):
+    """Per-level cell keys, masses and centres of mass for unit-mass points."""
+    lo = pos.min(axis=0)
+    span = max(float((pos.max(axis=0) - lo).max()), 1e-9) * (1 + 1e-9)
+    unit = (pos - lo) / span
+    levels = []
+    for level in range(1, depth + 1):
+        side = 1 << level
+        cell = np.minimum((unit * side).astype(np.int64), side - 1)
+        node_key = cell[:, 0] * side + cell[:, 1]
+        keys, inverse = np.unique(node_key, return_inverse=True)
+        mass = np.bincount(inverse).astype(np.float64)
+        com = np.stack([np.bincount(inverse, weights=pos[:, 0]),
+                        np.bincount(inverse, weights=pos[:, 1])], axis=1) / mass[:, None]
+        levels.append((side, keys, mass, com, node_key))
+    return levels, span
+
+
+def _repulsion(pos, k2, theta, min_dist):
+    """Approximate sum over j != i of k^2 / d_ij along (p_i - p_j)."""
+    n = len(pos)
+    depth = int(np.clip(np.ceil(np.log(max(n, 2)) / np.log(4)), 2, 12))
+    levels, span = _quadtree(pos, depth)
+    fx = np.zeros(n)
+    fy = np.zeros(n)
+
+    side, keys, _, _, _ = levels[0]
+    nodes = np.repeat(np.arange(n), len(keys))
+    cells = np.tile(np.arange(len(keys)), n)
+    for level, (side, keys, mass, com, node_key) in enumerate(levels, start=1):
+        m = mass[cells]
+        c = com[cells]
+        own = node_key[nodes] == keys[cells]
+        if level == depth:
+            # Leaf cells: everything left is approximated, minus the node itself
+            rest = m - own
+            c = np.where(own[:, None], (c * m[:, None] - pos[nodes]) / np.maximum(rest, 1)[:, None], c)
+            accept = rest > 0
+            m = rest
+        else:
+            dist = np.hypot(*(pos[nodes] - c).T)
+            accept = ~own & (span / side < theta * dist)
+
+        d = pos[nodes[accept]] - c[accept]
+        dist2 = np.maximum((d ** 2).sum(axis=1), min_dist ** 2)
+        scale = k2 * m[accept] / dist2
+        fx += np.bincount(nodes[accept], weights=d[:, 0] * scale, minlength=n)
+        fy += np.bincount(nodes[accept], weights=d[:, 1] * scale, minlength=n)
+        if level == depth:
+            break
+
+        # Open the remaining cells: their non-empty children on the next level
+        nodes, cells = nodes[~accept], cells[~accept]
+        cx, cy = keys[cells] // side, keys[cells] % side
+        child_side, child_keys = levels[level][0], levels[level][1]
+        nodes = np.repeat(nodes, 4)
+        child = ((2 * np.repeat(cx, 4) + np.tile([0, 0, 1, 1], len(cx))) * child_side
+                 + 2 * np.repeat(cy, 4) + np.tile([0, 1, 0, 1], len(cy)))
+        idx = np.minimum(np.searchsorted(child_keys, child), len(child_keys) - 1)
+        present = child_keys[idx] == child
+        nodes, cells = nodes[present], idx[present]
+    return np.stack([fx, fy], axis=1)
+
+
+def force_layout(n, src, dst, weights, init=None, iterations=None, theta=None, seed=0, cooling_start=1.0):
+    """Positions (n, 2) in the unit square for the graph on n nodes.
+
+    `init` gives starting positions (any scale, same for all nodes), and
+    `cooling_start` the fraction of the full starting temperature to use;
+    a warm start from a previous layout uses a small one so it only refines.
+    """
+    iterations = _env_int('GRAPH_LAYOUT_ITERATIONS', 100) if iterations is None else iterations
+    theta = _env_float('GRAPH_LAYOUT_THETA', 0.8) if theta is None else theta
+    if n == 0:
+        return np.zeros((0, 2))
+    if n == 1:
+        return np.full((1, 2), 0.5)
+
+    k = 1.0
+    width = np.sqrt(n) * k
+    rng = np.random.default_rng(seed)
+    if init is None:
+        pos = rng.uniform(0, width, size=(n, 2))
+    else:
+        pos = _rescale(init) * width
+    w = np.asarray(weights, dtype=np.float64)
+    w = 1 + np.log(w) if len(w) else w
+    center = np.array([width / 2, width / 2])
+    t0 = width / 10 * cooling_start
+
+    for step in range(iterations):
+        disp = _repulsion(pos, k * k, theta, min_dist=0.01 * k)
+        delta = pos[src] - pos[dst]
+        dist = np.maximum(np.hypot(delta[:, 0], delta[:, 1]), 0.01 * k)
+        pull = delta * (dist * w / k)[:, None]
+        for axis in (0, 1):
+            disp[:, axis] -= np.bincount(src, weights=pull[:, axis], minlength=n)
+            disp[:, axis] += np.bincount(dst, weights=pull[:, axis], minlength=n)
+        # Weak gravity keeps disconnected components from drifting apart
+        disp += (center - pos) * (0.05 * k)
+
+        temperature = t0 * (1 - step / iterations) + 1e-3
+        length = np.maximum(np.hypot(disp[:, 0], disp[:, 1]), 1e-12)
+        pos += disp * (np.minimum(length, temperature) / length)[:, None]
+    return _rescale(pos)
+
+
+def _rescale(pos):
+    """Fit positions into [0, 1]^2, preserving aspect ratio, centred."""
+    lo = pos.min(axis=0)
+    extent = pos.max(axis=0) - lo
+    span = max(float(extent.max()), 1e-9)
+    return (pos - lo) / span + (1 - extent / span) / 2
+
+
+def warm_start(node_ids, src, dst, previous, seed=0):
+    """Initial positions from {node_id: (x, y)}; None if nothing overlaps.
+
+    New nodes go to the mean position of their placed neighbours, or to a
+    random point in the previous layout if they have none.
+    """
+    n = len(node_ids)
+    pos = np.full((n, 2), np.nan)
+    for i, node_id in enumerate(node_ids):
+        xy = previous.get(node_id)
+        if xy is not None:
+            pos[i] = xy
+    known = ~np.isnan(pos[:, 0])
+    if not known.any():
+        return None, 0
+
+    rows = np.concatenate([src, dst])
+    cols = np.concatenate([dst, src])
+    usable = known[cols] & ~known[rows]
+    counts = np.bincount(rows[usable], minlength=n)
+    sums = np.stack([np.bincount(rows[usable], weights=pos[cols[usable], axis], minlength=n)
+                     for axis in (0, 1)], axis=1)
+    rng = np.random.default_rng(seed)
+    fill = ~known & (counts > 0)
+    pos[fill] = sums[fill] / counts[fill][:, None] + rng.normal(0, 0.01, size=(fill.sum(), 2))
+    rest = np.isnan(pos[:, 0])
+    lo, hi = pos[known].min(axis=0), pos[known].max(axis=0)
+    pos[rest] = rng.uniform(lo, np.maximum(hi, lo + 1e-3), size=(rest.sum(), 2))
+    return pos, int(known.sum())
+
+
+# -- storage ---------------------------------------------------------------------
+
+layout_cache = TTLCache(maxsize=_env_int('GRAPH_LAYOUT_CACHE_SIZE', 32), ttl=3600)
+
+
+def _decode(doc):
+    coords = np.frombuffer(doc['coords'], dtype=np.float32).reshape(-1, 2).astype(np.float64)
+    return dict(zip(doc['node_ids'], map(tuple, coords)))
+
+
+def previous_layout(db, username, exclude_key):
+    """The user's most recent stored layout other than `exclude_key`, as {node_id: (x, y)}."""
+    doc = db.graph_layouts.find_one({'username': username, '_id': {'$ne': exclude_key}},
+                                    {'node_ids': 1, 'coords': 1}, sort=[('created_at', -1), ('_id', -1)])
+    return (doc['_id'], _decode(doc)) if doc else (None, None)
+
+
+def _layout_input(graph):
+    keep = graph.ranked_nodes(max(1, _env_int('GRAPH_LAYOUT_MAX_NODES', 2000)))
+    node_ids = [graph.node_id(i) for i in keep.tolist()]
+    src, dst, weights = graph.induced_edges(keep)
+    local = np.full(graph.n_nodes, -1, dtype=np.int64)
+    local[keep] = np.arange(len(keep))
+    return node_ids, local[src], local[dst], weights
+
+
+def stored_layout(db, key):
+    """(positions, meta) for `key` from memory or `graph_layouts`, or None."""
+    cached = layout_cache.get(key)
+    if cached is not None:
+        return cached[0], dict(cached[1], cached=True)
+
+    doc = db.graph_layouts.find_one({'_id': key}, {'node_ids': 1, 'coords': 1, 'meta': 1})
+    if doc:
+        result = (_decode(doc), dict(doc.get('meta') or {}, key=key))
+        layout_cache.set(key, result)
+        return result[0], dict(result[1], cached=True)
+    return None
+
+
+def compute_layout(db, key, node_ids, src, dst, weights, classification):
+    """Lay out the graph (warm-started where possible), store it and return (positions, meta)."""
+    started = time.perf_counter()
+    username = classification.get('username')
+    previous_key, previous = previous_layout(db, username, key) if username else (None, None)
+    init, reused = warm_start(node_ids, src, dst, previous) if previous else (None, 0)
+    if init is not None:
+        iterations = _env_int('GRAPH_LAYOUT_WARM_ITERATIONS', 30)
+        pos = force_layout(len(node_ids), src, dst, weights, init=init, iterations=iterations,
+                           cooling_start=0.2)
+    else:
+        iterations = _env_int('GRAPH_LAYOUT_ITERATIONS', 100)
+        pos = force_layout(len(node_ids), src, dst, weights, iterations=iterations)
+
+    meta = {
+        'key': key,
+        'version': LAYOUT_VERSION,
+        'nodes': len(node_ids),
+        'iterations': iterations,
+        'warm_start_from': previous_key if init is not None else None,
+        'reused_positions': reused,
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+    positions = dict(zip(node_ids, map(tuple, pos)))
+    try:
+        db.graph_layouts.replace_one({'_id': key}, {
+            'classification_id': classification['_id'],
+            'username': username,
+            'created_at': datetime.utcnow(),
+            'node_ids': node_ids,
+            'coords': Binary(pos.astype(np.float32).tobytes()),
+            'meta': meta,
+        }, upsert=True)
+    except Exception as e:
+        # The layout is still good for this response; it will be recomputed next time
+        print(f"Could not store graph layout: {str(e)}")
+    layout_cache.set(key, (positions, meta))
+    return positions, dict(meta, cached=False)
+
+
+class LayoutWorker:
+    """Background thread computing layouts too large for the request thread.
+
+    Each key is queued at most once while pending. The thread is started
+    lazily and restarted after a fork, like the ingest queue's writer.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pending = set()
+        self._thread = None
+        self._pid = None
+
+    def submit(self, key, job):
+        """Queue `job()` for `key`; False if the queue is full (it will be offered again)."""
+        with self._lock:
+            if self._pid != os.getpid() or self._thread is None or not self._thread.is_alive():
+                self._queue = queue.Queue()
+                self._pending = set()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='graph-layout', daemon=True)
+                self._thread.start()
+            if key in self._pending:
+                return True
+            if len(self._pending) >= max(1, _env_int('GRAPH_LAYOUT_MAX_PENDING', 16)):
+                return False
+            self._pending.add(key)
+            self._queue.put((key, job))
+            return True
+
+    def _run(self):
+        jobs = self._queue
+        while True:
+            key, job = jobs.get()
+            try:
+                job()
+            except Exception as e:
+                print(f"Graph layout failed: {str(e)}")
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+
+
+layout_worker = LayoutWorker()
+
+
+def get_layout(db, graph, classification):
+    """{node_id: (x, y)} for the top GRAPH_LAYOUT_MAX_NODES nodes of `graph`, plus metadata.
+
+    Looked up by content hash in memory, then in `graph_layouts`. Otherwise
+    computed here if the graph has at most GRAPH_LAYOUT_SYNC_MAX_NODES nodes,
+    or queued for the background thread, returning (None, meta with
+    `pending: True`) so the caller can send the graph without positions.
+    """
+    node_ids, src, dst, weights = _layout_input(graph)
+    key = content_hash(node_ids, src, dst, weights)
+    found = stored_layout(db, key)
+    if found is not None:
+        return found
+
+    if len(node_ids) <= _env_int('GRAPH_LAYOUT_SYNC_MAX_NODES', 300):
+        return compute_layout(db, key, node_ids, src, dst, weights, classification)
+
+    owner = {'_id': classification['_id'], 'username': classification.get('username')}
+    # Another worker process may have finished the same layout while this one was queued
+    queued = layout_worker.submit(key, lambda: stored_layout(db, key) or compute_layout(
+        db, key, node_ids, src, dst, weights, owner))
+    return None, {'key': key, 'nodes': len(node_ids), 'pending': True, 'queued': queued}
+
+
+def layout_run(db, classification_id):
+    """Build a saved run's graph and store its layout; returns (positions, meta) or None."""
+    classification = db.classifications.find_one(
+        {'_id': classification_id}, {'predictions': 1, 'status': 1, 'username': 1, 'storage': 1, 'archive': 1})
+    if classification is None or classification.get('status', 'complete') != 'complete':
+        return None
+    node_ids, src, dst, weights = _layout_input(ReviewGraph.from_predictions(db, classification))
+    key = content_hash(node_ids, src, dst, weights)
+    return stored_layout(db, key) or compute_layout(db, key, node_ids, src, dst, weights, classification)
+
+
+def schedule_layouts(db, classification_ids):
+    """Queue the layouts of just-saved runs, so `/api/graph` only has to read them."""
+    if os.environ.get('GRAPH_LAYOUT_ON_SAVE', 'true').lower() in ('0', 'false', 'no'):
+        return
+    for classification_id in classification_ids:
+        if not layout_worker.submit(f'run:{classification_id}', lambda oid=classification_id: layout_run(db, oid)):
+            # The first /api/graph request for it queues it again
+            print(f"Graph layout queue full; {classification_id} will be laid out on first view")
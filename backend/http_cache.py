@@ -0,0 +1,262 @@
+"""ETags, conditional GET, a small response cache and response compression.
+
+List endpoints (`GET /api/classifications`, `/api/feedback`,
+`/api/access-requests`) tag every page with a weak ETag. The tag is derived
+from the request (route, filter, page arguments) and from cheap collection
+state, without running the page query:
+
+  count     matching documents (index count; collection metadata when unfiltered)
+  newest    (created_at, _id) of the newest matching document
+  updated   newest `updated_at` in the collection, for collections whose
+            documents change in place (UPDATED_COLLECTIONS)
+  local     a per-process generation, bumped by this worker's write routes
+
+A request whose `If-None-Match` matches gets a 304 before any page is read
+or serialized. Otherwise the page is served from `response_cache` when the
+same tag and encoding were built recently, or built, compressed and stored.
+Collection state is reused for HTTP_CACHE_STATE_TTL seconds; writes made
+through this worker invalidate it and the response cache at once, and
+writes from other workers or the admin CLI are seen within that TTL.
+
+JSON responses of at least HTTP_COMPRESS_MIN_BYTES are compressed with
+brotli (when the `brotli` package is installed) or gzip, whichever the
+client prefers in Accept-Encoding. Streamed NDJSON responses are left alone.
+
+Configuration (environment variables):
+  HTTP_CACHE_ENABLED             ETags and the response cache (default true)
+  HTTP_CACHE_STATE_TTL           seconds collection state is reused (default 1)
+  HTTP_RESPONSE_CACHE_SIZE       cached responses per worker (default 256)
+  HTTP_RESPONSE_CACHE_MAX_BYTES  largest cached body, after compression (default 1048576)
+  HTTP_COMPRESS_MIN_BYTES        smallest body worth compressing (default 1024)
+  HTTP_GZIP_LEVEL                1-9 (default 6)
+  HTTP_BROTLI_QUALITY            0-11 (default 5)
+"""
+import gzip
+import hashlib
+import os
+import threading
+
+from flask import current_app, jsonify, request
+from pymongo import DESCENDING
+
+from pagination import CURSOR_HEADER
+from ttl_cache import TTLCache
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+UPDATED_COLLECTIONS = ('classifications', 'access_requests')
+COMPRESSIBLE_TYPES = ('application/json', 'text/')
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def cache_enabled():
+    return os.environ.get('HTTP_CACHE_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+
+
+response_cache = TTLCache(maxsize=_env_int('HTTP_RESPONSE_CACHE_SIZE', 256), ttl=3600)
+state_cache = TTLCache(maxsize=1024, ttl=_env_float('HTTP_CACHE_STATE_TTL', 1))
+_generations = {}
+_generation_lock = threading.Lock()
+
+
+def invalidate(*collections):
+    """Called by write routes: new ETags, and no cached responses, for these collections."""
+    with _generation_lock:
+        for name in collections:
+            _generations[name] = _generations.get(name, 0) + 1
+    names = set(collections)
+    state_cache.discard_where(lambda key, value: key[0] in names)
+    response_cache.discard_where(lambda key, value: key[0] in names)
+
+
+# -- collection state and tags -------------------------------------------------
+
+def _state_key(collection, query):
+    return collection.name, repr(sorted(query.items()))
+
+
+def _newest(doc):
+    if doc is None:
+        return None
+    return doc.get('created_at').isoformat() if doc.get('created_at') else None, str(doc['_id'])
+
+
+def collection_state(collection, query):
+    """(count, newest, updated) for `query` on a pymongo collection, cached briefly."""
+    key = _state_key(collection, query)
+    state = state_cache.get(key)
+    if state is not None:
+        return state
+    count = collection.count_documents(query) if query else collection.estimated_document_count()
+    newest = collection.find_one(query, {'created_at': 1},
+                                 sort=[('created_at', DESCENDING), ('_id', DESCENDING)])
+    updated = None
+    if collection.name in UPDATED_COLLECTIONS:
+        doc = collection.find_one({'updated_at': {'$exists': True}}, {'updated_at': 1},
+                                  sort=[('updated_at', DESCENDING)])
+        updated = doc['updated_at'].isoformat() if doc else None
+    state = (count, _newest(newest), updated)
+    state_cache.set(key, state)
+    return state
+
+
+async def collection_state_async(collection, query):
+    """collection_state on a motor collection (asgi_app.py)."""
+    key = _state_key(collection, query)
+    state = state_cache.get(key)
+    if state is not None:
+        return state
+    count = await collection.count_documents(query) if query else await collection.estimated_document_count()
+    newest = await collection.find_one(query, {'created_at': 1},
+                                       sort=[('created_at', DESCENDING), ('_id', DESCENDING)])
+    updated = None
+    if collection.name in UPDATED_COLLECTIONS:
+        doc = await collection.find_one({'updated_at': {'$exists': True}}, {'updated_at': 1},
+                                        sort=[('updated_at', DESCENDING)])
+        updated = doc['updated_at'].isoformat() if doc else None
+    state = (count, _newest(newest), updated)
+    state_cache.set(key, state)
+    return state
+
+
+def make_etag(collection_name, query, args, state):
+    """Weak ETag for one page; `args` are the request's query parameters."""
+    with _generation_lock:
+        generation = _generations.get(collection_name, 0)
+    raw = repr((collection_name, sorted(query.items()), sorted(args), state, generation))
+    return 'W/"' + hashlib.sha1(raw.encode('utf-8')).hexdigest()[:32] + '"'
+
+
+def not_modified(if_none_match, etag):
+    """True when an If-None-Match header value matches `etag` (weak comparison)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    bare = etag[2:] if etag.startswith('W/') else etag
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if (candidate[2:] if candidate.startswith('W/') else candidate) == bare:
+            return True
+    return False
+
+
+# -- compression ---------------------------------------------------------------
+
+def negotiate(accept_encoding):
+    """'br', 'gzip' or None for an Accept-Encoding header, honouring q-values."""
+    offered = {}
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        name = name.strip().lower()
+        q = 1.0
+        if params.strip().startswith('q='):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            offered[name] = q
+    choices = (['br'] if brotli is not None else []) + ['gzip']
+    best = max(choices, key=lambda c: (offered.get(c, offered.get('*', 0.0)), c == 'br'))
+    return best if offered.get(best, offered.get('*', 0.0)) > 0 else None
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=_env_int('HTTP_BROTLI_QUALITY', 5))
+    return gzip.compress(body, compresslevel=_env_int('HTTP_GZIP_LEVEL', 6))
+
+
+def worth_compressing(body, content_type):
+    return (len(body) >= _env_int('HTTP_COMPRESS_MIN_BYTES', 1024)
+            and any((content_type or '').startswith(t) for t in COMPRESSIBLE_TYPES))
+
+
+def add_vary(headers):
+    vary = headers.get('Vary')
+    if not vary:
+        headers['Vary'] = 'Accept-Encoding'
+    elif 'accept-encoding' not in vary.lower():
+        headers['Vary'] = vary + ', Accept-Encoding'
+
+
+# -- Flask integration ---------------------------------------------------------
+
+def cached_page(collection, query, build_page):
+    """Conditional, cached and compressed list page for the current Flask request.
+
+    `build_page()` returns (docs, next_cursor) and only runs on a cache miss.
+    """
+    if not cache_enabled():
+        docs, next_cursor = build_page()
+        return page_response(jsonify(docs), next_cursor)
+
+    etag = make_etag(collection.name, query, request.args.items(multi=True),
+                     collection_state(collection, query))
+    if not_modified(request.headers.get('If-None-Match'), etag):
+        response = current_app.response_class(status=304)
+        response.headers['ETag'] = etag
+        response.headers['Cache-Control'] = 'private, no-cache'
+        # Same Vary as the 200 it revalidates, so shared caches keep the encodings apart
+        add_vary(response.headers)
+        return response
+
+    encoding = negotiate(request.headers.get('Accept-Encoding'))
+    key = (collection.name, etag, encoding)
+    cached = response_cache.get(key)
+    if cached is None:
+        docs, next_cursor = build_page()
+        body = jsonify(docs).get_data()
+        used = encoding if encoding and worth_compressing(body, 'application/json') else None
+        cached = (compress(body, used) if used else body, used, next_cursor)
+        if len(cached[0]) <= _env_int('HTTP_RESPONSE_CACHE_MAX_BYTES', 1 << 20):
+            response_cache.set(key, cached)
+
+    body, used, next_cursor = cached
+    response = current_app.response_class(body, mimetype='application/json')
+    if used:
+        response.headers['Content-Encoding'] = used
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'private, no-cache'
+    add_vary(response.headers)
+    return page_response(response, next_cursor)
+
+
+def page_response(response, next_cursor):
+    if next_cursor:
+        response.headers[CURSOR_HEADER] = next_cursor
+    return response
+
+
+def compress_response(response):
+    """after_request hook: compress other JSON responses the client accepts compressed."""
+    if (response.direct_passthrough or response.is_streamed or response.status_code < 200
+            or response.status_code in (204, 304) or 'Content-Encoding' in response.headers):
+        return response
+    body = response.get_data()
+    if not worth_compressing(body, response.content_type):
+        return response
+    encoding = negotiate(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+    response.set_data(compress(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    add_vary(response.headers)
+    return response
@@ -0,0 +1,241 @@
+"""Declared indexes for every collection the API touches.
+
+The API applies these once per process on its first request (set
+MONGO_ENSURE_INDEXES=false to skip). Creating an index that already exists
+with the same definition is a no-op, so running this repeatedly is safe.
+
+Usage:
+  python indexes.py apply    # create any missing indexes
+  python indexes.py check    # explain() every route's query shape, exit 1 on COLLSCAN
+  python indexes.py list     # print the registry
+"""
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import PyMongoError
+
+from pagination import keyset_query
+
+NEWEST_FIRST = [('created_at', DESCENDING), ('_id', DESCENDING)]
+
+# collection -> list of IndexModel
+INDEXES = {
+    'approved_users': [
+        IndexModel([('username', ASCENDING)], name='username_unique', unique=True),
+        IndexModel([('email', ASCENDING)], name='email'),
+    ],
+    'access_requests': [
+        IndexModel([('username', ASCENDING)], name='username'),
+        IndexModel([('email', ASCENDING)], name='email'),
+        IndexModel([('status', ASCENDING)] + NEWEST_FIRST, name='status_newest'),
+        IndexModel(NEWEST_FIRST, name='newest'),
+        IndexModel([('updated_at', DESCENDING)], name='updated'),
+    ],
+    'classifications': [
+        IndexModel([('username', ASCENDING)] + NEWEST_FIRST, name='username_newest'),
+        IndexModel(NEWEST_FIRST, name='newest'),
+        IndexModel([('updated_at', DESCENDING)], name='updated'),
+    ],
+    'predictions': [
+        IndexModel([('classification_id', ASCENDING), ('seq', ASCENDING)], name='run_seq', unique=True),
+    ],
+    'prediction_blobs': [
+        IndexModel([('classification_id', ASCENDING), ('part', ASCENDING)], name='run_part', unique=True),
+    ],
+    'classification_rollups': [
+        IndexModel([('scope', ASCENDING), ('granularity', ASCENDING), ('key', ASCENDING),
+                    ('bucket', ASCENDING)], name='scope_key_bucket'),
+    ],
+    'prediction_cache': [
+        IndexModel([('expires_at', ASCENDING)], name='expires_at_ttl', expireAfterSeconds=0),
+    ],
+    'graph_layouts': [
+        IndexModel([('username', ASCENDING)] + NEWEST_FIRST, name='username_newest'),
+    ],
+    'model_feedback': [
+        IndexModel([('transactionId', ASCENDING)], name='transactionId'),
+        IndexModel([('username', ASCENDING)] + NEWEST_FIRST, name='username_newest'),
+        IndexModel(NEWEST_FIRST, name='newest'),
+    ],
+}
+
+_SAMPLE_ID = ObjectId('000000000000000000000000')
+_SAMPLE_TIME = datetime(2025, 1, 1)
+_SAMPLE_CURSOR = (_SAMPLE_TIME, _SAMPLE_ID)
+
+
+def _page(collection, query, cursor=None, projection=None):
+    return {'collection': collection, 'filter': keyset_query(query, cursor),
+            'sort': NEWEST_FIRST, 'projection': projection, 'limit': 51}
+
+
+# route -> query shapes it issues, with placeholder values
+QUERY_SHAPES = {
+    'login: approved user': {'collection': 'approved_users', 'filter': {'username': 'u'}},
+    'login: pending request': {'collection': 'access_requests', 'filter': {'username': 'u'}},
+    'access request: duplicate user': {
+        'collection': 'approved_users', 'filter': {'$or': [{'username': 'u'}, {'email': 'e'}]}},
+    'access request: duplicate request': {
+        'collection': 'access_requests', 'filter': {'$or': [{'username': 'u'}, {'email': 'e'}]}},
+    'admin cli: requests by username': {'collection': 'access_requests', 'filter': {'username': {'$in': ['u']}}},
+    'admin cli: requests by status and date': {
+        'collection': 'access_requests',
+        'filter': {'status': 'pending', 'created_at': {'$gte': _SAMPLE_TIME, '$lt': datetime(2025, 2, 1)}},
+        'sort': [('created_at', ASCENDING)]},
+    'admin cli: existing users': {
+        'collection': 'approved_users',
+        'filter': {'$or': [{'username': {'$in': ['u']}}, {'email': {'$in': ['e']}}]}},
+    'access requests: list': _page('access_requests', {}),
+    'access requests: list by status': _page('access_requests', {'status': 'pending'}),
+    'access requests: next page by status': _page('access_requests', {'status': 'pending'}, _SAMPLE_CURSOR),
+    'classifications: history': _page('classifications', {}),
+    'classifications: history next page': _page('classifications', {}, _SAMPLE_CURSOR),
+    'classifications: user history': _page('classifications', {'username': 'u'}),
+    'classifications: user history next page': _page('classifications', {'username': 'u'}, _SAMPLE_CURSOR),
+    'classifications: predictions page': {
+        'collection': 'predictions', 'filter': {'classification_id': _SAMPLE_ID, 'seq': {'$gt': -1}},
+        'sort': [('seq', ASCENDING)], 'limit': 101},
+    'classifications: compacted predictions page': {
+        'collection': 'prediction_blobs', 'filter': {'classification_id': _SAMPLE_ID, 'last_seq': {'$gt': -1}},
+        'sort': [('part', ASCENDING)]},
+    'retention: runs to compact': {
+        'collection': 'classifications',
+        'filter': {'created_at': {'$lt': _SAMPLE_TIME}, 'status': {'$ne': 'saving'},
+                   'compacted_at': {'$exists': False}, 'storage': {'$ne': 'archived'}},
+        'sort': [('created_at', ASCENDING)], 'projection': {'_id': 1}},
+    'stats: series': {
+        'collection': 'classification_rollups',
+        'filter': {'scope': 'user', 'granularity': 'day', 'key': 'u',
+                   'bucket': {'$gte': _SAMPLE_TIME, '$lt': datetime(2025, 2, 1)}},
+        'sort': [('bucket', ASCENDING)]},
+    'stats: top products': {
+        'collection': 'classification_rollups',
+        'filter': {'scope': 'product', 'granularity': 'day',
+                   'bucket': {'$gte': _SAMPLE_TIME, '$lt': datetime(2025, 2, 1)}},
+        'sort': [('bucket', ASCENDING)]},
+    'graph: previous layout': {
+        'collection': 'graph_layouts', 'filter': {'username': 'u', '_id': {'$ne': 'k'}},
+        'sort': NEWEST_FIRST, 'limit': 1},
+    'http cache: classifications last update': {
+        'collection': 'classifications', 'filter': {'updated_at': {'$exists': True}},
+        'sort': [('updated_at', DESCENDING)], 'limit': 1},
+    'http cache: access requests last update': {
+        'collection': 'access_requests', 'filter': {'updated_at': {'$exists': True}},
+        'sort': [('updated_at', DESCENDING)], 'limit': 1},
+    'feedback: list': _page('model_feedback', {}),
+    'feedback: by transaction': _page('model_feedback', {'transactionId': 't'}),
+    'feedback: by user': _page('model_feedback', {'username': 'u'}),
+    'feedback: by user next page': _page('model_feedback', {'username': 'u'}, _SAMPLE_CURSOR),
+}
+
+
+def apply_indexes(db, verbose=False):
+    """Create every declared index; returns {collection: [names]} plus any errors."""
+    created, errors = {}, {}
+    for name, models in INDEXES.items():
+        try:
+            created[name] = db[name].create_indexes(models)
+            if verbose:
+                print(f"{name}: {', '.join(created[name])}")
+        except PyMongoError as e:
+            # e.g. duplicate usernames already stored; keep going with the rest
+            errors[name] = str(e)
+            print(f"Could not create indexes on {name}: {e}")
+    return created, errors
+
+
+def _stages(plan):
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            yield from _stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _stages(item)
+
+
+def explain_shape(db, shape):
+    cursor = db[shape['collection']].find(shape['filter'], shape.get('projection'))
+    if shape.get('sort'):
+        cursor = cursor.sort(shape['sort'])
+    if shape.get('limit'):
+        cursor = cursor.limit(shape['limit'])
+    plan = cursor.explain().get('queryPlanner', {}).get('winningPlan', {})
+    return sorted(set(_stages(plan)))
+
+
+def check_query_plans(db, verbose=True):
+    """Explain every registered query shape; returns the names that COLLSCAN."""
+    failures = []
+    for name, shape in QUERY_SHAPES.items():
+        stages = explain_shape(db, shape)
+        bad = 'COLLSCAN' in stages
+        if bad:
+            failures.append(name)
+        if verbose:
+            print(f"{'FAIL' if bad else 'ok  '} {name}: {', '.join(stages)}")
+    return failures
+
+
+_applied = False
+_last_attempt = None
+_lock = threading.Lock()
+
+
+def ensure_indexes_once(get_db, retry_seconds=60):
+    """Apply the registry once per process; retried at most every `retry_seconds`.
+
+    Takes the `get_db` callable so the common already-applied case costs a
+    single flag check.
+    """
+    global _applied, _last_attempt
+    if _applied:
+        return
+    if os.environ.get('MONGO_ENSURE_INDEXES', 'true').lower() in ('0', 'false', 'no'):
+        _applied = True
+        return
+    with _lock:
+        if _applied or (_last_attempt is not None and time.monotonic() - _last_attempt < retry_seconds):
+            return
+        _last_attempt = time.monotonic()
+        db = get_db()
+        if db is None:
+            return
+        _, errors = apply_indexes(db)
+        _applied = not errors
+
+
+if __name__ == '__main__':
+    from db import manager
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'apply'
+    if command == 'list':
+        for coll, models in INDEXES.items():
+            for model in models:
+                print(coll, model.document['name'], dict(model.document['key']))
+        sys.exit(0)
+
+    db = manager.get_db()
+    if db is None:
+        print('Could not connect to MongoDB. Check MONGO_URL or run test_mongo.py.')
+        sys.exit(1)
+
+    if command == 'apply':
+        _, errors = apply_indexes(db, verbose=True)
+        sys.exit(1 if errors else 0)
+    elif command == 'check':
+        apply_indexes(db)
+        failures = check_query_plans(db)
+        if failures:
+            print(f"\n{len(failures)} query shape(s) scan a whole collection")
+            sys.exit(1)
+        print('\nAll query shapes use an index')
+    else:
+        print('Usage: python indexes.py <apply|check|list>')
+        sys.exit(1)
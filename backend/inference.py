@@ -0,0 +1,282 @@
+"""In-process CPU inference for exported GE-GNN weights.
+
+With MODEL_BACKEND=embedded, `/api/classify` runs the model here instead of
+calling the Colab/ngrok endpoint. The upload is preprocessed once
+(preprocess.py: features plus the user / product_rating / product_month
+relations, cached on disk by content hash). The model then runs layer by
+layer in mini-batches of target reviews. Each batch samples at most
+INFERENCE_FANOUT neighbours per relation, and the batches run on
+INFERENCE_WORKERS threads, since NumPy releases the GIL inside the matrix
+products. If the weights cannot be loaded or inference fails, the
+route falls back to the remote model when one is configured.
+
+Weights are a plain `.npz` archive (np.savez) with:
+
+  feature_names        str array; input columns, matched to preprocess.py's by name
+  relations            str array; relation names, in the order of the weights below
+  layer{i}_self        (d_in, d_out) weight on the review's own representation
+  layer{i}_{relation}  (d_in, d_out) weight on the mean of its neighbours in `relation`
+  layer{i}_bias        (d_out,)
+  classifier_weight    (d, 2) and classifier_bias (2,); column 1 is fraud
+  threshold            optional scalar (default 0.5)
+
+Each layer computes relu(h W_self + sum_r mean_{j in N_r(i)} h_j W_r + b).
+Export trained parameters into this layout with np.savez. For development,
+`python inference.py random-weights model_weights.npz` writes untrained weights.
+
+Configuration (environment variables):
+  MODEL_BACKEND          remote | embedded (default remote)
+  MODEL_WEIGHTS_PATH     weights file (default backend/model_weights.npz)
+  INFERENCE_BATCH_SIZE   target reviews per mini-batch (default 4096)
+  INFERENCE_FANOUT       neighbours sampled per relation and layer, 0 = all (default 25)
+  INFERENCE_WORKERS      threads running mini-batches (default 4)
+  INFERENCE_SEED         sampling seed, so repeated runs agree (default 0)
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from preprocess import CONTINUOUS_FEATURES, RELATIONS, preprocess_file
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def embedded_enabled():
+    return os.environ.get('MODEL_BACKEND', 'remote').lower() == 'embedded'
+
+
+def weights_path():
+    return os.environ.get('MODEL_WEIGHTS_PATH') or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'model_weights.npz')
+
+
+class InferenceError(Exception):
+    """The embedded model is missing, malformed or failed on this input."""
+
+
+def sample_neighbors(indptr, indices, nodes, fanout, rng):
+    """Up to `fanout` neighbours per node (all of them when it has fewer, or fanout=0).
+
+    Returns (count per node, neighbour ids grouped by node).
+    """
+    start = indptr[nodes]
+    degree = indptr[nodes + 1] - start
+    take = degree if not fanout else np.minimum(degree, fanout)
+    total = int(take.sum())
+    local = np.arange(total) - np.repeat(np.cumsum(take) - take, take)
+    if fanout:
+        # Nodes with more neighbours than the fanout get a uniform sample (with replacement)
+        row_degree = np.repeat(degree, take)
+        sampled = row_degree > fanout
+        local[sampled] = rng.integers(0, row_degree[sampled])
+    return take, np.asarray(indices[np.repeat(start, take) + local], dtype=np.int64)
+
+
+def _mean_by_group(columns, counts):
+    """Means of consecutive groups of `columns` (d, E), sizes `counts`, as (len(counts), d).
+
+    Empty groups give 0. Works on feature-major data because np.add.reduceat
+    is fast along the contiguous axis and very slow across rows.
+    """
+    out = np.zeros((len(counts), columns.shape[0]), dtype=columns.dtype)
+    nonempty = counts > 0
+    if nonempty.any():
+        starts = (np.cumsum(counts) - counts)[nonempty]
+        out[nonempty] = np.add.reduceat(columns, starts, axis=1).T / counts[nonempty, None]
+    return out
+
+
+class InferenceEngine:
+    def __init__(self, path, batch_size=None, fanout=None, workers=None, seed=None):
+        try:
+            with np.load(path, allow_pickle=False) as archive:
+                arrays = {name: archive[name] for name in archive.files}
+        except (OSError, ValueError) as e:
+            raise InferenceError(f'Could not load model weights from {path}: {e}') from e
+
+        try:
+            self.feature_names = [str(n) for n in arrays['feature_names']]
+            self.relations = [str(r) for r in arrays['relations']]
+            self.layers = []
+            i = 0
+            while f'layer{i}_self' in arrays:
+                self.layers.append({
+                    'self': arrays[f'layer{i}_self'].astype(np.float32),
+                    'bias': arrays[f'layer{i}_bias'].astype(np.float32),
+                    'relations': [arrays[f'layer{i}_{r}'].astype(np.float32) for r in self.relations],
+                })
+                i += 1
+            self.classifier_weight = arrays['classifier_weight'].astype(np.float32)
+            self.classifier_bias = arrays['classifier_bias'].astype(np.float32)
+        except KeyError as e:
+            raise InferenceError(f'Model weights are missing {e}') from e
+        if not self.layers:
+            raise InferenceError('Model weights have no layers')
+        if self.layers[0]['self'].shape[0] != len(self.feature_names):
+            raise InferenceError('layer0_self does not match feature_names')
+        unknown = set(self.relations) - set(RELATIONS)
+        if unknown:
+            raise InferenceError(f'Unknown relations in weights: {", ".join(sorted(unknown))}')
+
+        self.threshold = float(arrays['threshold']) if 'threshold' in arrays else 0.5
+        self.path = path
+        self.batch_size = max(1, batch_size or _env_int('INFERENCE_BATCH_SIZE', 4096))
+        self.fanout = max(0, fanout if fanout is not None else _env_int('INFERENCE_FANOUT', 25))
+        self.workers = max(1, workers or _env_int('INFERENCE_WORKERS', 4))
+        self.seed = seed if seed is not None else _env_int('INFERENCE_SEED', 0)
+
+    def _feature_columns(self, dataset):
+        """(dataset column, model column) pairs; model features the CSV lacks stay 0."""
+        position = {name: i for i, name in enumerate(dataset.feature_names)}
+        pairs = [(position[name], j) for j, name in enumerate(self.feature_names) if name in position]
+        if not pairs:
+            raise InferenceError('None of the model features could be computed from this CSV')
+        source, target = (np.array(side, dtype=np.int64) for side in zip(*pairs))
+        return source, target
+
+    def _layer_batch(self, layer, layer_index, h, features_major, dataset, targets, batch_index):
+        """One layer's output for the `targets` reviews, from sampled neighbours in `h`."""
+        rng = np.random.default_rng([self.seed, layer_index, batch_index])
+        out = h[targets] @ layer['self'] + layer['bias']
+        for relation, weight in zip(self.relations, layer['relations']):
+            counts, nbrs = sample_neighbors(*dataset.relations[relation], targets, self.fanout, rng)
+            if len(nbrs):
+                # mean(h) W == mean(h W); averaging first keeps the gathered messages narrow
+                out += _mean_by_group(features_major[:, nbrs], counts) @ weight
+        return np.maximum(out, 0)
+
+    def predict(self, dataset):
+        """Fraud probability for every review in a preprocessed dataset.
+
+        Runs layer by layer over all reviews rather than expanding a
+        multi-hop neighbourhood per batch. Each review's representation is
+        computed once per layer, and every batch only samples its
+        one-hop neighbours from the previous layer's output.
+        """
+        missing = set(self.relations) - set(dataset.relations)
+        if missing:
+            raise InferenceError(f'Dataset lacks relations: {", ".join(sorted(missing))}')
+        n = len(dataset)
+        if n == 0:
+            return np.zeros(0)
+
+        source, target = self._feature_columns(dataset)
+        batches = [np.arange(start, min(start + self.batch_size, n))
+                   for start in range(0, n, self.batch_size)]
+        h = np.zeros((n, len(self.feature_names)), dtype=np.float32)
+        for rows in batches:
+            h[rows[:, None], target] = dataset.features[rows[0]:rows[-1] + 1][:, source]
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='inference') as pool:
+            for layer_index, layer in enumerate(self.layers):
+                features_major = np.ascontiguousarray(h.T)
+                out = np.empty((n, layer['self'].shape[1]), dtype=np.float32)
+
+                def run(item, layer=layer, layer_index=layer_index, h=h, features_major=features_major):
+                    batch_index, rows = item
+                    out[rows] = self._layer_batch(layer, layer_index, h, features_major, dataset,
+                                                  rows, batch_index)
+
+                list(pool.map(run, enumerate(batches)))
+                h = out
+
+        logits = h @ self.classifier_weight + self.classifier_bias
+        logits -= logits.max(axis=1, keepdims=True)
+        p = np.exp(logits)
+        return p[:, 1] / p.sum(axis=1)
+
+    def classify_file(self, f):
+        """Predictions for a seekable binary CSV, shaped like the remote model's."""
+        dataset = preprocess_file(f)
+        probability = self.predict(dataset)
+        fraud = probability >= self.threshold
+        confidence = np.where(fraud, probability, 1 - probability)
+        identity = dataset.identity
+        return [{
+            '_id': review_id or None,
+            'reviewerID': reviewer or None,
+            'reviewerName': name or None,
+            'asin': asin or None,
+            'label': 'Fraud' if is_fraud else 'Benign',
+            'fraud_probability': round(p, 4),
+            'confidence': round(c, 4),
+        } for review_id, reviewer, name, asin, is_fraud, p, c in zip(
+            identity['_id'].tolist(), identity['reviewerID'].tolist(), identity['reviewerName'].tolist(),
+            identity['asin'].tolist(), fraud.tolist(), probability.tolist(), confidence.tolist())]
+
+    def info(self):
+        return {
+            'weights': self.path,
+            'features': len(self.feature_names),
+            'relations': self.relations,
+            'layers': [layer['self'].shape[1] for layer in self.layers],
+            'batch_size': self.batch_size,
+            'fanout': self.fanout,
+            'workers': self.workers,
+        }
+
+
+_engine = None
+_engine_error = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Process-wide engine, or None (with the reason printed once) if it cannot load."""
+    global _engine, _engine_error
+    if _engine is None and _engine_error is None:
+        with _engine_lock:
+            if _engine is None and _engine_error is None:
+                try:
+                    _engine = InferenceEngine(weights_path())
+                except InferenceError as e:
+                    _engine_error = str(e)
+                    print(f"Embedded inference unavailable: {_engine_error}")
+    return _engine
+
+
+def random_weights(feature_names=CONTINUOUS_FEATURES, relations=RELATIONS, hidden=(32, 16), seed=0):
+    """Untrained weights in the export layout (for development and benchmarks)."""
+    rng = np.random.default_rng(seed)
+    arrays = {'feature_names': np.array(feature_names), 'relations': np.array(relations)}
+    sizes = [len(feature_names)] + list(hidden)
+    for i, (d_in, d_out) in enumerate(zip(sizes, sizes[1:])):
+        scale = np.sqrt(2.0 / d_in)
+        arrays[f'layer{i}_self'] = rng.normal(0, scale, (d_in, d_out)).astype(np.float32)
+        arrays[f'layer{i}_bias'] = np.zeros(d_out, dtype=np.float32)
+        for r in relations:
+            arrays[f'layer{i}_{r}'] = rng.normal(0, scale, (d_in, d_out)).astype(np.float32)
+    arrays['classifier_weight'] = rng.normal(0, np.sqrt(1.0 / sizes[-1]), (sizes[-1], 2)).astype(np.float32)
+    arrays['classifier_bias'] = np.zeros(2, dtype=np.float32)
+    return arrays
+
+
+if __name__ == '__main__':
+    import json
+    import sys
+    import time
+
+    if len(sys.argv) == 3 and sys.argv[1] == 'random-weights':
+        np.savez(sys.argv[2], **random_weights())
+        print(f'Wrote untrained weights to {sys.argv[2]}')
+    elif len(sys.argv) == 3 and sys.argv[1] == 'classify':
+        engine = get_engine()
+        if engine is None:
+            sys.exit(1)
+        started = time.perf_counter()
+        with open(sys.argv[2], 'rb') as f:
+            predictions = engine.classify_file(f)
+        fraud = sum(1 for p in predictions if p['label'] == 'Fraud')
+        print(json.dumps(dict(engine.info(), reviews=len(predictions), fraud=fraud,
+                              seconds=round(time.perf_counter() - started, 3)), indent=2))
+    else:
+        print('Usage: python inference.py random-weights <out.npz>')
+        print('       python inference.py classify <reviews.csv>')
+        sys.exit(1)
@@ -0,0 +1,338 @@
+"""Write-behind queue for classification saves.
+
+With CLASSIFICATION_WRITE_MODE=async (or `?async=true` on the request),
+`POST /api/classifications` validates the body, queues the run under a
+pre-assigned id and answers 202 right away. A background thread per worker
+process takes up to INGEST_BATCH_MAX queued runs at a time. It writes them
+with shared bulk inserts (summaries, predictions and rollups) and retries
+failed writes with backoff.
+
+The queue is bounded by run count and by total prediction rows. When it is
+full, INGEST_OVERFLOW decides what happens:
+  block   wait up to INGEST_BLOCK_TIMEOUT seconds for room, then 503
+  reject  answer 503 immediately
+  spill   append the run to a local NDJSON journal (INGEST_JOURNAL_PATH),
+          which the writer replays once the queue has drained
+
+On shutdown the writer drains the queue. Anything it cannot write in
+INGEST_DRAIN_TIMEOUT seconds is spilled to the journal so it is not lost.
+
+Configuration (environment variables):
+  CLASSIFICATION_WRITE_MODE   sync | async (default sync)
+  INGEST_QUEUE_MAX            queued runs (default 200)
+  INGEST_QUEUE_MAX_ROWS       queued prediction rows (default 500000)
+  INGEST_OVERFLOW             block | reject | spill (default reject)
+  INGEST_BLOCK_TIMEOUT        seconds (default 2)
+  INGEST_BATCH_MAX            runs per bulk write (default 50)
+  INGEST_FLUSH_INTERVAL       seconds to wait for more runs before writing (default 0.05)
+  INGEST_MAX_RETRIES          write attempts before spilling a batch (default 3)
+  INGEST_DRAIN_TIMEOUT        seconds to drain on shutdown (default 10)
+  INGEST_JOURNAL_PATH         spill file (default backend/ingest_journal.ndjson)
+"""
+import atexit
+import os
+import threading
+import time
+from collections import deque
+
+from bson import json_util
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process dev server only
+    fcntl = None
+
+import db as _db
+from graph_layout import schedule_layouts
+from http_cache import invalidate as invalidate_http_cache
+from predictions import save_runs
+from rollups import update_rollups_many, rollup_failed
+
+OVERFLOW_MODES = ('block', 'reject', 'spill')
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def async_writes_enabled():
+    return os.environ.get('CLASSIFICATION_WRITE_MODE', 'sync').lower() == 'async'
+
+
+class QueueFull(Exception):
+    """No room in the queue and the overflow policy does not allow waiting longer."""
+
+
+class WriteBehindQueue:
+    def __init__(self, get_db=None):
+        self.get_db = get_db or _db.get_db
+        self.max_runs = max(1, _env_int('INGEST_QUEUE_MAX', 200))
+        self.max_rows = max(1, _env_int('INGEST_QUEUE_MAX_ROWS', 500000))
+        self.overflow = os.environ.get('INGEST_OVERFLOW', 'reject').lower()
+        if self.overflow not in OVERFLOW_MODES:
+            print(f"Unknown INGEST_OVERFLOW={self.overflow!r}, using reject")
+            self.overflow = 'reject'
+        self.block_timeout = _env_float('INGEST_BLOCK_TIMEOUT', 2)
+        self.batch_max = max(1, _env_int('INGEST_BATCH_MAX', 50))
+        self.flush_interval = _env_float('INGEST_FLUSH_INTERVAL', 0.05)
+        self.max_retries = max(1, _env_int('INGEST_MAX_RETRIES', 3))
+        self.drain_timeout = _env_float('INGEST_DRAIN_TIMEOUT', 10)
+        self.journal_path = os.environ.get('INGEST_JOURNAL_PATH') or os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), 'ingest_journal.ndjson')
+
+        self._items = deque()          # (enqueued_at, record)
+        self._rows = 0
+        self._cond = threading.Condition()
+        self._journal_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self._in_flight = []           # batch the writer is currently writing
+
+        self.enqueued = 0
+        self.written = 0
+        self.failed_attempts = 0
+        self.rejected = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.last_flush_at = None
+        self.last_error = None
+
+    # -- producer side -------------------------------------------------
+    def _has_room(self, rows):
+        # A single oversized run is still accepted into an empty queue
+        if not self._items:
+            return True
+        return len(self._items) < self.max_runs and self._rows + rows <= self.max_rows
+
+    def submit(self, record):
+        """Queue a run; returns 'queued' or 'spilled', raises QueueFull otherwise."""
+        self._ensure_writer()
+        rows = len(record['predictions'])
+        with self._cond:
+            if not self._has_room(rows) and self.overflow == 'block':
+                deadline = time.monotonic() + self.block_timeout
+                while not self._has_room(rows):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            if self._has_room(rows) and not self._stopping:
+                self._items.append((time.monotonic(), record))
+                self._rows += rows
+                self.enqueued += 1
+                self._cond.notify_all()
+                return 'queued'
+            if self.overflow != 'spill':
+                self.rejected += 1
+                raise QueueFull('Write queue is full, try again shortly')
+        self._spill([record])
+        return 'spilled'
+
+    # -- writer side ---------------------------------------------------
+    def _ensure_writer(self):
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._cond:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                # Records queued in the parent belong to the parent
+                self._items.clear()
+                self._rows = 0
+            self._stopping = False
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='ingest-writer', daemon=True)
+            self._thread.start()
+
+    def _take_batch(self):
+        with self._cond:
+            while not self._items and not self._stopping:
+                if not self._cond.wait(timeout=1.0) and self._journal_pending():
+                    return []  # idle: give the journal a chance
+            if not self._items:
+                return []
+            if len(self._items) < self.batch_max and not self._stopping:
+                # Give concurrent requests a moment to join this batch
+                self._cond.wait(self.flush_interval)
+            batch = []
+            while self._items and len(batch) < self.batch_max:
+                _, record = self._items.popleft()
+                self._rows -= len(record['predictions'])
+                batch.append(record)
+            self._in_flight = batch
+            self._cond.notify_all()
+            return batch
+
+    def _write(self, batch):
+        for attempt in range(self.max_retries):
+            try:
+                database = self.get_db()
+                if database is None:
+                    raise RuntimeError('Database connection failed')
+                save_runs(database, batch)
+                try:
+                    update_rollups_many(database, batch)
+                except Exception as e:
+                    rollup_failed(database, [record['_id'] for record in batch], e, 'queue')
+                schedule_layouts(database, [record['_id'] for record in batch])
+                invalidate_http_cache('classifications')
+                self.written += len(batch)
+                self.last_flush_at = time.time()
+                return True
+            except Exception as e:
+                self.failed_attempts += 1
+                self.last_error = str(e)
+                print(f"Write-behind batch of {len(batch)} failed (attempt {attempt + 1}): {str(e)}")
+                time.sleep(min(0.5 * 2 ** attempt, 5))
+        return False
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch:
+                if not self._write(batch):
+                    self._spill(batch)
+                with self._cond:
+                    self._in_flight = []
+                    self._cond.notify_all()
+            elif self._stopping:
+                return
+            elif self._journal_pending():
+                self._replay_journal()
+
+    # -- journal -------------------------------------------------------
+    def _journal_pending(self):
+        try:
+            return os.path.getsize(self.journal_path) > 0
+        except OSError:
+            return False
+
+    def _open_journal_locked(self):
+        """Open the journal for append under an exclusive lock shared with other workers.
+
+        If another process renamed the file for replay while we waited for
+        the lock, reopen so the records land in the new journal.
+        """
+        while True:
+            f = open(self.journal_path, 'a', encoding='utf-8')
+            if fcntl is None:
+                return f
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(self.journal_path).st_ino:
+                    return f
+            except OSError:
+                pass
+            f.close()
+
+    def _spill(self, records):
+        with self._journal_lock:
+            with self._open_journal_locked() as f:
+                for record in records:
+                    f.write(json_util.dumps(record) + '\n')
+                f.flush()
+        self.spilled += len(records)
+
+    def _replay_batch(self, batch):
+        """Write one batch from the journal; returns the records that still failed."""
+        database = self.get_db()
+        if database is not None:
+            # A run spilled at shutdown may have been written after all
+            ids = [r['_id'] for r in batch]
+            done = {d['_id'] for d in database.classifications.find(
+                {'_id': {'$in': ids}, 'status': 'complete'}, {'_id': 1})}
+            batch = [r for r in batch if r['_id'] not in done]
+        if not batch or self._write(batch):
+            self.replayed += len(batch)
+            return []
+        return batch
+
+    def _replay_journal(self):
+        """Write spilled runs back in batches; keeps the file if Mongo is still down."""
+        replaying = f'{self.journal_path}.{os.getpid()}.replaying'
+        with self._journal_lock:
+            if not self._journal_pending():
+                return
+            with self._open_journal_locked():
+                os.replace(self.journal_path, replaying)
+        failed = []
+        batch = []
+        with open(replaying, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    batch.append(json_util.loads(line))
+                if len(batch) >= self.batch_max:
+                    failed.extend(self._replay_batch(batch))
+                    batch = []
+        if batch:
+            failed.extend(self._replay_batch(batch))
+        os.remove(replaying)
+        if failed:
+            self.spilled -= len(failed)  # counted again by _spill
+            self._spill(failed)
+            time.sleep(5)
+
+    # -- lifecycle -----------------------------------------------------
+    def stop(self, timeout=None):
+        """Drain the queue; spill whatever is left after `timeout` seconds."""
+        timeout = self.drain_timeout if timeout is None else timeout
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+        with self._cond:
+            leftovers = [record for _, record in self._items]
+            if self._thread is not None and self._thread.is_alive():
+                # Still retrying when time ran out; replay skips it if it lands
+                leftovers = list(self._in_flight) + leftovers
+            self._items.clear()
+            self._rows = 0
+        if leftovers:
+            self._spill(leftovers)
+
+    def status(self):
+        with self._cond:
+            oldest = self._items[0][0] if self._items else None
+            depth = len(self._items)
+            rows = self._rows
+            in_flight = len(self._in_flight)
+        try:
+            journal_bytes = os.path.getsize(self.journal_path)
+        except OSError:
+            journal_bytes = 0
+        return {
+            'mode': 'async' if async_writes_enabled() else 'sync',
+            'overflow': self.overflow,
+            'depth': depth,
+            'rows': rows,
+            'in_flight': in_flight,
+            'max_runs': self.max_runs,
+            'max_rows': self.max_rows,
+            'lag_seconds': round(time.monotonic() - oldest, 3) if oldest is not None else 0.0,
+            'enqueued': self.enqueued,
+            'written': self.written,
+            'rejected': self.rejected,
+            'spilled': self.spilled,
+            'replayed': self.replayed,
+            'failed_attempts': self.failed_attempts,
+            'last_flush_at': self.last_flush_at,
+            'last_error': self.last_error,
+            'journal_bytes': journal_bytes,
+            'writer_alive': bool(self._thread and self._pid == os.getpid() and self._thread.is_alive()),
+        }
+
+
+ingest_queue = WriteBehindQueue()
+atexit.register(ingest_queue.stop)
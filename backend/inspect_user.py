@@ -1,48 +1,77 @@
-"""Quick inspector to check if a username exists in approved_users or access_requests.
+"""Quick inspector to check if usernames exist in approved_users or access_requests.
 
 Usage:
-  python inspect_user.py <username>
+  python inspect_user.py <username> [<username> ...]
+  python inspect_user.py --file cohort.txt        # one username per line, '-' for stdin
+  python inspect_user.py --file cohort.txt --summary
+
+Every username is looked up with one query per collection (per 1000 names).
+--summary prints one line per user instead of the full documents.
 
 Reads MONGO_URL and MONGO_DB_NAME from backend/.env (via dotenv).
 """
-import os
+import argparse
 import sys
-from dotenv import load_dotenv
-import pymongo
-
-load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '.env'))
-
-MONGO_URL = os.environ.get('MONGO_URL')
-DB_NAME = os.environ.get('MONGO_DB_NAME', 'fraud_detection')
-if not MONGO_URL:
-    print('MONGO_URL not set in backend/.env or environment')
-    sys.exit(1)
-
-client = pymongo.MongoClient(MONGO_URL)
-db = client[DB_NAME]
-
-if len(sys.argv) < 2:
-    print('Usage: python inspect_user.py <username>')
-    sys.exit(1)
-
-username = sys.argv[1]
-
-print(f"Checking username: {username}\n")
-approved = db.approved_users.find_one({'username': username})
-request = db.access_requests.find_one({'username': username})
-
-print('approved_users:')
-if approved:
-    approved.pop('_id', None)
-    print(approved)
-else:
-    print('  <not found>')
-
-print('\naccess_requests:')
-if request:
-    request.pop('_id', None)
-    # do not print password hash
-    request.pop('password', None)
-    print(request)
-else:
-    print('  <not found>')
+
+from cli_utils import read_usernames
+from db import manager
+
+CHUNK = 1000
+
+
+def lookup(db, collection, usernames, projection=None):
+    found = {}
+    for i in range(0, len(usernames), CHUNK):
+        for doc in db[collection].find({'username': {'$in': usernames[i:i + CHUNK]}}, projection):
+            found[doc['username']] = doc
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Show approved_users and access_requests entries.')
+    parser.add_argument('usernames', nargs='*')
+    parser.add_argument('--file', help="file of usernames, one per line ('-' for stdin)")
+    parser.add_argument('--summary', action='store_true', help='one line per user')
+    args = parser.parse_intermixed_args(argv)
+
+    usernames = list(args.usernames)
+    if args.file:
+        usernames += [u for u in read_usernames(args.file) if u not in usernames]
+    if not usernames:
+        print('Usage: python inspect_user.py <username> [<username> ...] [--file FILE]')
+        return 1
+
+    if not manager.url:
+        print('MONGO_URL not set in backend/.env or environment')
+        return 1
+    db = manager.get_db()
+    if db is None:
+        print('Could not connect to MongoDB. Run test_mongo.py for details.')
+        return 1
+
+    # do not print password hashes
+    approved = lookup(db, 'approved_users', usernames, {'_id': 0, 'password': 0})
+    requests = lookup(db, 'access_requests', usernames, {'_id': 0, 'password': 0})
+
+    if args.summary:
+        for username in usernames:
+            user, request = approved.get(username), requests.get(username)
+            print(f"{username:<32} approved_users: {user.get('role', 'user') if user else '-':<8} "
+                  f"access_requests: {request.get('status') if request else '-'}")
+    else:
+        for n, username in enumerate(usernames):
+            if n:
+                print('\n' + '-' * 40 + '\n')
+            print(f"Checking username: {username}\n")
+            print('approved_users:')
+            print(approved.get(username) or '  <not found>')
+            print('\naccess_requests:')
+            print(requests.get(username) or '  <not found>')
+
+    print(f"\n{len(usernames)} checked: {len(approved)} approved, {len(requests)} with access requests, "
+          f"{sum(1 for u in usernames if u not in approved and u not in requests)} unknown")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,288 @@
+"""Request and MongoDB metrics in Prometheus text format.
+
+Collected per worker process, with no extra dependencies:
+
+  aegis_http_request_duration_seconds   histogram by method, route and status
+  aegis_http_requests_in_progress       gauge
+  aegis_mongo_command_duration_seconds  histogram by collection and command
+                                        (pymongo CommandListener)
+  aegis_mongo_command_failures_total    counter by collection and command
+  aegis_mongo_slow_commands_total       counter by collection and command
+  aegis_mongo_pool_*                    connection pool gauges and counters (db.PoolStats)
+  aegis_rate_limited_total              counter by limit and reason (rate_limit.py)
+  aegis_rollup_update_failures_total    counter by save path (rollups.py)
+
+Routes are labelled by their URL rule (`/api/graph/<classification_id>`),
+never by the raw path, so label cardinality stays fixed. Recording is a
+bisect and a few additions under a lock, cheap enough to leave on.
+Durations for streamed (NDJSON) responses end when the headers are sent.
+
+Commands slower than METRICS_SLOW_QUERY_MS are printed with the shape of
+their filter (field names and operators, no values).
+
+`GET /metrics` serves everything for a Prometheus scrape. When
+METRICS_TOKEN is set, the scrape must send `Authorization: Bearer <token>`.
+Under gunicorn each worker keeps its own numbers, so a scrape through the
+shared port sees one worker at a time; scrape workers directly, or compare
+rates rather than absolute totals.
+
+Configuration (environment variables):
+  METRICS_ENABLED         collect metrics (default true)
+  METRICS_SLOW_QUERY_MS   slow command log threshold, 0 = off (default 100)
+  METRICS_TOKEN           bearer token required by /metrics (default none)
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from pymongo import monitoring
+
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+MONGO_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def metrics_enabled():
+    return os.environ.get('METRICS_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Fixed-bucket histogram keyed by a tuple of label values."""
+
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        with self._lock:
+            snapshot = [(labels, list(s[0]), s[1], s[2]) for labels, s in self._series.items()]
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for labels, counts, total, count in sorted(snapshot):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f'{self.name}_bucket{_labels(self.label_names, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.label_names, labels)} {_number(total)}')
+            lines.append(f'{self.name}_count{_labels(self.label_names, labels)} {count}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            snapshot = sorted(self._values.items())
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        lines += [f'{self.name}{_labels(self.label_names, labels)} {_number(v)}' for labels, v in snapshot]
+        return lines
+
+
+def _gauge(name, help_text, value, kind='gauge'):
+    return [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}', f'{name} {_number(value)}']
+
+
+def _shape(value, depth=0):
+    """Field names and operators of a filter, with every value replaced by '?'."""
+    if depth > 4:
+        return '...'
+    if isinstance(value, dict):
+        return {k: _shape(v, depth + 1) for k, v in value.items()}
+    if isinstance(value, (list, tuple)) and value and isinstance(value[0], dict):
+        return [_shape(v, depth + 1) for v in value[:3]]
+    return '?'
+
+
+def command_shape(name, command):
+    """A loggable, value-free summary of what a command matched on."""
+    if name == 'aggregate':
+        return [next(iter(stage), '?') for stage in command.get('pipeline', [])]
+    if name in ('update', 'delete'):
+        statements = command.get('updates') or command.get('deletes') or []
+        return _shape(statements[0].get('q', {})) if statements else {}
+    for field in ('filter', 'query', 'q'):
+        if field in command:
+            return _shape(command[field])
+    return {}
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Times every MongoDB command by collection and command name."""
+
+    def __init__(self, registry):
+        self.registry = registry
+        self._pending = {}
+
+    def started(self, event):
+        name = event.command_name
+        target = event.command.get('collection') if name == 'getMore' else event.command.get(name)
+        collection = target if isinstance(target, str) else ''
+        # Kept by reference; only turned into a filter shape when the command is slow
+        self._pending[(event.connection_id, event.request_id)] = (collection, event.command)
+
+    def _finish(self, event, failed):
+        pending = self._pending.pop((event.connection_id, event.request_id), None)
+        collection, command = pending if pending else ('', None)
+        labels = (collection, event.command_name)
+        seconds = event.duration_micros / 1e6
+        self.registry.mongo_duration.observe(labels, seconds)
+        if failed:
+            self.registry.mongo_failures.inc(labels)
+        slow_ms = self.registry.slow_query_ms
+        if slow_ms and seconds * 1000 >= slow_ms:
+            self.registry.mongo_slow.inc(labels)
+            shape = command_shape(event.command_name, command) if command is not None else {}
+            print(f"Slow MongoDB command: {event.command_name} on {collection or event.database_name} "
+                  f"took {seconds * 1000:.1f} ms (filter {shape})")
+
+    def succeeded(self, event):
+        self._finish(event, failed=False)
+
+    def failed(self, event):
+        self._finish(event, failed=True)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.http_duration = Histogram(
+            'aegis_http_request_duration_seconds', 'HTTP request latency by route.',
+            ('method', 'route', 'status'), HTTP_BUCKETS)
+        self.mongo_duration = Histogram(
+            'aegis_mongo_command_duration_seconds', 'MongoDB command latency.',
+            ('collection', 'command'), MONGO_BUCKETS)
+        self.mongo_failures = Counter(
+            'aegis_mongo_command_failures_total', 'MongoDB commands that failed.', ('collection', 'command'))
+        self.mongo_slow = Counter(
+            'aegis_mongo_slow_commands_total', 'MongoDB commands slower than METRICS_SLOW_QUERY_MS.',
+            ('collection', 'command'))
+        self.rate_limited = Counter(
+            'aegis_rate_limited_total', 'Requests answered 429 by admission control (rate_limit.py).',
+            ('limit', 'reason'))
+        self.rollup_failures = Counter(
+            'aegis_rollup_update_failures_total',
+            'Saved runs whose rollup update failed; `rollups.py rebuild` repairs the stats.', ('source',))
+        self.in_progress = 0
+        self._lock = threading.Lock()
+        self.slow_query_ms = _env_float('METRICS_SLOW_QUERY_MS', 100)
+        self.command_listener = CommandMetrics(self)
+
+    def request_started(self):
+        with self._lock:
+            self.in_progress += 1
+        return time.perf_counter()
+
+    def request_finished(self, started, method, route, status):
+        """Record a finished request; status None only drops it from the in-progress gauge."""
+        if status is not None:
+            self.http_duration.observe((method, route, str(status)), time.perf_counter() - started)
+        with self._lock:
+            self.in_progress -= 1
+
+    def render(self, mongo_manager=None):
+        lines = []
+        lines += self.http_duration.render()
+        lines += _gauge('aegis_http_requests_in_progress', 'Requests being handled by this worker.',
+                        self.in_progress)
+        lines += self.mongo_duration.render()
+        lines += self.mongo_failures.render()
+        lines += self.mongo_slow.render()
+        lines += self.rate_limited.render()
+        lines += self.rollup_failures.render()
+        if mongo_manager is not None:
+            pool = mongo_manager.pool_stats.snapshot()
+            lines += _gauge('aegis_mongo_pool_open_connections', 'Open pooled connections.',
+                            pool['open_connections'])
+            lines += _gauge('aegis_mongo_pool_in_use_connections', 'Connections checked out.', pool['in_use'])
+            lines += _gauge('aegis_mongo_pool_max_size', 'Configured maxPoolSize.',
+                            mongo_manager.client_options()['maxPoolSize'])
+            lines += _gauge('aegis_mongo_pool_checkouts_total', 'Connection checkouts.',
+                            pool['checkouts'], 'counter')
+            lines += _gauge('aegis_mongo_pool_checkout_failures_total', 'Checkouts that timed out or failed.',
+                            pool['checkout_failures'], 'counter')
+            lines += _gauge('aegis_mongo_pool_cleared_total', 'Times the pool was cleared.',
+                            pool['pools_cleared'], 'counter')
+            lines += _gauge('aegis_mongo_healthy', 'Result of the last MongoDB health check.',
+                            1 if mongo_manager._healthy else 0)
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+def instrument(app, mongo_manager):
+    """Time every request of `app` and register the command listener on `mongo_manager`.
+
+    Call before the first request, since listeners only reach clients created afterwards.
+    """
+    if not metrics_enabled():
+        return
+    from flask import g, request
+
+    mongo_manager.add_listener(registry.command_listener)
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = registry.request_started()
+
+    @app.teardown_request
+    def record_request_time(error=None):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        status = g.pop('metrics_status', 500 if error is not None else 200)
+        registry.request_finished(started, request.method, route, status)
+
+    @app.after_request
+    def remember_status(response):
+        g.metrics_status = response.status_code
+        return response
@@ -0,0 +1,72 @@
+"""Local stand-in for the Colab GE-GNN model server.
+
+Speaks the same protocol as the notebook: POST /api/classify with a CSV in
+the `file` form field, answer {"predictions": [...]} with one prediction per
+row. Scores are deterministic (hashed from the row) so repeated runs are
+comparable, which makes this useful for throughput testing offline.
+
+Usage:
+  python mock_model_server.py            # listens on MOCK_MODEL_PORT (default 5001)
+  COLAB_MODEL_URL=http://localhost:5001 python mongo_connection.py
+
+Optional environment variables:
+  MOCK_MODEL_LATENCY_MS       fixed delay per request (default 0)
+  MOCK_MODEL_ROW_LATENCY_MS   extra delay per row (default 0)
+  MOCK_MODEL_FAILURE_RATE     fraction of requests answered with 503 (default 0)
+"""
+import csv
+import hashlib
+import io
+import os
+import random
+import time
+
+from flask import Flask, request, jsonify
+
+app = Flask(__name__)
+
+
+def score_row(row):
+    key = '|'.join(str(row.get(k, '')) for k in ('_id', 'reviewerID', 'asin', 'reviewText'))
+    base = int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:8], 16) / 0xFFFFFFFF
+    text = row.get('reviewText') or ''
+    # Nudge shouty, exclamation-heavy reviews towards fraud so demos look plausible
+    shout = min(text.count('!') * 0.05, 0.3)
+    return min(base * 0.7 + shout, 1.0)
+
+
+@app.route('/api/classify', methods=['POST'])
+def classify():
+    latency = float(os.environ.get('MOCK_MODEL_LATENCY_MS', 0)) / 1000.0
+    row_latency = float(os.environ.get('MOCK_MODEL_ROW_LATENCY_MS', 0)) / 1000.0
+    failure_rate = float(os.environ.get('MOCK_MODEL_FAILURE_RATE', 0))
+
+    if failure_rate and random.random() < failure_rate:
+        return jsonify({'error': 'Simulated model failure'}), 503
+
+    upload = request.files.get('file')
+    if upload is None:
+        return jsonify({'error': 'No file uploaded'}), 400
+
+    reader = csv.DictReader(io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline=''))
+    predictions = []
+    for row in reader:
+        p = score_row(row)
+        fraud = p >= 0.5
+        predictions.append({
+            '_id': row.get('_id'),
+            'reviewerID': row.get('reviewerID'),
+            'reviewerName': row.get('reviewerName'),
+            'asin': row.get('asin'),
+            'label': 'Fraud' if fraud else 'Benign',
+            'fraud_probability': round(p, 4),
+            'confidence': round(p if fraud else 1 - p, 4),
+        })
+
+    time.sleep(latency + row_latency * len(predictions))
+    return jsonify({'predictions': predictions}), 200
+
+
+if __name__ == '__main__':
+    port = int(os.environ.get('MOCK_MODEL_PORT', 5001))
+    app.run(host='0.0.0.0', port=port, threaded=True)
@@ -0,0 +1,328 @@
+"""Client for the remote GE-GNN model endpoint (Colab/ngrok or the local stand-in).
+
+`/api/classify` streams the uploaded CSV through `iter_csv_rows`, cuts it
+into batches, drops rows already in the prediction cache (prediction_cache.py)
+and sends the rest to the model over one pooled `requests.Session`
+with bounded concurrency, retries and per-batch timeouts. Only a small
+window of batches is held in memory at a time; predictions come back in the
+same order as the input rows. `AsyncModelClient` does the same over one
+`httpx.AsyncClient` for the ASGI app (asgi_app.py).
+
+Configuration (environment variables):
+  COLAB_MODEL_URL            model base URL (falls back to MODEL_API_URL)
+  MODEL_CLASSIFY_PATH        path on the model server (default /api/classify)
+  CLASSIFY_BATCH_SIZE        rows per model call (default 500)
+  CLASSIFY_MAX_CONCURRENCY   batches in flight at once (default 4)
+  CLASSIFY_RETRIES           retries per batch on 429/5xx/connection errors (default 2)
+  CLASSIFY_CONNECT_TIMEOUT   seconds (default 5)
+  CLASSIFY_READ_TIMEOUT      seconds per batch (default 120)
+  CLASSIFY_ASYNC_MAX_CONNECTIONS  model calls in flight per ASGI worker, across
+                                  all uploads (default 16)
+"""
+import asyncio
+import csv
+import io
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from prediction_cache import get_prediction_cache
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+class ModelServiceError(Exception):
+    """The model endpoint failed or returned something we cannot use."""
+
+
+def iter_csv_rows(stream, encoding='utf-8-sig'):
+    """Return (fieldnames, row iterator) for a binary CSV stream without reading it all."""
+    text = io.TextIOWrapper(stream, encoding=encoding, newline='')
+    reader = csv.DictReader(text)
+    fieldnames = reader.fieldnames or []
+    return fieldnames, reader
+
+
+def iter_batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def rows_to_csv(rows, fieldnames):
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=fieldnames, extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(rows)
+    return buf.getvalue().encode('utf-8')
+
+
+def extract_predictions(data):
+    """Accept the same response shapes the dashboard used to handle."""
+    if isinstance(data, list):
+        return data
+    if isinstance(data, dict):
+        for key in ('predictions', 'results', 'data', 'output'):
+            if isinstance(data.get(key), list):
+                return data[key]
+    raise ModelServiceError('Invalid response format from model endpoint')
+
+
+class ModelClient:
+    def __init__(self, base_url=None, batch_size=None, max_concurrency=None,
+                 retries=None, connect_timeout=None, read_timeout=None, cache=None):
+        self.base_url = (base_url or os.environ.get('COLAB_MODEL_URL')
+                         or os.environ.get('MODEL_API_URL') or '').rstrip('/')
+        self.path = os.environ.get('MODEL_CLASSIFY_PATH', '/api/classify')
+        self.batch_size = max(1, batch_size or _env_int('CLASSIFY_BATCH_SIZE', 500))
+        self.max_concurrency = max(1, max_concurrency or _env_int('CLASSIFY_MAX_CONCURRENCY', 4))
+        self.retries = retries if retries is not None else _env_int('CLASSIFY_RETRIES', 2)
+        self.timeout = (connect_timeout or _env_float('CLASSIFY_CONNECT_TIMEOUT', 5),
+                        read_timeout or _env_float('CLASSIFY_READ_TIMEOUT', 120))
+        self.cache = cache
+        self._session = None
+        self._session_pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def configured(self):
+        return bool(self.base_url)
+
+    @property
+    def session(self):
+        """Pooled session, rebuilt after fork so workers never share sockets."""
+        if self._session is None or self._session_pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._session_pid != os.getpid():
+                    retry = Retry(
+                        total=self.retries,
+                        backoff_factor=0.5,
+                        status_forcelist=(429, 500, 502, 503, 504),
+                        allowed_methods=frozenset(['POST']),
+                        respect_retry_after_header=True,
+                        raise_on_status=False,
+                    )
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency,
+                                          pool_block=True, max_retries=retry)
+                    session = requests.Session()
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    # ngrok shows an HTML interstitial to browsers unless told otherwise
+                    session.headers['ngrok-skip-browser-warning'] = '1'
+                    self._session = session
+                    self._session_pid = os.getpid()
+        return self._session
+
+    def classify_batch(self, rows, fieldnames, index=0):
+        """Predictions for one batch, asking the model only about cache misses."""
+        if self.cache is None:
+            return self.call_model(rows, fieldnames, index)
+
+        keys = [self.cache.key(row) for row in rows]
+        found = self.cache.lookup(keys)
+        results = [found.get(key) for key in keys]
+        missing = [i for i, p in enumerate(results) if p is None]
+        if not missing:
+            return results
+
+        fresh = self.call_model([rows[i] for i in missing], fieldnames, index)
+        if len(fresh) != len(missing):
+            # Cannot line answers up with rows; use the model's output for the whole batch
+            return self.call_model(rows, fieldnames, index) if len(missing) < len(rows) else fresh
+        for i, prediction in zip(missing, fresh):
+            results[i] = prediction
+        self.cache.store([(keys[i], prediction) for i, prediction in zip(missing, fresh)])
+        return results
+
+    def call_model(self, rows, fieldnames, index=0):
+        payload = rows_to_csv(rows, fieldnames)
+        files = {'file': (f'batch-{index:05d}.csv', payload, 'text/csv')}
+        try:
+            response = self.session.post(self.base_url + self.path, files=files, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise ModelServiceError(f'Batch {index} failed: {e}') from e
+        if response.status_code >= 400:
+            raise ModelServiceError(f'Batch {index} failed with HTTP {response.status_code}: {response.text[:200]}')
+        try:
+            predictions = extract_predictions(response.json())
+        except ValueError as e:
+            raise ModelServiceError(f'Batch {index} returned invalid JSON') from e
+        if len(predictions) != len(rows):
+            print(f"Model returned {len(predictions)} predictions for {len(rows)} rows in batch {index}")
+        return predictions
+
+    def classify_rows(self, rows, fieldnames):
+        """Yield predictions for `rows` in input order.
+
+        At most 2 * max_concurrency batches are parsed ahead of the consumer,
+        so memory stays bounded no matter how large the upload is.
+        """
+        if not self.configured:
+            raise ModelServiceError('Model endpoint is not configured (set COLAB_MODEL_URL)')
+        window = self.max_concurrency * 2
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='classify') as pool:
+            try:
+                for index, batch in enumerate(iter_batches(rows, self.batch_size)):
+                    pending.append(pool.submit(self.classify_batch, batch, fieldnames, index))
+                    if len(pending) >= window:
+                        yield from pending.popleft().result()
+                while pending:
+                    yield from pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+
+class AsyncModelClient:
+    """asyncio version of ModelClient with the same settings and prediction cache.
+
+    Needs httpx. Cache lookups and CSV parsing run in threads, so the event
+    loop only waits on the model.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, client=None):
+        self.sync = client or get_model_client()
+        self._http = None
+        self._limit = None
+
+    @property
+    def configured(self):
+        return self.sync.configured
+
+    @property
+    def cache(self):
+        return self.sync.cache
+
+    @property
+    def http(self):
+        if self._http is None:
+            import httpx
+            connect, read = self.sync.timeout
+            connections = max(1, _env_int('CLASSIFY_ASYNC_MAX_CONNECTIONS', 16))
+            self._http = httpx.AsyncClient(
+                timeout=httpx.Timeout(read, connect=connect),
+                limits=httpx.Limits(max_connections=connections),
+                # ngrok shows an HTML interstitial to browsers unless told otherwise
+                headers={'ngrok-skip-browser-warning': '1'})
+            self._limit = asyncio.Semaphore(connections)
+        return self._http
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    async def call_model(self, rows, fieldnames, index=0):
+        import httpx
+        payload = rows_to_csv(rows, fieldnames)
+        files = {'file': (f'batch-{index:05d}.csv', payload, 'text/csv')}
+        url = self.sync.base_url + self.sync.path
+        http = self.http
+        for attempt in range(self.sync.retries + 1):
+            last = attempt == self.sync.retries
+            try:
+                async with self._limit:
+                    response = await http.post(url, files=files)
+            except httpx.HTTPError as e:
+                if last:
+                    raise ModelServiceError(f'Batch {index} failed: {e}') from e
+                await asyncio.sleep(0.5 * 2 ** attempt)
+                continue
+            if response.status_code in self.RETRY_STATUSES and not last:
+                try:
+                    delay = float(response.headers.get('Retry-After', ''))
+                except ValueError:
+                    delay = 0.5 * 2 ** attempt
+                await asyncio.sleep(delay)
+                continue
+            break
+        if response.status_code >= 400:
+            raise ModelServiceError(f'Batch {index} failed with HTTP {response.status_code}: {response.text[:200]}')
+        try:
+            predictions = extract_predictions(response.json())
+        except ValueError as e:
+            raise ModelServiceError(f'Batch {index} returned invalid JSON') from e
+        if len(predictions) != len(rows):
+            print(f"Model returned {len(predictions)} predictions for {len(rows)} rows in batch {index}")
+        return predictions
+
+    async def classify_batch(self, rows, fieldnames, index=0):
+        """Same cache handling as ModelClient.classify_batch."""
+        cache = self.cache
+        if cache is None:
+            return await self.call_model(rows, fieldnames, index)
+
+        keys = [cache.key(row) for row in rows]
+        found = await asyncio.to_thread(cache.lookup, keys)
+        results = [found.get(key) for key in keys]
+        missing = [i for i, p in enumerate(results) if p is None]
+        if not missing:
+            return results
+
+        fresh = await self.call_model([rows[i] for i in missing], fieldnames, index)
+        if len(fresh) != len(missing):
+            return await self.call_model(rows, fieldnames, index) if len(missing) < len(rows) else fresh
+        for i, prediction in zip(missing, fresh):
+            results[i] = prediction
+        await asyncio.to_thread(cache.store, [(keys[i], prediction) for i, prediction in zip(missing, fresh)])
+        return results
+
+    async def classify_rows(self, rows, fieldnames):
+        """Predictions for `rows` in input order, max_concurrency batches in flight."""
+        if not self.configured:
+            raise ModelServiceError('Model endpoint is not configured (set COLAB_MODEL_URL)')
+        batches = iter_batches(rows, self.sync.batch_size)
+        pending = deque()
+        predictions = []
+        try:
+            index = 0
+            while True:
+                batch = await asyncio.to_thread(next, batches, None)
+                if batch is None:
+                    break
+                pending.append(asyncio.ensure_future(self.classify_batch(batch, fieldnames, index)))
+                index += 1
+                if len(pending) >= self.sync.max_concurrency:
+                    predictions.extend(await pending.popleft())
+            while pending:
+                predictions.extend(await pending.popleft())
+        finally:
+            for task in pending:
+                task.cancel()
+        return predictions
+
+
+_client = None
+
+
+def get_model_client():
+    """Process-wide model client (shares one HTTP connection pool)."""
+    global _client
+    if _client is None:
+        _client = ModelClient(cache=get_prediction_cache())
+    return _client
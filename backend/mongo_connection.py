@@ -1,41 +1,76 @@
 import os
 from flask import Flask, request, jsonify
-import pymongo
-import certifi
-import traceback
 from flask_cors import CORS
 from dotenv import load_dotenv
-from werkzeug.security import check_password_hash, generate_password_hash
+import csv
+import hmac
+import shutil
+import tempfile
 from datetime import datetime
 
+from bson import ObjectId
+
+from db import get_db, manager as mongo_manager
+from model_client import get_model_client, iter_csv_rows, ModelServiceError
+from inference import embedded_enabled, get_engine
+from predictions import save_run, page_predictions, page_projection, parse_object_id, ArchivedRunUnavailable
+from pagination import (parse_page_args, build_projection, find_page, find_all, split_page,
+                        PaginationError, CURSOR_HEADER)
+from rollups import update_rollups, rollup_failed, query_stats
+from cli_utils import parse_time
+from ingest_queue import ingest_queue, async_writes_enabled, QueueFull
+from graph_layout import get_layout, schedule_layouts
+from review_graph import ReviewGraph
+from ttl_cache import TTLCache
+from uploads import upload_store, UploadError, CHECKSUM_HEADER
+import http_cache
+from serialization import MongoJSONProvider, wants_ndjson, ndjson_response, ndjson_batch_size
+from indexes import ensure_indexes_once
+from rate_limit import install as install_rate_limits
+from metrics import instrument, registry as metrics_registry, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from auth import (issue_token, check_password, hash_password, is_hashed, token_ttl, login_enabled,
+                  current_principal, login_required, revoke_user)
+
 # Load environment variables
 load_dotenv()
 
 app = Flask(__name__)
-CORS(app)
+app.json = MongoJSONProvider(app)
+CORS(app, expose_headers=[CURSOR_HEADER, 'ETag'])
 
 app.config['JSON_SORT_KEYS'] = False
-
-def get_db():
-    """Create a Mongo client using MONGO_URL env var."""
-    MONGO_URL = os.environ.get('MONGO_URL')
-    DB_NAME = os.environ.get('MONGO_DB_NAME', 'fraud_detection')
-    if not MONGO_URL:
-        return None
-    try:
-        # Use certifi CA bundle to avoid local OpenSSL CA issues
-        ca = certifi.where()
-        client = pymongo.MongoClient(MONGO_URL, tlsCAFile=ca, serverSelectionTimeoutMS=10000)
-        # Test the connection (will raise on failure)
-        client.server_info()
-        db = client[DB_NAME]
-        # Test database access
-        db.list_collection_names()
-        return db
-    except Exception as e:
-        print(f"MongoDB Connection Error: {str(e)}")
-        traceback.print_exc()
-        return None
+instrument(app, mongo_manager)
+install_rate_limits(app)
+app.after_request(http_cache.compress_response)
+
+@app.before_request
+def bootstrap_indexes():
+    """Apply the declared indexes (indexes.py) once per worker process."""
+    ensure_indexes_once(get_db)
+
+def list_documents(collection, query, **projection_options):
+    """Shared body of the list endpoints: one JSON page, or an NDJSON stream.
+
+    Streaming (format=ndjson) starts at `cursor` and runs to the end of the
+    result set unless `limit` is given explicitly.
+    """
+    limit, page_cursor, fields, summary = parse_page_args(request.args)
+    projection = build_projection(fields, summary=summary, **projection_options)
+    if wants_ndjson(request):
+        stream_limit = limit if 'limit' in request.args else None
+        cursor = find_all(collection, query, projection, page_cursor, stream_limit, ndjson_batch_size())
+        return ndjson_response(cursor), 200
+    # ETag / 304 / cached and compressed page (http_cache.py)
+    return http_cache.cached_page(collection, query, lambda: split_page(
+        list(find_page(collection, query, projection, limit, page_cursor)), limit))
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus scrape endpoint (see metrics.py)."""
+    token = os.environ.get('METRICS_TOKEN')
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return metrics_registry.render(mongo_manager), 200, {'Content-Type': METRICS_CONTENT_TYPE}
 
 # Simple test endpoint to verify connection
 @app.route('/api/test-connection', methods=['GET'])
@@ -43,12 +78,13 @@ def test_connection():
     """Test if MongoDB connection is working."""
     print("Received test connection request")  # Debug log
     try:
-        db = get_db()
-        if db is None:
+        if mongo_manager.get_client() is None or not mongo_manager.is_healthy(force=True):
             print("MongoDB connection failed")  # Debug log
-            return jsonify({'status': 'error', 'message': 'Could not connect to MongoDB'}), 500
+            return jsonify({'status': 'error', 'message': 'Could not connect to MongoDB',
+                            'pool': mongo_manager.stats()}), 500
         print("MongoDB connection successful")  # Debug log
-        return jsonify({'status': 'success', 'message': 'Connected to MongoDB'}), 200
+        return jsonify({'status': 'success', 'message': 'Connected to MongoDB',
+                        'pool': mongo_manager.stats()}), 200
     except Exception as e:
         print(f"Error: {str(e)}")  # Debug log
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -57,6 +93,8 @@ def test_connection():
 def login():
     """Check if user exists and credentials are valid."""
     try:
+        if not login_enabled():
+            return jsonify({'error': 'Login is disabled: AUTH_SECRET_KEY is not set'}), 503
         db = get_db()
         if db is None:
             return jsonify({'error': 'Database connection failed'}), 500
@@ -68,15 +106,22 @@ def login():
         if not username or not password:
             return jsonify({'error': 'Username and password are required'}), 400
 
-        # Check for an approved user with matching password (no hashing)
-        approved_user = db.approved_users.find_one({'username': username, 'password': password})
-        if approved_user:
+        # Check for an approved user and verify the password hash
+        approved_user = db.approved_users.find_one({'username': username})
+        # Unknown users are checked too (against a dummy hash) so timing does not reveal accounts
+        stored = approved_user.get('password') if approved_user else None
+        if check_password(username, stored, password):
+            if not is_hashed(approved_user.get('password')):
+                # Upgrade accounts that still hold a plaintext password
+                db.approved_users.update_one({'_id': approved_user['_id']},
+                                             {'$set': {'password': hash_password(password)}})
             user_data = {
                 'username': approved_user['username'],
                 'email': approved_user.get('email'),
                 'role': approved_user.get('role', 'user')
             }
-            return jsonify({'success': True, 'message': 'Login successful', 'user': user_data}), 200
+            return jsonify({'success': True, 'message': 'Login successful', 'user': user_data,
+                            'token': issue_token(user_data), 'expires_in': token_ttl()}), 200
 
         # If not an approved user, check if they have a pending access request
         pending_request = db.access_requests.find_one({'username': username})
@@ -90,6 +135,7 @@ def login():
 
 
 @app.route('/api/feedback', methods=['POST'])
+@login_required()
 def submit_feedback():
     """Save platform feedback to `platform_feedback` collection."""
     try:
@@ -98,6 +144,7 @@ def submit_feedback():
             return jsonify({'error': 'Database connection failed'}), 500
 
         data = request.get_json() or {}
+        principal = current_principal()
         # Basic validation
         if not data.get('rating') or not data.get('comments'):
             return jsonify({'error': 'Rating and comments are required'}), 400
@@ -107,7 +154,7 @@ def submit_feedback():
             'email': data.get('email'),
             'rating': data.get('rating'),
             'comments': data.get('comments'),
-            'username': data.get('username', 'Anonymous'),
+            'username': principal['username'] if principal else data.get('username', 'Anonymous'),
             'created_at': datetime.utcnow()
         }
 
@@ -118,8 +165,14 @@ def submit_feedback():
 
 
 @app.route('/api/feedback', methods=['GET'])
+@login_required(role='admin')
 def list_feedback():
-    """List saved feedback (admin). Optional query params: transactionId, username."""
+    """List saved feedback (admin), newest first.
+
+    Optional query params: transactionId, username, plus limit/cursor/fields
+    (see pagination.py). The next page token is in the X-Next-Cursor header.
+    format=ndjson streams every matching document instead.
+    """
     try:
         db = get_db()
         if db is None:
@@ -133,15 +186,9 @@ def list_feedback():
         if user:
             query['username'] = user
 
-        cursor = db.model_feedback.find(query)
-        results = []
-        for r in cursor:
-            r['_id'] = str(r.get('_id'))
-            if isinstance(r.get('created_at'), datetime):
-                r['created_at'] = r['created_at'].isoformat()
-            results.append(r)
-
-        return jsonify(results), 200
+        return list_documents(db.model_feedback, query)
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -174,17 +221,17 @@ def create_access_request():
         if existing_request:
             return jsonify({'error': 'An access request with this username or email already exists'}), 400
 
-        # Create new access request (no password hashing)
         access_request = {
             'username': username,
             'email': email,
-            'password': password,
+            'password': hash_password(password),
             'status': 'pending',
             'created_at': datetime.utcnow(),
             'updated_at': datetime.utcnow()
         }
 
         result = db.access_requests.insert_one(access_request)
+        http_cache.invalidate('access_requests')
         return jsonify({
             'message': 'Access request created successfully',
             'id': str(result.inserted_id)
@@ -226,8 +273,12 @@ def check_request_status(username):
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/access-requests', methods=['GET'])
+@login_required(role='admin')
 def list_access_requests():
-    """List access requests (admin). Optional query param `status` to filter."""
+    """List access requests (admin), newest first.
+
+    Optional query param `status` to filter, plus limit/cursor/fields.
+    """
     try:
         db = get_db()
         if db is None:
@@ -238,27 +289,15 @@ def list_access_requests():
         if status:
             query['status'] = status
 
-        cursor = db.access_requests.find(query, {'password': 0})
-        results = []
-        for r in cursor:
-            r['_id'] = str(r.get('_id'))
-            # Convert datetimes to isoformat for JSON
-            if isinstance(r.get('created_at'), datetime):
-                r['created_at'] = r['created_at'].isoformat()
-            if isinstance(r.get('updated_at'), datetime):
-                r['updated_at'] = r['updated_at'].isoformat()
-            if isinstance(r.get('approved_at'), datetime):
-                r['approved_at'] = r['approved_at'].isoformat()
-            if isinstance(r.get('denied_at'), datetime):
-                r['denied_at'] = r['denied_at'].isoformat()
-            results.append(r)
-
-        return jsonify(results), 200
+        return list_documents(db.access_requests, query, exclude=['password'])
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/access-requests/<username>/approve', methods=['POST'])
+@login_required(role='admin')
 def approve_access_request(username):
     """Approve an access request: copy to approved_users and update request status."""
     try:
@@ -275,13 +314,14 @@ def approve_access_request(username):
         if existing:
             # Mark request as approved for audit and return conflict
             db.access_requests.update_one({'username': username}, {'$set': {'status': 'approved', 'updated_at': datetime.utcnow(), 'approved_at': datetime.utcnow()}})
+            http_cache.invalidate('access_requests')
             return jsonify({'message': 'User already exists in approved_users; request marked approved'}), 200
 
         # Insert into approved_users with original password
         new_user = {
             'username': req['username'],
             'email': req.get('email'),
-            'password': req['password'],  # Using original password without hashing
+            'password': req['password'],  # Already hashed when the request was created
             'role': request.json.get('role') if request.is_json and request.json.get('role') else req.get('role', 'user'),
             'created_at': datetime.utcnow()
         }
@@ -289,6 +329,7 @@ def approve_access_request(username):
 
         # Update the request status to approved
         db.access_requests.update_one({'username': username}, {'$set': {'status': 'approved', 'updated_at': datetime.utcnow(), 'approved_at': datetime.utcnow()}})
+        http_cache.invalidate('access_requests')
 
         return jsonify({'message': 'Access request approved and user created'}), 200
     except Exception as e:
@@ -296,6 +337,7 @@ def approve_access_request(username):
 
 
 @app.route('/api/access-requests/<username>/deny', methods=['POST'])
+@login_required(role='admin')
 def deny_access_request(username):
     """Deny an access request and set a denial reason."""
     try:
@@ -316,42 +358,250 @@ def deny_access_request(username):
             update['denied_reason'] = reason
 
         db.access_requests.update_one({'username': username}, {'$set': update})
+        http_cache.invalidate('access_requests')
 
         return jsonify({'message': 'Access request denied'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/classifications', methods=['POST'])
-def save_classification():
-    """Save classification results to database."""
+@app.route('/api/users/<username>/revoke', methods=['POST'])
+@login_required(role='admin')
+def revoke_access(username):
+    """Remove an approved user and invalidate any tokens already issued to them."""
     try:
         db = get_db()
         if db is None:
             return jsonify({'error': 'Database connection failed'}), 500
 
-        data = request.get_json()
+        deleted = revoke_user(db, username)
+        if not deleted:
+            return jsonify({'error': 'Approved user not found'}), 404
+
+        db.access_requests.update_one({'username': username}, {'$set': {'status': 'revoked', 'updated_at': datetime.utcnow()}})
+        http_cache.invalidate('access_requests')
+        return jsonify({'message': 'User access revoked'}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+def proxy_classify(client, stream):
+    """Classify a CSV stream with the remote model; returns (body, status)."""
+    fieldnames, rows = iter_csv_rows(stream)
+    if not fieldnames:
+        return {'error': 'Uploaded CSV is empty'}, 400
+
+    cache_before = client.cache.stats() if client.cache else None
+    predictions = list(client.classify_rows(rows, fieldnames))
+    body = {'predictions': predictions, 'total': len(predictions), 'engine': 'remote'}
+    if cache_before:
+        # Approximate under concurrent uploads; the global counters are exact
+        after = client.cache.stats()
+        body['cache'] = {
+            'hits': (after['memory_hits'] + after['store_hits']) - (cache_before['memory_hits'] + cache_before['store_hits']),
+            'misses': after['misses'] - cache_before['misses'],
+        }
+    return body, 200
+
+
+def classify_file(f, client, engine):
+    """Classify a seekable CSV file with the embedded engine, else the remote model.
+
+    The remote model is also the fallback when embedded inference fails.
+    Returns (body, status).
+    """
+    if engine is None:
+        if not client.configured:
+            return {'error': 'Model endpoint not configured'}, 503
+        return proxy_classify(client, f)
+    try:
+        predictions = engine.classify_file(f)
+        return {'predictions': predictions, 'total': len(predictions), 'engine': 'embedded'}, 200
+    except (UnicodeDecodeError, csv.Error):
+        raise
+    except Exception as e:
+        if not client.configured:
+            raise
+        print(f"Embedded inference failed, falling back to the remote model: {str(e)}")
+    f.seek(0)
+    return proxy_classify(client, f)
+
+
+@app.route('/api/classify', methods=['POST'])
+@login_required()
+def classify_reviews():
+    """Classify an uploaded review CSV with the GE-GNN model.
+
+    With MODEL_BACKEND=embedded the model runs in-process (inference.py);
+    otherwise, or if that fails, batches are proxied to the remote endpoint.
+    """
+    try:
+        upload = request.files.get('file')
+        if upload is None:
+            return jsonify({'error': 'No file uploaded'}), 400
+
+        client = get_model_client()
+        engine = get_engine() if embedded_enabled() else None
+        if engine is None:
+            if not client.configured:
+                return jsonify({'error': 'Model endpoint not configured'}), 503
+            body, status = proxy_classify(client, upload.stream)
+            return jsonify(body), status
+
+        # The embedded model needs the whole file (it builds the review graph),
+        # and the fallback needs to read it again, so spool it to disk first
+        with tempfile.TemporaryFile() as spool:
+            shutil.copyfileobj(upload.stream, spool, 1 << 20)
+            if spool.tell() == 0:
+                return jsonify({'error': 'Uploaded CSV is empty'}), 400
+            spool.seek(0)
+            body, status = classify_file(spool, client, engine)
+            return jsonify(body), status
+
+    except ModelServiceError as e:
+        print(f"Model endpoint error: {str(e)}")
+        return jsonify({'error': str(e)}), 502
+    except (UnicodeDecodeError, csv.Error) as e:
+        return jsonify({'error': f'Could not parse CSV: {str(e)}'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/uploads', methods=['POST'])
+@login_required()
+def start_upload():
+    """Start a resumable chunked upload (uploads.py) for a CSV of `size` bytes."""
+    data = request.get_json(silent=True) or {}
+    try:
+        upload = upload_store.create(current_principal(), data.get('filename'), data.get('size'),
+                                     data.get('sha256'))
+    except UploadError as e:
+        return jsonify(e.body()), e.status
+    return jsonify(upload), 201
+
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@login_required()
+def get_upload_status(upload_id):
+    """Acknowledged offset of an upload; clients resume from here."""
+    try:
+        return jsonify(upload_store.status(upload_id, current_principal())), 200
+    except UploadError as e:
+        return jsonify(e.body()), e.status
+
+
+@app.route('/api/uploads/<upload_id>/chunk', methods=['PUT'])
+@login_required()
+def upload_chunk(upload_id):
+    """Append the raw request body at `offset`, verified against X-Chunk-SHA256."""
+    try:
+        offset = int(request.args['offset'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'offset must be an integer'}), 400
+    try:
+        upload = upload_store.append(upload_id, current_principal(), offset, request.stream,
+                                     request.headers.get(CHECKSUM_HEADER))
+    except UploadError as e:
+        return jsonify(e.body()), e.status
+    return jsonify(upload), 200
+
+
+@app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+@login_required()
+def finalize_upload(upload_id):
+    """Classify a completed upload; the response matches POST /api/classify."""
+    try:
+        client = get_model_client()
+        engine = get_engine() if embedded_enabled() else None
+        with upload_store.assembled(upload_id, current_principal()) as f:
+            body, status = classify_file(f, client, engine)
+            if status == 503:
+                # Keep the upload until a model is available
+                raise UploadError(body['error'], 503)
+        return jsonify(body), status
+    except UploadError as e:
+        return jsonify(e.body()), e.status
+    except ModelServiceError as e:
+        print(f"Model endpoint error: {str(e)}")
+        return jsonify({'error': str(e)}), 502
+    except (UnicodeDecodeError, csv.Error) as e:
+        return jsonify({'error': f'Could not parse CSV: {str(e)}'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+@login_required()
+def abort_upload(upload_id):
+    try:
+        upload_store.delete(upload_id, current_principal())
+    except UploadError as e:
+        return jsonify(e.body()), e.status
+    return jsonify({'message': 'Upload aborted'}), 200
+
+
+@app.route('/api/classify/cache', methods=['GET'])
+@login_required(role='admin')
+def get_prediction_cache_stats():
+    """Hit/miss counters of this worker's prediction cache."""
+    client = get_model_client()
+    if client.cache is None:
+        return jsonify({'enabled': False}), 200
+    return jsonify(client.cache.stats()), 200
+
+
+@app.route('/api/classifications', methods=['POST'])
+@login_required()
+def save_classification():
+    """Save classification results to database.
+
+    With CLASSIFICATION_WRITE_MODE=async (or ?async=true) the run is queued
+    for the background writer and the route answers 202 with its future id.
+    """
+    try:
+        data = request.get_json() or {}
         predictions = data.get('predictions', [])
-        username = data.get('username', 'Anonymous')
-        
-        if not predictions:
+        principal = current_principal()
+        # Trust the signed token over whatever username the body claims
+        username = principal['username'] if principal else data.get('username', 'Anonymous')
+
+        if not predictions or not isinstance(predictions, list):
             return jsonify({'error': 'No predictions provided'}), 400
 
-        # Create classification record
-        classification_record = {
-            'username': username,
-            'total_reviews': len(predictions),
-            'fraud_count': len([p for p in predictions if p.get('label') == 'Fraud']),
-            'legitimate_count': len([p for p in predictions if p.get('label') in ['Legitimate', 'Benign']]),
-            'predictions': predictions,
-            'created_at': datetime.utcnow()
-        }
+        created_at = datetime.utcnow()
+        if async_writes_enabled() or request.args.get('async', '').lower() in ('1', 'true'):
+            record = {'_id': ObjectId(), 'username': username, 'predictions': predictions,
+                      'created_at': created_at}
+            try:
+                outcome = ingest_queue.submit(record)
+            except QueueFull as e:
+                response = jsonify({'error': str(e)})
+                response.headers['Retry-After'] = '1'
+                return response, 503
+            return jsonify({
+                'message': 'Classification results queued',
+                'id': str(record['_id']),
+                'status': outcome,
+                'total_saved': len(predictions)
+            }), 202
+
+        db = get_db()
+        if db is None:
+            return jsonify({'error': 'Database connection failed'}), 500
+
+        # Summary goes to `classifications`, rows to `predictions`
+        classification_id = save_run(db, username, predictions, created_at)
+        try:
+            update_rollups(db, username, predictions, created_at)
+        except Exception as e:
+            # The run itself is saved; `python rollups.py rebuild` repairs the stats
+            rollup_failed(db, [classification_id], e, 'sync')
+        schedule_layouts(db, [classification_id])
+        http_cache.invalidate('classifications')
 
-        result = db.classifications.insert_one(classification_record)
-        
         return jsonify({
             'message': 'Classification results saved successfully',
-            'id': str(result.inserted_id),
+            'id': str(classification_id),
             'total_saved': len(predictions)
         }), 201
 
@@ -360,27 +610,178 @@ def save_classification():
 
 
 @app.route('/api/classifications', methods=['GET'])
+@login_required()
 def get_classifications():
-    """Get classification history. Optional query param: username."""
+    """Get classification history, newest first.
+
+    Optional query params: username, limit, cursor, fields, and summary=true
+    to leave out embedded prediction arrays from older runs.
+    """
     try:
         db = get_db()
         if db is None:
             return jsonify({'error': 'Database connection failed'}), 500
 
         username = request.args.get('username')
+        principal = current_principal()
+        if principal and principal['role'] != 'admin':
+            # Regular users only see their own history
+            username = principal['username']
         query = {}
         if username:
             query['username'] = username
 
-        cursor = db.classifications.find(query).sort('created_at', -1).limit(50)
-        results = []
-        for r in cursor:
-            r['_id'] = str(r.get('_id'))
-            if isinstance(r.get('created_at'), datetime):
-                r['created_at'] = r['created_at'].isoformat()
-            results.append(r)
+        return list_documents(db.classifications, query, heavy=['predictions'])
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/classifications/queue', methods=['GET'])
+@login_required(role='admin')
+def get_ingest_queue_status():
+    """Depth, lag and counters of this worker's write-behind queue."""
+    return jsonify(ingest_queue.status()), 200
+
+
+@app.route('/api/classifications/stats', methods=['GET'])
+@login_required()
+def get_classification_stats():
+    """Fraud statistics from pre-aggregated rollups.
+
+    Query params: scope (all|user|product|category), key, granularity
+    (hour|day), from, to (ISO 8601, UTC unless an offset is given; default
+    last 30 days), top.
+    """
+    try:
+        db = get_db()
+        if db is None:
+            return jsonify({'error': 'Database connection failed'}), 500
+
+        scope = request.args.get('scope', 'all')
+        key = request.args.get('key')
+        principal = current_principal()
+        if principal and principal['role'] != 'admin':
+            # Regular users only see their own numbers
+            scope, key = 'user', principal['username']
+        try:
+            end = parse_time(request.args.get('to'), None)
+            start = parse_time(request.args.get('from'), None)
+            top = min(max(int(request.args.get('top', 20)), 1), 200)
+            stats = query_stats(db, scope, key, request.args.get('granularity', 'day'), start, end, top)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        return jsonify(stats), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-        return jsonify(results), 200
+
+def visible_to(principal, classification):
+    """Whether the caller may read a run: admins and the owner (anonymous callers when allowed at all)."""
+    if principal is None or principal['role'] == 'admin':
+        return True
+    return classification.get('username') == principal['username']
+
+
+@app.route('/api/classifications/<classification_id>/predictions', methods=['GET'])
+@login_required()
+def get_classification_predictions(classification_id):
+    """Page through one run's predictions. Query params: after (seq), limit."""
+    try:
+        db = get_db()
+        if db is None:
+            return jsonify({'error': 'Database connection failed'}), 500
+
+        oid = parse_object_id(classification_id)
+        if oid is None:
+            return jsonify({'error': 'Invalid classification id'}), 400
+
+        try:
+            after = int(request.args.get('after', -1))
+            limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+        except ValueError:
+            return jsonify({'error': 'after and limit must be integers'}), 400
+        if after < -1:
+            return jsonify({'error': 'after must be -1 or a seq from next_after'}), 400
+
+        classification = db.classifications.find_one({'_id': oid}, page_projection(after, limit))
+        if not classification or not visible_to(current_principal(), classification):
+            # Other users' runs look missing, as in the history list
+            return jsonify({'error': 'Classification not found'}), 404
+
+        page, next_after = page_predictions(db, classification, after, limit, sliced=True)
+        return jsonify({
+            'classification_id': classification_id,
+            'total_reviews': classification.get('total_reviews'),
+            'predictions': page,
+            'next_after': next_after
+        }), 200
+    except ArchivedRunUnavailable as e:
+        return jsonify({'error': str(e)}), 410
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# Runs never change once saved, so built graphs can be reused across requests
+graph_cache = TTLCache(maxsize=int(os.environ.get('GRAPH_CACHE_SIZE', 16)), ttl=3600)
+
+
+@app.route('/api/graph/<classification_id>', methods=['GET'])
+@login_required()
+def get_review_graph(classification_id):
+    """Reviewer-product graph for one run, pruned to `max_nodes` (default 300).
+
+    Nodes carry precomputed x/y layout coordinates unless `layout=false`.
+    Layouts are computed when the run is saved; a large graph requested
+    before its layout is stored comes back without x/y and with
+    `layout.pending` (graph_layout.py).
+    """
+    try:
+        db = get_db()
+        if db is None:
+            return jsonify({'error': 'Database connection failed'}), 500
+
+        oid = parse_object_id(classification_id)
+        if oid is None:
+            return jsonify({'error': 'Invalid classification id'}), 400
+        try:
+            max_nodes = min(max(int(request.args.get('max_nodes', 300)), 1), 5000)
+        except ValueError:
+            return jsonify({'error': 'max_nodes must be an integer'}), 400
+
+        principal = current_principal()
+        cached = graph_cache.get(oid)
+        if cached is None:
+            classification = db.classifications.find_one(
+                {'_id': oid}, {'predictions': 1, 'status': 1, 'username': 1, 'storage': 1, 'archive': 1})
+            if not classification or not visible_to(principal, classification):
+                return jsonify({'error': 'Classification not found'}), 404
+            graph = ReviewGraph.from_predictions(db, classification)
+            if classification.get('status', 'complete') == 'complete':
+                graph_cache.set(oid, (graph, classification.get('username')))
+        else:
+            graph, username = cached
+            classification = {'_id': oid, 'username': username}
+            if not visible_to(principal, classification):
+                return jsonify({'error': 'Classification not found'}), 404
+
+        positions, layout = None, None
+        if request.args.get('layout', 'true').lower() not in ('0', 'false', 'no'):
+            positions, layout = get_layout(db, graph, classification)
+
+        nodes, edges = graph.subgraph(max_nodes, positions)
+        return jsonify({
+            'classification_id': classification_id,
+            'stats': graph.summary(),
+            'truncated': len(nodes) < graph.n_nodes,
+            'layout': layout,
+            'nodes': nodes,
+            'edges': edges
+        }), 200
+    except ArchivedRunUnavailable as e:
+        return jsonify({'error': str(e)}), 410
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -0,0 +1,122 @@
+"""Keyset (cursor) pagination for list endpoints.
+
+Lists are ordered newest first on (created_at, _id). The next page is
+selected with a range condition on that pair instead of skip(), so page
+1000 costs the same as page 1. The cursor handed to clients is an opaque
+url-safe token; it is returned in the `X-Next-Cursor` response header and
+is absent on the last page.
+
+Query parameters understood by `parse_page_args`:
+  limit    page size (default 50, max 500)
+  cursor   token from a previous response's X-Next-Cursor header
+  fields   comma separated list of fields to return
+  summary  true/1 to leave out heavy arrays (e.g. predictions)
+"""
+import base64
+import json
+from datetime import datetime
+
+from bson import ObjectId
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+CURSOR_HEADER = 'X-Next-Cursor'
+
+
+class PaginationError(ValueError):
+    """Bad limit/cursor/fields query parameters."""
+
+
+def encode_cursor(doc, sort_field='created_at'):
+    value = doc.get(sort_field)
+    payload = {
+        't': value.isoformat() if isinstance(value, datetime) else None,
+        'id': str(doc['_id']),
+    }
+    raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        ts = datetime.fromisoformat(payload['t']) if payload.get('t') else None
+        return ts, ObjectId(payload['id'])
+    except Exception:
+        raise PaginationError('Invalid cursor')
+
+
+def parse_page_args(args):
+    """Return (limit, cursor, fields, summary) from request.args."""
+    try:
+        limit = int(args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise PaginationError('limit must be an integer')
+    limit = min(max(limit, 1), MAX_LIMIT)
+
+    cursor = args.get('cursor')
+    cursor = decode_cursor(cursor) if cursor else None
+
+    fields = [f.strip() for f in (args.get('fields') or '').split(',') if f.strip()]
+    summary = (args.get('summary') or '').lower() in ('1', 'true', 'yes')
+    return limit, cursor, fields, summary
+
+
+def build_projection(fields=None, exclude=None, heavy=(), summary=False):
+    """Combine an explicit field list, always-hidden fields and summary mode."""
+    if fields:
+        projection = {f: 1 for f in fields if f not in (exclude or ())}
+        # The cursor needs these even when the caller did not ask for them
+        projection['created_at'] = 1
+        projection['_id'] = 1
+        return projection
+    hidden = list(exclude or ())
+    if summary:
+        hidden.extend(heavy)
+    return {f: 0 for f in hidden} or None
+
+
+def keyset_query(query, cursor, sort_field='created_at'):
+    if cursor is None:
+        return query
+    ts, oid = cursor
+    if ts is None:
+        after = {sort_field: None, '_id': {'$lt': oid}}
+    else:
+        # Documents without a timestamp sort after every dated document
+        after = {'$or': [
+            {sort_field: {'$lt': ts}},
+            {sort_field: ts, '_id': {'$lt': oid}},
+            {sort_field: None},
+        ]}
+    if not query:
+        return after
+    return {'$and': [query, after]}
+
+
+def find_page(collection, query, projection=None, limit=DEFAULT_LIMIT, cursor=None,
+              sort_field='created_at'):
+    """Return a cursor over one page (limit + 1 docs, to detect the next page)."""
+    return (collection.find(keyset_query(query, cursor, sort_field), projection)
+            .sort([(sort_field, -1), ('_id', -1)])
+            .limit(limit + 1))
+
+
+def split_page(docs, limit, sort_field='created_at'):
+    """Trim the look-ahead document and return (docs, next_cursor)."""
+    if len(docs) > limit:
+        docs = docs[:limit]
+        return docs, encode_cursor(docs[-1], sort_field)
+    return docs, None
+
+
+def find_all(collection, query, projection=None, cursor=None, limit=None, batch_size=500,
+             sort_field='created_at'):
+    """Cursor over everything after `cursor` in page order, fetched `batch_size` at a time."""
+    result = (collection.find(keyset_query(query, cursor, sort_field), projection)
+              .sort([(sort_field, -1), ('_id', -1)])
+              .batch_size(batch_size))
+    if limit:
+        result = result.limit(limit)
+    return result
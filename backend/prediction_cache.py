@@ -0,0 +1,153 @@
+"""Content-addressed cache of model predictions.
+
+Users often re-upload overlapping CSV exports. A row whose model inputs have
+not changed gets the same prediction again, so `/api/classify` looks each
+row up here first and sends only the misses to the model.
+
+The key is a SHA-256 of the feature columns the model reads
+(MODEL_FEATURE_COLUMNS), prefixed with MODEL_VERSION so a new model never
+serves stale answers. Identity columns (`_id`, `reviewerID`, `asin`) are
+part of the key because GE-GNN also uses them to build its review graph.
+
+Two tiers:
+  * an in-process LRU (PREDICTION_CACHE_SIZE entries);
+  * the `prediction_cache` collection, shared by every worker, whose
+    documents expire through a TTL index (PREDICTION_CACHE_TTL_SECONDS).
+
+Set PREDICTION_CACHE=false to disable caching.
+"""
+import hashlib
+import os
+import threading
+from datetime import datetime, timedelta
+
+from pymongo import ReplaceOne
+
+import db as _db
+from ttl_cache import TTLCache
+
+DEFAULT_FEATURE_COLUMNS = ('_id', 'reviewerID', 'asin', 'reviewText', 'summary', 'helpful',
+                           'overall', 'unixReviewTime', 'category', 'review_word_count')
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def cache_enabled():
+    return os.environ.get('PREDICTION_CACHE', 'true').lower() not in ('0', 'false', 'no')
+
+
+def model_version():
+    return os.environ.get('MODEL_VERSION', 'ge-gnn-v1')
+
+
+class PredictionCache:
+    def __init__(self, get_db=None):
+        self.get_db = get_db or _db.get_db
+        columns = os.environ.get('MODEL_FEATURE_COLUMNS')
+        self.columns = tuple(c.strip() for c in columns.split(',')) if columns else DEFAULT_FEATURE_COLUMNS
+        self.version = model_version()
+        self.ttl = _env_int('PREDICTION_CACHE_TTL_SECONDS', 7 * 24 * 3600)
+        self.memory = TTLCache(_env_int('PREDICTION_CACHE_SIZE', 100000), self.ttl)
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.store_errors = 0
+
+    def key(self, row):
+        h = hashlib.sha256()
+        for column in self.columns:
+            value = row.get(column)
+            h.update(('' if value is None else str(value).strip()).encode('utf-8'))
+            h.update(b'\x1f')
+        return f'{self.version}:{h.hexdigest()}'
+
+    def lookup(self, keys):
+        """Return {key: prediction} for every key found in either tier."""
+        found = {}
+        missing = []
+        for key in keys:
+            prediction = self.memory.get(key)
+            if prediction is not None:
+                found[key] = prediction
+            else:
+                missing.append(key)
+        memory_hits = len(keys) - len(missing)
+
+        store_hits = 0
+        if missing:
+            try:
+                database = self.get_db()
+                if database is not None:
+                    docs = database.prediction_cache.find(
+                        {'_id': {'$in': list(set(missing))}, 'expires_at': {'$gt': datetime.utcnow()}},
+                        {'prediction': 1})
+                    for doc in docs:
+                        found[doc['_id']] = doc['prediction']
+                        self.memory.set(doc['_id'], doc['prediction'])
+                    store_hits = sum(1 for key in missing if key in found)
+            except Exception as e:
+                # The cache is an optimization; fall through to the model
+                print(f"Prediction cache lookup failed: {str(e)}")
+                self.store_errors += 1
+
+        with self._lock:
+            self.memory_hits += memory_hits
+            self.store_hits += store_hits
+            self.misses += len(keys) - memory_hits - store_hits
+        return found
+
+    def store(self, items):
+        """Remember (key, prediction) pairs in both tiers."""
+        if not items:
+            return
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=self.ttl)
+        ops = {}
+        for key, prediction in items:
+            self.memory.set(key, prediction)
+            ops[key] = ReplaceOne({'_id': key}, {'prediction': prediction, 'model_version': self.version,
+                                                 'created_at': now, 'expires_at': expires_at}, upsert=True)
+        try:
+            database = self.get_db()
+            if database is not None:
+                database.prediction_cache.bulk_write(list(ops.values()), ordered=False)
+                with self._lock:
+                    self.stored += len(ops)
+        except Exception as e:
+            print(f"Prediction cache write failed: {str(e)}")
+            self.store_errors += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.store_hits + self.misses
+            return {
+                'enabled': cache_enabled(),
+                'model_version': self.version,
+                'memory_entries': len(self.memory),
+                'memory_hits': self.memory_hits,
+                'store_hits': self.store_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.memory_hits + self.store_hits) / lookups, 4) if lookups else None,
+                'stored': self.stored,
+                'store_errors': self.store_errors,
+            }
+
+
+_cache = None
+
+
+def get_prediction_cache():
+    """Process-wide cache, or None when PREDICTION_CACHE is off."""
+    global _cache
+    if not cache_enabled():
+        return None
+    if _cache is None:
+        _cache = PredictionCache()
+    return _cache
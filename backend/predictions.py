@@ -0,0 +1,341 @@
+"""Storage helpers for per-review predictions.
+
+A classification run is stored as a small summary document in
+`classifications` plus one document per prediction in `predictions`,
+linked by `classification_id` and ordered by `seq` (row position). This
+keeps large uploads under Mongo's 16 MB document limit and lets history
+reads skip the predictions entirely.
+
+Older runs move to cheaper tiers (retention.py), recorded in the summary's
+`storage` field:
+
+  (none)    rows in `predictions` (or, for the oldest runs, an embedded array)
+  compact   rows packed PREDICTION_BLOB_ROWS at a time into zlib-compressed
+            BSON blobs in `prediction_blobs`
+  archived  rows in a gzipped BSON file under RETENTION_ARCHIVE_DIR, one
+            gzip member per PREDICTION_BLOB_ROWS rows so reads can seek
+
+iter_run_predictions and page_predictions read every tier, so callers
+do not need to care where a run's rows are.
+"""
+import bisect
+import gzip
+import os
+import zlib
+from datetime import datetime
+
+import bson
+from bson import Binary, ObjectId
+from bson.errors import InvalidId
+
+FRAUD_LABELS = ('Fraud',)
+LEGITIMATE_LABELS = ('Legitimate', 'Benign')
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def insert_chunk_size():
+    try:
+        return max(1, int(os.environ.get('PREDICTION_INSERT_CHUNK', 1000)))
+    except ValueError:
+        return 1000
+
+
+def summarize(predictions):
+    """Count fraud / legitimate labels in a single pass."""
+    fraud = legitimate = 0
+    for p in predictions:
+        label = p.get('label') if isinstance(p, dict) else None
+        if label in FRAUD_LABELS:
+            fraud += 1
+        elif label in LEGITIMATE_LABELS:
+            legitimate += 1
+    return {'total_reviews': len(predictions), 'fraud_count': fraud, 'legitimate_count': legitimate}
+
+
+def parse_object_id(value):
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        return None
+
+
+def prediction_docs(classification_id, predictions, username=None, created_at=None):
+    """Yield the stored form of each prediction, numbered by row position."""
+    for seq, p in enumerate(predictions):
+        doc = dict(p) if isinstance(p, dict) else {'value': p}
+        # Keep the model's own `_id` (the review id) without clashing with ours
+        if '_id' in doc:
+            doc['review_id'] = doc.pop('_id')
+        doc['classification_id'] = classification_id
+        doc['seq'] = seq
+        doc['username'] = username
+        doc['created_at'] = created_at
+        yield doc
+
+
+def insert_docs(collection, docs):
+    """insert_many in unordered chunks of PREDICTION_INSERT_CHUNK; returns the count."""
+    chunk_size = insert_chunk_size()
+    written = 0
+    chunk = []
+    for doc in docs:
+        chunk.append(doc)
+        if len(chunk) >= chunk_size:
+            written += len(collection.insert_many(chunk, ordered=False).inserted_ids)
+            chunk = []
+    if chunk:
+        written += len(collection.insert_many(chunk, ordered=False).inserted_ids)
+    return written
+
+
+def insert_predictions(db, classification_id, predictions, username=None, created_at=None):
+    """Bulk insert predictions in unordered chunks; returns the number written."""
+    return insert_docs(db.predictions, prediction_docs(classification_id, predictions, username, created_at))
+
+
+def save_runs(db, runs):
+    """Write several classification runs with shared bulk writes; returns their ids.
+
+    Each run is a dict with `username`, `predictions` and optionally `_id`
+    and `created_at`. Summaries are marked `status: 'saving'` until every
+    prediction chunk is written so a half-saved run is never presented as
+    complete. On failure the partial predictions and summaries are removed
+    before the error propagates, so callers can safely retry.
+    """
+    summaries = []
+    for run in runs:
+        summary = {'_id': run.get('_id') or ObjectId(), 'username': run.get('username')}
+        summary.update(summarize(run['predictions']))
+        summary['status'] = 'saving'
+        summary['created_at'] = run.get('created_at') or datetime.utcnow()
+        summaries.append(summary)
+    ids = [s['_id'] for s in summaries]
+
+    def all_docs():
+        for run, summary in zip(runs, summaries):
+            yield from prediction_docs(summary['_id'], run['predictions'],
+                                       summary['username'], summary['created_at'])
+
+    try:
+        db.classifications.insert_many(summaries, ordered=False)
+        insert_docs(db.predictions, all_docs())
+    except Exception:
+        db.predictions.delete_many({'classification_id': {'$in': ids}})
+        db.classifications.delete_many({'_id': {'$in': ids}})
+        raise
+    db.classifications.update_many({'_id': {'$in': ids}},
+                                   {'$set': {'status': 'complete', 'updated_at': datetime.utcnow()}})
+    return ids
+
+
+def save_run(db, username, predictions, created_at=None):
+    """Write one classification summary and its predictions; returns the summary id."""
+    return save_runs(db, [{'username': username, 'predictions': predictions,
+                           'created_at': created_at}])[0]
+
+
+async def save_run_async(db, username, predictions, created_at=None):
+    """save_run on an async (motor) database (asgi_app.py); returns the summary id."""
+    summary = {'_id': ObjectId(), 'username': username}
+    summary.update(summarize(predictions))
+    summary['status'] = 'saving'
+    summary['created_at'] = created_at or datetime.utcnow()
+    chunk_size = insert_chunk_size()
+    try:
+        await db.classifications.insert_one(summary)
+        chunk = []
+        for doc in prediction_docs(summary['_id'], predictions, username, summary['created_at']):
+            chunk.append(doc)
+            if len(chunk) >= chunk_size:
+                await db.predictions.insert_many(chunk, ordered=False)
+                chunk = []
+        if chunk:
+            await db.predictions.insert_many(chunk, ordered=False)
+    except Exception:
+        await db.predictions.delete_many({'classification_id': summary['_id']})
+        await db.classifications.delete_one({'_id': summary['_id']})
+        raise
+    await db.classifications.update_one({'_id': summary['_id']},
+                                        {'$set': {'status': 'complete', 'updated_at': datetime.utcnow()}})
+    return summary['_id']
+
+
+# -- compacted and archived runs ---------------------------------------------
+
+# Repeated in every row of a run; dropped when rows are packed
+RUN_FIELDS = ('classification_id', 'username', 'created_at')
+BLOB_CODEC = 'bson+zlib'
+
+
+class ArchivedRunUnavailable(Exception):
+    """The run was archived to a file that is not present on this host."""
+
+
+def blob_rows():
+    return max(1, _env_int('PREDICTION_BLOB_ROWS', 5000))
+
+
+def archive_dir():
+    return os.environ.get('RETENTION_ARCHIVE_DIR') or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'archive')
+
+
+def strip_row(doc):
+    return {k: v for k, v in doc.items() if k not in RUN_FIELDS and k != '_id'}
+
+
+def pack_rows(rows):
+    return zlib.compress(bson.encode({'rows': rows}), _env_int('RETENTION_ZLIB_LEVEL', 6))
+
+
+def unpack_rows(data):
+    return bson.decode(zlib.decompress(data))['rows']
+
+
+def blob_docs(classification_id, rows):
+    """Yield `prediction_blobs` documents for an iterable of stripped rows."""
+    part, batch = 0, []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= blob_rows():
+            yield _blob(classification_id, part, batch)
+            part, batch = part + 1, []
+    if batch:
+        yield _blob(classification_id, part, batch)
+
+
+def _blob(classification_id, part, rows):
+    return {'classification_id': classification_id, 'part': part, 'codec': BLOB_CODEC,
+            'first_seq': rows[0]['seq'], 'last_seq': rows[-1]['seq'], 'count': len(rows),
+            'data': Binary(pack_rows(rows))}
+
+
+def iter_blob_rows(db, classification_id, after=-1):
+    blobs = db.prediction_blobs.find({'classification_id': classification_id, 'last_seq': {'$gt': after}},
+                                     {'data': 1}).sort('part', 1)
+    for blob in blobs:
+        for row in unpack_rows(blob['data']):
+            if row['seq'] > after:
+                yield row
+
+
+def archive_offset(blocks, after=-1):
+    """Byte offset of the archive member holding the first row after `after` (0: the file start).
+
+    `blocks` is the run's `archive.blocks`, [first_seq, offset] per gzip
+    member of rows; archives written without it are read from the start.
+    """
+    if not blocks:
+        return 0
+    i = bisect.bisect_right([first_seq for first_seq, _ in blocks], after + 1) - 1
+    return blocks[max(i, 0)][1]
+
+
+def iter_archive_rows(classification, after=-1):
+    archive = classification['archive']
+    path = os.path.join(archive_dir(), archive['file'])
+    try:
+        raw = open(path, 'rb')
+    except FileNotFoundError:
+        raise ArchivedRunUnavailable(f"Run {classification['_id']} is archived "
+                                     f"({archive['file']}) and its file is not on this host")
+    offset = archive_offset(archive.get('blocks'), after)
+    with raw:
+        raw.seek(offset)
+        # Each block is its own gzip member, so reading can start at any of them
+        with gzip.GzipFile(fileobj=raw, mode='rb') as f:
+            docs = bson.decode_file_iter(f)
+            if not offset:
+                next(docs, None)  # the summary
+            for row in docs:
+                if row['seq'] > after:
+                    yield row
+
+
+def _packed_rows(db, classification, after=-1):
+    if classification['storage'] == 'compact':
+        return iter_blob_rows(db, classification['_id'], after)
+    return iter_archive_rows(classification, after)
+
+
+def iter_run_predictions(db, classification, fields=None):
+    """Every stored prediction of a run in `seq` order, whatever its storage tier.
+
+    Rows keep the stored form (`review_id`, `seq`); `fields` limits what is
+    read from the `predictions` collection.
+    """
+    if classification.get('storage') in ('compact', 'archived'):
+        return _packed_rows(db, classification)
+    if isinstance(classification.get('predictions'), list):
+        return prediction_docs(classification['_id'], classification['predictions'])
+    projection = {f: 1 for f in fields} if fields else {}
+    projection['_id'] = 0
+    return db.predictions.find({'classification_id': classification['_id']},
+                               projection).sort('seq', 1).batch_size(5000)
+
+
+def page_projection(after=-1, limit=100):
+    """Projection for the run summary of a page read.
+
+    Only the fields paging needs, and only the page's part of a legacy
+    embedded array. Pass the result to page_predictions with `sliced=True`.
+    """
+    return {'username': 1, 'total_reviews': 1, 'storage': 1, 'archive': 1,
+            'predictions': {'$slice': [after + 1, limit + 1]}}
+
+
+def page_predictions(db, classification, after=-1, limit=100, sliced=False):
+    """Return (predictions, next_after) for one run, keyed on `seq`.
+
+    Runs saved before predictions moved to their own collection still carry
+    an embedded `predictions` array; those are sliced and given the `seq` the
+    other tiers store, so a row looks the same before and after retention
+    moves it. With `sliced`, the summary was read with page_projection and
+    the array already starts at the page. Compacted and archived runs are
+    decompressed as the page is read, starting at the blob or archive block
+    that holds `after`, so a page costs the same wherever it is in the run.
+    """
+    if classification.get('storage') in ('compact', 'archived'):
+        page = []
+        for row in _packed_rows(db, classification, after):
+            page.append(row)
+            if len(page) > limit:
+                break
+        next_after = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_after = page[-1]['seq']
+        for doc in page:
+            if 'review_id' in doc:
+                doc['_id'] = doc.pop('review_id')
+        return page, next_after
+
+    if isinstance(classification.get('predictions'), list):
+        start = after + 1
+        embedded = classification['predictions']
+        if not sliced:
+            embedded = embedded[start:start + limit + 1]
+        page = [dict(p, seq=seq) if isinstance(p, dict) else {'value': p, 'seq': seq}
+                for seq, p in enumerate(embedded[:limit], start)]
+        next_after = start + limit - 1 if len(embedded) > limit else None
+        return page, next_after
+
+    cursor = db.predictions.find(
+        {'classification_id': classification['_id'], 'seq': {'$gt': after}},
+        {'_id': 0, 'classification_id': 0, 'username': 0, 'created_at': 0},
+    ).sort('seq', 1).limit(limit + 1)
+    page = list(cursor)
+    next_after = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_after = page[-1]['seq']
+    for doc in page:
+        if 'review_id' in doc:
+            doc['_id'] = doc.pop('review_id')
+    return page, next_after
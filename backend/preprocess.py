@@ -0,0 +1,444 @@
+"""Feature matrix and relation graphs for GE-GNN, built with NumPy.
+
+Turns a review CSV (the schema Dashboard.js tests with) into:
+
+  features   float32 matrix, one row per review (see CONTINUOUS_FEATURES plus one
+             `category=<name>` column per frequent category)
+  relations  per-relation adjacency between reviews in CSR form
+             (indptr, indices):
+               user            R-U-R  same reviewerID
+               product_rating  R-S-R  same asin and same star rating
+               product_month   R-T-R  same asin, reviewed in the same month
+
+Everything after CSV parsing is column-wise NumPy; there are no Python loops
+over rows. Each relation links a review to the PREPROCESS_MAX_NEIGHBORS
+members of its group nearest in time on each side, computed from one sort
+and a few repeat/cumsum passes. The cap keeps a product with thousands of
+reviews from turning its group into an O(n^2) clique.
+
+Results are cached on disk under PREPROCESS_CACHE_DIR/<dataset hash>/ as
+plain .npy files loaded with mmap_mode='r', so every worker shares one copy
+through the page cache and a repeated upload skips all of this. After each
+build the least recently used datasets beyond PREPROCESS_CACHE_MAX_ENTRIES,
+and any unused for PREPROCESS_CACHE_MAX_AGE_HOURS, are removed.
+
+Usage:
+  python preprocess.py reviews.csv     # build (or load) and print a summary
+
+Configuration (environment variables):
+  PREPROCESS_CACHE_DIR            cache root (default backend/preprocess_cache)
+  PREPROCESS_MAX_NEIGHBORS        links per review, relation and side, 0 = whole group (default 50)
+  PREPROCESS_MAX_CATEGORIES       one-hot category columns (default 32)
+  PREPROCESS_CACHE_MAX_ENTRIES    datasets kept, 0 = no limit (default 32)
+  PREPROCESS_CACHE_MAX_AGE_HOURS  remove datasets unused for this long, 0 = never (default 168)
+"""
+import csv
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+from itertools import zip_longest
+
+import numpy as np
+
+PREPROCESS_VERSION = 'ge-gnn-pre-2'
+CONTINUOUS_FEATURES = (
+    'helpful_votes', 'helpful_total', 'helpful_ratio',
+    'overall', 'overall_vs_product', 'overall_vs_user',
+    'review_time', 'review_word_count',
+    'user_review_count', 'product_review_count',
+)
+RELATIONS = ('user', 'product_rating', 'product_month')
+# Carried through so predictions can be labelled like the remote model's
+IDENTITY_COLUMNS = ('_id', 'reviewerID', 'reviewerName', 'asin')
+CHUNK_SIZE = 1 << 20
+# Half-written builds (`.<key>.*` temp dirs) older than this are left over from a crash
+STALE_BUILD_SECONDS = 3600
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def cache_dir():
+    return os.environ.get('PREPROCESS_CACHE_DIR') or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'preprocess_cache')
+
+
+def _settings():
+    return {
+        'version': PREPROCESS_VERSION,
+        'max_neighbors': max(0, _env_int('PREPROCESS_MAX_NEIGHBORS', 50)),
+        'max_categories': max(0, _env_int('PREPROCESS_MAX_CATEGORIES', 32)),
+    }
+
+
+def dataset_key(chunks, settings=None):
+    """SHA-256 of the raw CSV bytes plus the settings that shape the output."""
+    h = hashlib.sha256(json.dumps(settings or _settings(), sort_keys=True).encode('utf-8'))
+    for chunk in chunks:
+        h.update(chunk)
+    return h.hexdigest()
+
+
+# -- parsing -------------------------------------------------------------------
+
+def read_columns(stream, encoding='utf-8-sig'):
+    """{column: unicode array} for a binary CSV stream; short rows are padded with ''."""
+    text = io.TextIOWrapper(stream, encoding=encoding, newline='')
+    try:
+        reader = csv.reader(text)
+        header = [name.strip() for name in next(reader, None) or []]
+        columns = list(zip_longest(*reader, fillvalue=''))
+    finally:
+        text.detach()  # leave the caller's file open
+    n = len(columns[0]) if columns else 0
+    return {name: np.asarray(columns[i], dtype=str) if i < len(columns) else np.full(n, '', dtype=str)
+            for i, name in enumerate(header)}
+
+
+def to_float(values):
+    """Parse a string array to float64; blanks and junk become NaN."""
+    values = np.char.strip(np.asarray(values, dtype=str))
+    values = np.where(values == '', 'nan', values)
+    try:
+        return values.astype(np.float64)
+    except ValueError:
+        # Only reached for malformed cells; parse the column one value at a time
+        def parse(v):
+            try:
+                return float(v)
+            except ValueError:
+                return np.nan
+        return np.fromiter((parse(v) for v in values), dtype=np.float64, count=len(values))
+
+
+def parse_helpful(values):
+    """Amazon's "[helpful, total]" vote pairs as two float arrays."""
+    if len(values) == 0:
+        return np.zeros(0), np.zeros(0)
+    parts = np.char.partition(np.char.strip(np.asarray(values, dtype=str), '[]() "'), ',')
+    return to_float(parts[:, 0]), to_float(parts[:, 2])
+
+
+def _codes(values):
+    """Integer codes for a string column; blanks get -1."""
+    values = np.char.strip(np.asarray(values, dtype=str))
+    uniques, codes = np.unique(values, return_inverse=True)
+    codes = codes.astype(np.int64)
+    blank = np.flatnonzero(uniques == '')
+    if len(blank):
+        codes[codes == blank[0]] = -1
+    return codes, uniques
+
+
+def _group_mean(codes, values):
+    """Per-row mean of `values` over rows sharing the same code (NaNs ignored)."""
+    valid = (codes >= 0) & ~np.isnan(values)
+    size = max(codes.max(initial=-1) + 1, 1)  # at least one slot, for all-blank columns
+    sums = np.bincount(codes[valid], weights=values[valid], minlength=size)
+    counts = np.bincount(codes[valid], minlength=size)
+    means = np.divide(sums, counts, out=np.full(size, np.nan), where=counts > 0)
+    return np.where(codes >= 0, means[np.maximum(codes, 0)], np.nan)
+
+
+def _group_size(codes):
+    counts = np.bincount(codes[codes >= 0], minlength=max(codes.max(initial=-1) + 1, 1))
+    return np.where(codes >= 0, counts[np.maximum(codes, 0)], 0)
+
+
+def _standardize(x):
+    """Z-score each column; missing values become the column mean (0 after scaling)."""
+    known = ~np.isnan(x)
+    means = np.where(known, x, 0).sum(axis=0) / np.maximum(known.sum(axis=0), 1)
+    x = np.where(known, x, means)
+    std = x.std(axis=0)
+    return (x - x.mean(axis=0)) / np.where(std > 0, std, 1.0)
+
+
+def build_features(columns, max_categories=32):
+    """(float32 matrix, column names) for the review columns."""
+    n = len(next(iter(columns.values()), []))
+    if n == 0:
+        # A header-only CSV
+        return np.zeros((0, len(CONTINUOUS_FEATURES)), dtype=np.float32), list(CONTINUOUS_FEATURES)
+    blank = np.full(n, '', dtype=str)
+    users, _ = _codes(columns.get('reviewerID', blank))
+    products, _ = _codes(columns.get('asin', blank))
+
+    votes, total = parse_helpful(columns.get('helpful', blank))
+    overall = to_float(columns.get('overall', blank))
+    words = to_float(columns.get('review_word_count', blank))
+    review_time = to_float(columns.get('unixReviewTime', blank))
+    continuous = np.stack([
+        votes,
+        total,
+        np.divide(votes, total, out=np.zeros(n), where=total > 0),
+        overall,
+        overall - _group_mean(products, overall),
+        overall - _group_mean(users, overall),
+        review_time,
+        np.log1p(np.maximum(words, 0)),
+        np.log1p(_group_size(users)),
+        np.log1p(_group_size(products)),
+    ], axis=1)
+    features = [_standardize(continuous)]
+    names = list(CONTINUOUS_FEATURES)
+
+    # One-hot for the most frequent categories; the rest share no column
+    categories, labels = _codes(columns.get('category', blank))
+    if max_categories and n and categories.max() >= 0:
+        counts = np.bincount(categories[categories >= 0], minlength=len(labels))
+        top = np.argsort(-counts, kind='stable')[:max_categories]
+        top = top[counts[top] > 0]
+        slot = np.full(len(labels) + 1, -1)
+        slot[top] = np.arange(len(top))
+        onehot = np.zeros((n, len(top)))
+        row_slot = slot[categories]  # categories == -1 picks the trailing -1
+        hit = row_slot >= 0
+        onehot[np.flatnonzero(hit), row_slot[hit]] = 1.0
+        features.append(onehot)
+        names.extend(f'category={labels[i]}' for i in top)
+    return np.ascontiguousarray(np.concatenate(features, axis=1), dtype=np.float32), names
+
+
+# -- relations -------------------------------------------------------------------
+
+def group_adjacency(groups, order_key=None, max_neighbors=0):
+    """CSR (indptr, indices) linking each row to the other rows of its group.
+
+    Rows with a negative group are left unlinked. Within a group, rows are
+    ordered by `order_key`. With `max_neighbors` > 0, each row links only to
+    the `max_neighbors` nearest rows on either side in that order.
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    n = len(groups)
+    if n == 0:
+        return np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32)
+    # Give unlinked rows a group of their own
+    top = groups.max() + 1
+    groups = np.where(groups < 0, top + np.arange(n), groups)
+
+    order = np.lexsort((order_key, groups)) if order_key is not None else np.argsort(groups, kind='stable')
+    sorted_groups = groups[order]
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    sizes = np.diff(np.r_[starts, n])
+    lo = np.repeat(starts, sizes)
+    hi = lo + np.repeat(sizes, sizes)
+    position = np.arange(n)
+    if max_neighbors:
+        lo = np.maximum(lo, position - max_neighbors)
+        hi = np.minimum(hi, position + max_neighbors + 1)
+
+    # Switch from sorted order to row order
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = position
+    counts = (hi - lo - 1)[rank]
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+
+    offset = np.arange(indptr[-1]) - np.repeat(indptr[:-1], counts)
+    neighbor = np.repeat(lo[rank], counts) + offset
+    neighbor += neighbor >= np.repeat(rank, counts)  # step over the row itself
+    index_type = np.int32 if n < 2 ** 31 else np.int64
+    return indptr, order[neighbor].astype(index_type)
+
+
+def _combine(a, b):
+    """One code per (a, b) pair; -1 if either side is missing."""
+    valid = (a >= 0) & (b >= 0)
+    return np.where(valid, a * (b.max() + 1 if len(b) else 1) + b, -1)
+
+
+def build_relations(columns, max_neighbors=0):
+    """{relation: (indptr, indices)} for the three GE-GNN review relations."""
+    n = len(next(iter(columns.values()), []))
+    if n == 0:
+        return {name: group_adjacency([]) for name in RELATIONS}
+    blank = np.full(n, '', dtype=str)
+    users, _ = _codes(columns.get('reviewerID', blank))
+    products, _ = _codes(columns.get('asin', blank))
+    review_time = to_float(columns.get('unixReviewTime', blank))
+    overall = to_float(columns.get('overall', blank))
+
+    known_time = ~np.isnan(review_time)
+    seconds = np.where(known_time, review_time, 0).astype(np.int64)
+    months = np.where(known_time, seconds.astype('datetime64[s]').astype('datetime64[M]').astype(np.int64), -1)
+    months = np.where(known_time, months - (months[known_time].min() if known_time.any() else 0), -1)
+    stars = np.where(np.isnan(overall), -1, np.rint(np.nan_to_num(overall))).astype(np.int64)
+
+    return {
+        'user': group_adjacency(users, seconds, max_neighbors),
+        'product_rating': group_adjacency(_combine(products, stars), seconds, max_neighbors),
+        'product_month': group_adjacency(_combine(products, months), seconds, max_neighbors),
+    }
+
+
+def to_scipy(indptr, indices, n):
+    """A scipy.sparse CSR matrix for one relation (scipy is optional)."""
+    from scipy.sparse import csr_matrix
+    return csr_matrix((np.ones(len(indices), dtype=np.float32), indices, indptr), shape=(n, n))
+
+
+# -- cache ------------------------------------------------------------------------
+
+class ReviewDataset:
+    """Preprocessed arrays for one CSV, usually memory-mapped from the cache."""
+
+    def __init__(self, key, identity, features, feature_names, relations, path=None):
+        self.key = key
+        self.identity = identity
+        self.features = features
+        self.feature_names = feature_names
+        self.relations = relations
+        self.path = path
+
+    def __len__(self):
+        return len(self.features)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+
+        def array(name):
+            return np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+
+        relations = {r: (array(f'{r}.indptr'), array(f'{r}.indices')) for r in meta['relations']}
+        identity = {c: array(f'identity.{c}') for c in IDENTITY_COLUMNS}
+        return cls(meta['key'], identity, array('features'), meta['feature_names'], relations, path)
+
+    def save(self, root):
+        """Write to root/<key>/ atomically; returns the loaded (memory-mapped) copy."""
+        final = os.path.join(root, self.key)
+        os.makedirs(root, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=f'.{self.key[:12]}.', dir=root)
+        try:
+            for column, values in self.identity.items():
+                np.save(os.path.join(tmp, f'identity.{column}.npy'), np.asarray(values, dtype=str))
+            np.save(os.path.join(tmp, 'features.npy'), self.features)
+            for name, (indptr, indices) in self.relations.items():
+                np.save(os.path.join(tmp, f'{name}.indptr.npy'), indptr)
+                np.save(os.path.join(tmp, f'{name}.indices.npy'), indices)
+            with open(os.path.join(tmp, 'meta.json'), 'w', encoding='utf-8') as f:
+                json.dump(self.summary(), f, indent=2)
+            os.rename(tmp, final)
+        except OSError:
+            # Another worker got there first (or the disk is full); theirs is as good
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.exists(os.path.join(final, 'meta.json')):
+                raise
+        return ReviewDataset.load(final)
+
+    def summary(self):
+        return {
+            'key': self.key,
+            'reviews': len(self),
+            'feature_names': list(self.feature_names),
+            'relations': list(self.relations),
+            'edges': {name: int(len(indices)) for name, (_, indices) in self.relations.items()},
+        }
+
+
+def build(stream, key):
+    """Parse a binary CSV stream and build the dataset (no caching)."""
+    settings = _settings()
+    columns = read_columns(stream)
+    n = len(next(iter(columns.values()), []))
+    identity = {c: columns.get(c, np.full(n, '', dtype=str)) for c in IDENTITY_COLUMNS}
+    features, names = build_features(columns, settings['max_categories'])
+    relations = build_relations(columns, settings['max_neighbors'])
+    return ReviewDataset(key, identity, features, names, relations)
+
+
+def _file_chunks(f):
+    f.seek(0)
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def prune_cache(root=None, keep=None):
+    """Remove cached datasets past the count and age limits; returns how many.
+
+    Entries are ranked by the mtime of their meta.json, which every cache
+    hit refreshes. Workers that still have a removed dataset memory-mapped
+    keep reading it until they let go (POSIX unlink semantics).
+    """
+    root = root or cache_dir()
+    max_entries = max(0, _env_int('PREPROCESS_CACHE_MAX_ENTRIES', 32))
+    max_age = max(0, _env_int('PREPROCESS_CACHE_MAX_AGE_HOURS', 168)) * 3600
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return 0
+    now = time.time()
+    entries, doomed = [], []
+    for name in names:
+        path = os.path.join(root, name)
+        try:
+            if name.startswith('.'):
+                if now - os.path.getmtime(path) > STALE_BUILD_SECONDS:
+                    doomed.append(name)
+                continue
+            entries.append((os.path.getmtime(os.path.join(path, 'meta.json')), name))
+        except OSError:
+            continue
+    entries.sort(reverse=True)
+    for rank, (used, name) in enumerate(entries):
+        if name != keep and ((max_entries and rank >= max_entries) or (max_age and now - used > max_age)):
+            doomed.append(name)
+    for name in doomed:
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+    if doomed:
+        print(f"Removed {len(doomed)} cached dataset(s) from {root}")
+    return len(doomed)
+
+
+def preprocess_file(f, root=None):
+    """Dataset for a seekable binary CSV file, from the cache when the same bytes were seen before."""
+    root = root or cache_dir()
+    key = dataset_key(_file_chunks(f))
+    cached = os.path.join(root, key)
+    try:
+        os.utime(os.path.join(cached, 'meta.json'))  # mark it recently used for prune_cache
+        return ReviewDataset.load(cached)
+    except FileNotFoundError:
+        pass  # not built yet, or just pruned
+    f.seek(0)
+    dataset = build(f, key).save(root)
+    prune_cache(root, keep=key)
+    return dataset
+
+
+def preprocess_path(path, root=None):
+    with open(path, 'rb') as f:
+        return preprocess_file(f, root)
+
+
+def preprocess_stream(stream, root=None):
+    """Dataset for an uploaded CSV stream; spools it to disk to hash it once."""
+    with tempfile.TemporaryFile() as spool:
+        shutil.copyfileobj(stream, spool, CHUNK_SIZE)
+        return preprocess_file(spool, root)
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    if len(sys.argv) != 2:
+        print('Usage: python preprocess.py reviews.csv')
+        sys.exit(1)
+    started = time.perf_counter()
+    dataset = preprocess_path(sys.argv[1])
+    print(json.dumps(dict(dataset.summary(), path=dataset.path,
+                          seconds=round(time.perf_counter() - started, 3)), indent=2))
@@ -0,0 +1,440 @@
+"""Admission control: per-user token buckets and a concurrency cap for expensive routes.
+
+Every request takes a token from the bucket of its route class for its
+user. The user is the token's username, or the client address for
+anonymous requests, so `login` is limited per address. Buckets refill
+continuously at `count/seconds` and hold up to `burst` tokens:
+
+  classify  POST /api/classify, POST /api/uploads/<id>/finalize
+  save      POST /api/classifications
+  upload    POST /api/uploads, PUT /api/uploads/<id>/chunk
+  login     POST /api/auth/login, POST /api/access-requests
+  default   every other route (OPTIONS and /metrics are never limited)
+
+`classify` and `save` requests also need one of RATE_LIMIT_MAX_CONCURRENT
+in-flight slots, counted across all workers on the host. A request with an
+empty bucket or no free slot is answered at once with 429 and
+`Retry-After`, before it touches Mongo or the model.
+
+State is a small fixed-size table in a shared memory-mapped file
+(RATE_LIMIT_STATE_PATH, under /dev/shm where available). It is guarded by
+an flock, so every gunicorn or uvicorn worker on the host sees the same
+buckets. An admission is a hash, a few struct reads and writes and one lock
+round trip: a few microseconds. Buckets whose users have gone quiet refill to
+full and their slots are reused, so the table never needs cleaning.
+In-flight counts are kept per worker pid, and counts of workers that have
+died are dropped, so a crash does not leak slots. Without fcntl (Windows)
+the table lives in process memory instead.
+
+Behind a reverse proxy every request arrives from the proxy's address, so
+anonymous clients would share one bucket. Set RATE_LIMIT_TRUSTED_PROXIES to
+the number of proxies in front of the app: the client address is then read
+from X-Forwarded-For, that many entries from the right (werkzeug's ProxyFix
+rule), in the Flask app and in asgi_app.py alike. Leave it at 0 when clients
+connect directly, or they can pick their own bucket with a forged header.
+
+Configuration (environment variables):
+  RATE_LIMIT_ENABLED          admission control on (default true)
+  RATE_LIMIT_CLASSIFY         count/seconds[:burst] per user (default 10/60:5)
+  RATE_LIMIT_SAVE             (default 30/60:10)
+  RATE_LIMIT_UPLOAD           (default 600/60:60)
+  RATE_LIMIT_LOGIN            per client address (default 20/60:10)
+  RATE_LIMIT_DEFAULT          (default 600/60:120)
+                              any of these set to `off` disables that bucket
+  RATE_LIMIT_MAX_CONCURRENT   in-flight classify/save requests per host, 0 = unlimited (default 8)
+  RATE_LIMIT_SLOTS            buckets in the shared table (default 8192)
+  RATE_LIMIT_STATE_PATH       shared state file (default /dev/shm/aegis-rate-limit-<PORT>)
+  RATE_LIMIT_TRUSTED_PROXIES  reverse proxies in front of the app whose X-Forwarded-For is trusted (default 0)
+"""
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: per-process state
+    fcntl = None
+
+from metrics import registry as metrics_registry
+
+LIMITS = {
+    'classify': ('RATE_LIMIT_CLASSIFY', '10/60:5'),
+    'save': ('RATE_LIMIT_SAVE', '30/60:10'),
+    'upload': ('RATE_LIMIT_UPLOAD', '600/60:60'),
+    'login': ('RATE_LIMIT_LOGIN', '20/60:10'),
+    'default': ('RATE_LIMIT_DEFAULT', '600/60:120'),
+}
+ROUTE_LIMITS = {
+    ('POST', '/api/classify'): 'classify',
+    ('POST', '/api/uploads/<upload_id>/finalize'): 'classify',
+    ('POST', '/api/classifications'): 'save',
+    ('POST', '/api/uploads'): 'upload',
+    ('PUT', '/api/uploads/<upload_id>/chunk'): 'upload',
+    ('POST', '/api/auth/login'): 'login',
+    ('POST', '/api/access-requests'): 'login',
+}
+GATED_LIMITS = ('classify', 'save')
+EXEMPT_RULES = ('/metrics',)
+
+MAGIC = b'AEGISRL1'
+HEADER = struct.Struct('<8sII')      # magic, bucket slots, worker slots
+BUCKET = struct.Struct('<Qdddd')     # key hash, tokens, updated, rate, burst
+WORKER = struct.Struct('<qq')        # pid, in-flight requests
+WORKER_SLOTS = 256
+PROBES = 8
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def rate_limit_enabled():
+    return os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+
+
+def parse_rate(spec):
+    """'count/seconds[:burst]' -> (tokens per second, burst), or None for 'off'."""
+    spec = (spec or '').strip().lower()
+    if spec in ('', '0', 'off', 'none'):
+        return None
+    rate, _, burst = spec.partition(':')
+    count, _, seconds = rate.partition('/')
+    count, seconds = float(count), float(seconds or 1)
+    burst = float(burst) if burst else count
+    if count <= 0 or seconds <= 0 or burst < 1:
+        raise ValueError(f'Invalid rate limit {spec!r}')
+    return count / seconds, burst
+
+
+def _hash(key):
+    # Stable across processes, unlike hash(); 0 marks an empty slot
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class RateLimited(Exception):
+    def __init__(self, limit, retry_after):
+        super().__init__('Too many requests')
+        self.limit = limit
+        self.retry_after = retry_after
+
+    def headers(self):
+        return {'Retry-After': str(max(1, math.ceil(self.retry_after)))}
+
+    def body(self):
+        return {'error': str(self), 'limit': self.limit, 'retry_after': round(self.retry_after, 3)}
+
+
+class Admission:
+    """A granted request; release() it when the request ends."""
+    __slots__ = ('limiter', 'key', 'limit', 'gated')
+
+    def __init__(self, limiter, key, limit, gated):
+        self.limiter = limiter
+        self.key = key
+        self.limit = limit
+        self.gated = gated
+
+    def release(self, refund=False):
+        """Give back the concurrency slot, and with `refund` the bucket token too."""
+        if self.gated:
+            self.gated = False
+            self.limiter.release()
+        if refund and self.key is not None:
+            self.limiter.refund(self.key, self.limit)
+            self.key = None
+
+
+class RateLimiter:
+    def __init__(self, path=None):
+        self.path = path
+        self._pid = None
+        self._buf = None
+        self._fd = None
+        self._worker_index = None
+        self._lock = threading.Lock()
+        self._config = None
+
+    # -- configuration -----------------------------------------------------
+
+    def config(self):
+        if self._config is None:
+            limits = {}
+            for name, (env, default) in LIMITS.items():
+                try:
+                    limits[name] = parse_rate(os.environ.get(env, default))
+                except ValueError as e:
+                    print(f"{e}; using {env}={default}")
+                    limits[name] = parse_rate(default)
+            self._config = {
+                'limits': limits,
+                'max_concurrent': max(0, _env_int('RATE_LIMIT_MAX_CONCURRENT', 8)),
+                'slots': max(PROBES, _env_int('RATE_LIMIT_SLOTS', 8192)),
+            }
+        return self._config
+
+    # -- shared table ------------------------------------------------------
+
+    def state_path(self):
+        if self.path:
+            return self.path
+        if os.environ.get('RATE_LIMIT_STATE_PATH'):
+            return os.environ['RATE_LIMIT_STATE_PATH']
+        directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        return os.path.join(directory, f"aegis-rate-limit-{os.environ.get('PORT', '5000')}")
+
+    def _open(self):
+        """Map the shared table for this process (again after a fork, like db.MongoManager)."""
+        slots = self.config()['slots']
+        size = HEADER.size + slots * BUCKET.size + WORKER_SLOTS * WORKER.size
+        self._close()
+        self._pid = os.getpid()
+        self._worker_index = None
+        if fcntl is not None:
+            try:
+                fd = os.open(self.state_path(), os.O_RDWR | os.O_CREAT, 0o600)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    if os.fstat(fd).st_size != size or os.pread(fd, HEADER.size, 0) != HEADER.pack(
+                            MAGIC, slots, WORKER_SLOTS):
+                        # New file, or one laid out for other settings: start empty
+                        os.ftruncate(fd, 0)
+                        os.ftruncate(fd, size)
+                        os.pwrite(fd, HEADER.pack(MAGIC, slots, WORKER_SLOTS), 0)
+                    self._buf = mmap.mmap(fd, size)
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                self._fd = fd
+                return
+            except OSError as e:
+                print(f"Rate limiter state is per process: could not map {self.state_path()}: {str(e)}")
+        self._buf = bytearray(size)
+        HEADER.pack_into(self._buf, 0, MAGIC, slots, WORKER_SLOTS)
+
+    def _close(self):
+        # After a fork the inherited descriptor shares its flock with the parent, so drop it
+        if self._fd is not None:
+            try:
+                self._buf.close()
+            finally:
+                os.close(self._fd)
+        self._buf = None
+        self._fd = None
+
+    def _acquire_table(self):
+        self._lock.acquire()
+        if self._pid != os.getpid():
+            self._open()
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self._buf
+
+    def _release_table(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+    def _find(self, buf, h, now):
+        """Offset of the bucket for `h`, and whether it already existed."""
+        slots = self.config()['slots']
+        base = h % slots
+        free = victim = None
+        oldest = float('inf')
+        for i in range(PROBES):
+            offset = HEADER.size + ((base + i) % slots) * BUCKET.size
+            key, tokens, updated, rate, burst = BUCKET.unpack_from(buf, offset)
+            if key == h:
+                return offset, True
+            if free is None and (key == 0 or tokens + (now - updated) * rate >= burst):
+                # Empty, or refilled to full: the same as a fresh bucket
+                free = offset
+            elif updated < oldest:
+                victim, oldest = offset, updated
+        return (free if free is not None else victim), False
+
+    # -- buckets and slots ---------------------------------------------------
+
+    def take(self, key, limit):
+        """Take one token; returns 0 when granted, else seconds until one is available."""
+        rate, burst = limit
+        h = _hash(key)
+        now = time.time()
+        buf = self._acquire_table()
+        try:
+            offset, existing = self._find(buf, h, now)
+            if existing:
+                _, tokens, updated, _, _ = BUCKET.unpack_from(buf, offset)
+                tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            else:
+                tokens = burst
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            BUCKET.pack_into(buf, offset, h, tokens, now, rate, burst)
+            return wait
+        finally:
+            self._release_table()
+
+    def refund(self, key, limit):
+        rate, burst = limit
+        h = _hash(key)
+        buf = self._acquire_table()
+        try:
+            offset, existing = self._find(buf, h, time.time())
+            if existing:
+                _, tokens, updated, _, _ = BUCKET.unpack_from(buf, offset)
+                BUCKET.pack_into(buf, offset, h, min(burst, tokens + 1), updated, rate, burst)
+        finally:
+            self._release_table()
+
+    def _worker_offset(self, buf, pid):
+        base = HEADER.size + self.config()['slots'] * BUCKET.size
+        if self._worker_index is not None:
+            offset = base + self._worker_index * WORKER.size
+            if WORKER.unpack_from(buf, offset)[0] == pid:
+                return offset
+        claim = None
+        for i in range(WORKER_SLOTS):
+            offset = base + i * WORKER.size
+            slot_pid, _ = WORKER.unpack_from(buf, offset)
+            if slot_pid == pid:
+                self._worker_index = i
+                return offset
+            if claim is None and (slot_pid == 0 or not _alive(slot_pid)):
+                claim = i
+        if claim is None:
+            return None
+        self._worker_index = claim
+        offset = base + claim * WORKER.size
+        WORKER.pack_into(buf, offset, pid, 0)
+        return offset
+
+    def acquire(self, max_concurrent):
+        """Claim an in-flight slot on this host; False when all are taken."""
+        pid = os.getpid()
+        buf = self._acquire_table()
+        try:
+            mine = self._worker_offset(buf, pid)
+            if mine is None:
+                return True  # more workers than the table tracks: do not gate
+            base = HEADER.size + self.config()['slots'] * BUCKET.size
+            total = 0
+            for i in range(WORKER_SLOTS):
+                offset = base + i * WORKER.size
+                slot_pid, count = WORKER.unpack_from(buf, offset)
+                if count <= 0:
+                    continue
+                if slot_pid != pid and not _alive(slot_pid):
+                    WORKER.pack_into(buf, offset, slot_pid, 0)
+                    continue
+                total += count
+            if total >= max_concurrent:
+                return False
+            WORKER.pack_into(buf, mine, pid, WORKER.unpack_from(buf, mine)[1] + 1)
+            return True
+        finally:
+            self._release_table()
+
+    def release(self):
+        pid = os.getpid()
+        buf = self._acquire_table()
+        try:
+            mine = self._worker_offset(buf, pid)
+            if mine is not None:
+                WORKER.pack_into(buf, mine, pid, max(0, WORKER.unpack_from(buf, mine)[1] - 1))
+        finally:
+            self._release_table()
+
+    # -- admission ---------------------------------------------------------
+
+    def admit(self, method, rule, identity):
+        """Admission for one request, or raise RateLimited."""
+        if method == 'OPTIONS' or rule in EXEMPT_RULES:
+            return None
+        config = self.config()
+        name = ROUTE_LIMITS.get((method, rule), 'default')
+        limit = config['limits'][name]
+        key = None
+        if limit is not None:
+            key = f'{name}:{identity}'
+            wait = self.take(key, limit)
+            if wait:
+                metrics_registry.rate_limited.inc((name, 'rate'))
+                raise RateLimited(name, wait)
+        gated = name in GATED_LIMITS and config['max_concurrent'] > 0
+        if gated and not self.acquire(config['max_concurrent']):
+            if key is not None:
+                self.refund(key, limit)
+            metrics_registry.rate_limited.inc((name, 'concurrency'))
+            raise RateLimited(name, 1.0)
+        return Admission(self, key, limit, gated)
+
+
+limiter = RateLimiter()
+
+
+def trusted_proxies():
+    return max(0, _env_int('RATE_LIMIT_TRUSTED_PROXIES', 0))
+
+
+def client_address(address, forwarded_for):
+    """The client address behind RATE_LIMIT_TRUSTED_PROXIES proxies, as ProxyFix(x_for=n) reads it."""
+    trusted = trusted_proxies()
+    if not trusted or not forwarded_for:
+        return address
+    values = [value.strip() for value in forwarded_for.split(',')]
+    return values[-trusted] if len(values) >= trusted else address
+
+
+def identity(principal, address):
+    """Bucket owner: the signed-in user, else the client address."""
+    return f"user:{principal['username']}" if principal else f'addr:{address}'
+
+
+def install(app):
+    """Admission control for every route of the Flask `app`."""
+    if trusted_proxies():
+        from werkzeug.middleware.proxy_fix import ProxyFix
+
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=trusted_proxies())
+    if not rate_limit_enabled():
+        return
+    from flask import g, jsonify, request
+
+    from auth import current_principal
+
+    @app.before_request
+    def admit_request():
+        if request.url_rule is None:
+            return None
+        try:
+            g.admission = limiter.admit(request.method, request.url_rule.rule,
+                                        identity(current_principal(), request.remote_addr))
+        except RateLimited as e:
+            return jsonify(e.body()), 429, e.headers()
+        return None
+
+    @app.teardown_request
+    def release_admission(error=None):
+        admission = g.pop('admission', None)
+        if admission is not None:
+            admission.release()
@@ -0,0 +1,338 @@
+"""Tiered retention for classification runs.
+
+Runs move down tiers by age (`created_at`); summaries always stay in
+`classifications`, so history, stats and rollups are unaffected:
+
+  hot       newer than RETENTION_HOT_DAYS: rows in `predictions`, untouched
+  compact   rows packed into zlib-compressed BSON blobs in `prediction_blobs`
+            (predictions.py); legacy embedded arrays are moved there too
+  archived  older than RETENTION_ARCHIVE_DAYS (off unless set): rows written to
+            a gzipped BSON file under RETENTION_ARCHIVE_DIR and removed from MongoDB
+
+Prediction pages, review graphs and `rollups.py rebuild` read every tier
+transparently (predictions.iter_run_predictions). Archived runs can only be
+read on the host that holds their file; elsewhere those reads answer 410.
+`restore` brings archived runs back to the compact tier for good: they are
+stamped `restored_at` and the job never archives them again (unset the
+field to let it).
+
+Each step is written before the data it replaces is deleted, and the run is
+only stamped `compacted_at` / `archived_at` at the end. An interrupted job
+leaves every run readable, and the next job finishes what was left. Run one
+job at a time (e.g. nightly from cron). Freed space is reused by MongoDB
+for new documents; run `compact` on the collections to return it to the OS.
+
+Usage:
+  python retention.py run [--dry-run] [--hot-days 30] [--archive-days 365] [--limit 500]
+  python retention.py status
+  python retention.py restore <classification_id> [<classification_id> ...]
+
+Configuration (environment variables):
+  RETENTION_HOT_DAYS       runs newer than this are left alone (default 30)
+  RETENTION_ARCHIVE_DAYS   archive runs older than this, 0 = never (default 0)
+  RETENTION_ARCHIVE_DIR    archive files (default backend/archive)
+  PREDICTION_BLOB_ROWS     rows per compressed blob (default 5000)
+  RETENTION_ZLIB_LEVEL     1-9 (default 6)
+"""
+import argparse
+import gzip
+import os
+import sys
+from datetime import datetime, timedelta
+
+import bson
+
+from predictions import (archive_dir, blob_docs, blob_rows, iter_archive_rows, iter_run_predictions,
+                         parse_object_id, strip_row)
+
+COLLECTIONS = ('classifications', 'predictions', 'prediction_blobs')
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _size(doc):
+    return len(bson.encode(doc))
+
+
+def _candidates(db, query, limit):
+    """Ids of matching runs, oldest first (embedded arrays are only loaded one run at a time)."""
+    cursor = db.classifications.find(query, {'_id': 1}).sort('created_at', 1)
+    if limit:
+        cursor = cursor.limit(limit)
+    return [doc['_id'] for doc in cursor]
+
+
+def _mongo_bytes(db, run):
+    """Logical BSON size of a run's predictions as currently stored in MongoDB."""
+    if isinstance(run.get('predictions'), list):
+        return _size({'predictions': run['predictions']})
+    if run.get('storage') == 'compact':
+        return run.get('stored_bytes', 0)
+    return sum(_size(doc) for doc in db.predictions.find({'classification_id': run['_id']}))
+
+
+# -- compact ----------------------------------------------------------------
+
+def compact_run(db, run, dry_run=False):
+    """Pack one run's rows into compressed blobs; returns (bytes before, bytes after, rows)."""
+    now = datetime.utcnow()
+    if run.get('storage') == 'compact':
+        # An earlier job wrote the blobs but stopped before removing the rows
+        before = _mongo_bytes(db, dict(run, storage=None))
+        after, rows = run.get('stored_bytes', 0), run.get('total_reviews', 0)
+    else:
+        legacy = isinstance(run.get('predictions'), list)
+        counts = {'before': _size({'predictions': run['predictions']}) if legacy else 0, 'rows': 0}
+
+        def rows_to_pack():
+            for doc in iter_run_predictions(db, run):
+                if not legacy:
+                    counts['before'] += _size(doc)
+                counts['rows'] += 1
+                yield strip_row(doc)
+
+        if not dry_run:
+            # Leftovers of an interrupted job
+            db.prediction_blobs.delete_many({'classification_id': run['_id']})
+        after = 0
+        for blob in blob_docs(run['_id'], rows_to_pack()):
+            after += _size(blob)
+            if not dry_run:
+                db.prediction_blobs.insert_one(blob)
+        before, rows = counts['before'], counts['rows']
+        if not dry_run:
+            db.classifications.update_one({'_id': run['_id']}, {
+                '$set': {'storage': 'compact', 'stored_bytes': after, 'updated_at': now},
+                '$unset': {'predictions': ''}})
+    if dry_run:
+        return before, after, rows
+    db.predictions.delete_many({'classification_id': run['_id']})
+    db.classifications.update_one({'_id': run['_id']}, {'$set': {'compacted_at': now}})
+    return before, after, rows
+
+
+# -- archive ----------------------------------------------------------------
+
+def archive_path(run):
+    created = run['created_at']
+    return os.path.join(f'{created:%Y}', f'{created:%m}', f"{run['_id']}.bson.gz")
+
+
+def write_archive(db, run, relative):
+    """Write the summary and every row to a gzipped BSON file; returns (bytes, rows, blocks).
+
+    The summary and each PREDICTION_BLOB_ROWS rows are separate gzip members;
+    `blocks` lists [first seq, byte offset] per row member so page reads can
+    seek to the one they need (predictions.iter_archive_rows).
+    """
+    path = os.path.join(archive_dir(), relative)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    level = _env_int('RETENTION_ZLIB_LEVEL', 6)
+    rows, blocks = 0, []
+    with open(tmp, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=level) as f:
+            f.write(bson.encode({k: v for k, v in run.items() if k != 'predictions'}))
+        f = None
+        for doc in iter_run_predictions(db, run):
+            row = strip_row(doc)
+            if f is None:
+                blocks.append([row['seq'], raw.tell()])
+                f = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=level)
+            f.write(bson.encode(row))
+            rows += 1
+            if rows % blob_rows() == 0:
+                f.close()
+                f = None
+        if f is not None:
+            f.close()
+        raw.flush()
+        os.fsync(raw.fileno())
+    if run.get('total_reviews') is not None and rows != run['total_reviews']:
+        os.remove(tmp)
+        raise ValueError(f"read {rows} rows but the summary counts {run['total_reviews']}")
+    os.replace(tmp, path)
+    return os.path.getsize(path), rows, blocks
+
+
+def archive_run(db, run, dry_run=False):
+    """Move one run's rows to an archive file; returns (bytes before, bytes after, rows)."""
+    now = datetime.utcnow()
+    rows = run.get('total_reviews', 0)
+    if run.get('storage') == 'archived':
+        # An earlier job wrote the file but stopped before removing the rows
+        before = sum(_size(doc) for doc in db.prediction_blobs.find({'classification_id': run['_id']}))
+        before += sum(_size(doc) for doc in db.predictions.find({'classification_id': run['_id']}))
+    else:
+        before = _mongo_bytes(db, run)
+    if dry_run:
+        return before, 0, rows
+    if run.get('storage') != 'archived':
+        relative = archive_path(run)
+        size, rows, blocks = write_archive(db, run, relative)
+        db.classifications.update_one({'_id': run['_id']}, {
+            '$set': {'storage': 'archived', 'stored_bytes': 0, 'updated_at': now,
+                     'archive': {'file': relative, 'bytes': size, 'rows': rows, 'blocks': blocks}},
+            '$unset': {'predictions': ''}})
+    db.prediction_blobs.delete_many({'classification_id': run['_id']})
+    db.predictions.delete_many({'classification_id': run['_id']})
+    db.classifications.update_one({'_id': run['_id']}, {'$set': {'archived_at': now}})
+    return before, 0, rows
+
+
+def restore_run(db, run):
+    """Load an archived run back into the compact tier and remove its file.
+
+    The run is stamped `restored_at`, which keeps later jobs from archiving
+    it again.
+    """
+    if run.get('storage') != 'archived':
+        raise ValueError('not archived')
+    db.prediction_blobs.delete_many({'classification_id': run['_id']})
+    stored = 0
+    for blob in blob_docs(run['_id'], iter_archive_rows(run)):
+        stored += _size(blob)
+        db.prediction_blobs.insert_one(blob)
+    now = datetime.utcnow()
+    db.classifications.update_one({'_id': run['_id']}, {
+        '$set': {'storage': 'compact', 'stored_bytes': stored, 'compacted_at': now, 'restored_at': now,
+                 'updated_at': now},
+        '$unset': {'archive': '', 'archived_at': ''}})
+    os.remove(os.path.join(archive_dir(), run['archive']['file']))
+    return stored
+
+
+# -- job --------------------------------------------------------------------
+
+def run_job(db, hot_days=None, archive_days=None, limit=0, dry_run=False):
+    """Archive, then compact, every run past its tier's age; returns a report dict."""
+    hot_days = _env_int('RETENTION_HOT_DAYS', 30) if hot_days is None else hot_days
+    archive_days = _env_int('RETENTION_ARCHIVE_DAYS', 0) if archive_days is None else archive_days
+    if archive_days and archive_days < hot_days:
+        raise ValueError('archive days must not be less than hot days')
+    now = datetime.utcnow()
+    report = {'dry_run': dry_run, 'hot_days': hot_days, 'archive_days': archive_days,
+              'archived': 0, 'compacted': 0, 'rows': 0, 'bytes_before': 0, 'bytes_after': 0, 'failed': []}
+
+    steps = []
+    if archive_days:
+        steps.append(('archived', archive_run, {
+            'created_at': {'$lt': now - timedelta(days=archive_days)},
+            'status': {'$ne': 'saving'}, 'archived_at': {'$exists': False}, 'restored_at': {'$exists': False}}))
+    steps.append(('compacted', compact_run, {
+        'created_at': {'$lt': now - timedelta(days=hot_days)},
+        'status': {'$ne': 'saving'}, 'compacted_at': {'$exists': False}, 'storage': {'$ne': 'archived'}}))
+
+    handled = set()
+    for key, step, query in steps:
+        for run_id in _candidates(db, query, limit):
+            run = db.classifications.find_one({'_id': run_id}) if run_id not in handled else None
+            if run is None:
+                continue
+            # A dry run leaves archived runs unmarked, so they would be counted again
+            handled.add(run_id)
+            try:
+                before, after, rows = step(db, run, dry_run)
+            except Exception as e:
+                print(f"  {run_id}: {key[:-1]} failed: {str(e)}")
+                report['failed'].append({'id': str(run_id), 'step': key, 'error': str(e)})
+                continue
+            report[key] += 1
+            report['rows'] += rows
+            report['bytes_before'] += before
+            report['bytes_after'] += after
+            print(f"  {run_id} {run['created_at']:%Y-%m-%d} {key:<10} {rows:>8} rows  "
+                  f"{before:>12} -> {after:>10} bytes")
+
+    report['bytes_reclaimed'] = report['bytes_before'] - report['bytes_after']
+    if not dry_run and (report['archived'] or report['compacted']):
+        from http_cache import invalidate
+        invalidate('classifications')
+    return report
+
+
+def print_report(report):
+    verb = 'Would reclaim' if report['dry_run'] else 'Reclaimed'
+    before = report['bytes_before']
+    share = f" ({report['bytes_reclaimed'] / before:.0%})" if before else ''
+    print(f"\n{'Dry run: ' if report['dry_run'] else ''}{report['archived']} archived, "
+          f"{report['compacted']} compacted, {report['rows']} rows, {len(report['failed'])} failed")
+    print(f"{verb} {report['bytes_reclaimed']} of {before} bytes of prediction data{share}")
+
+
+def status(db):
+    """Runs per storage tier and collection sizes."""
+    tiers = {
+        'hot': db.classifications.count_documents({'storage': {'$exists': False}}),
+        'compact': db.classifications.count_documents({'storage': 'compact'}),
+        'archived': db.classifications.count_documents({'storage': 'archived'}),
+    }
+    sizes = {}
+    for name in COLLECTIONS:
+        try:
+            stats = db.command('collStats', name)
+            sizes[name] = {'documents': stats.get('count', 0), 'data_bytes': stats.get('size', 0),
+                           'storage_bytes': stats.get('storageSize', 0)}
+        except Exception:
+            sizes[name] = {'documents': db[name].estimated_document_count()}
+    return {'runs': tiers, 'collections': sizes}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compact and archive old classification runs.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    run_parser = sub.add_parser('run', help='apply the retention tiers')
+    run_parser.add_argument('--hot-days', type=int, help='default RETENTION_HOT_DAYS or 30')
+    run_parser.add_argument('--archive-days', type=int, help='default RETENTION_ARCHIVE_DAYS or 0 (never)')
+    run_parser.add_argument('--limit', type=int, default=0, help='runs per tier in this job, 0 = all')
+    run_parser.add_argument('--dry-run', action='store_true', help='report what would change')
+    sub.add_parser('status', help='runs per tier and collection sizes')
+    restore_parser = sub.add_parser('restore', help='bring archived runs back to the compact tier')
+    restore_parser.add_argument('ids', nargs='+')
+    args = parser.parse_args(argv)
+
+    from db import manager
+    if not manager.url:
+        print('MONGO_URL not set in backend/.env or environment')
+        return 1
+    db = manager.get_db()
+    if db is None:
+        print('Could not connect to MongoDB. Run test_mongo.py for details.')
+        return 1
+
+    if args.command == 'status':
+        info = status(db)
+        print('Runs: ' + ', '.join(f'{tier} {n}' for tier, n in info['runs'].items()))
+        for name, sizes in info['collections'].items():
+            print(f'{name:<18} ' + '  '.join(f'{k} {v}' for k, v in sizes.items()))
+        return 0
+
+    if args.command == 'restore':
+        failed = 0
+        for value in args.ids:
+            oid = parse_object_id(value)
+            run = db.classifications.find_one({'_id': oid}) if oid else None
+            try:
+                if run is None:
+                    raise ValueError('not found')
+                print(f'{value}: restored ({restore_run(db, run)} bytes in prediction_blobs)')
+            except Exception as e:
+                print(f'{value}: {str(e)}')
+                failed += 1
+        return 1 if failed else 0
+
+    try:
+        report = run_job(db, args.hot_days, args.archive_days, args.limit, args.dry_run)
+    except ValueError as e:
+        parser.error(str(e))
+    print_report(report)
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
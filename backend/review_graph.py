@@ -0,0 +1,166 @@
+"""Reviewer-product graph for one classification run, built with NumPy.
+
+The run's predictions become a bipartite graph: reviewers (`reviewerID`) on
+one side, products (`asin`) on the other, with one weighted edge per
+reviewer-product pair. Adjacency is kept as CSR arrays (indptr, indices,
+weights), and all per-node statistics are vectorized:
+
+  degree            distinct neighbours
+  reviews           reviews touching the node
+  fraud_score       mean fraud probability of the node's reviews
+  fraud_neighbors   neighbours whose own fraud_score >= 0.5
+  fraud_neighbor_ratio
+
+`/api/graph/<classification_id>` returns a subgraph pruned to a node budget,
+ranked by fraud score and then degree, so the browser only has to draw a
+few hundred nodes whatever the run size.
+"""
+import numpy as np
+
+from predictions import iter_run_predictions
+
+FRAUD_THRESHOLD = 0.5
+REVIEWER_FIELDS = ('reviewerID', 'reviewerId', 'reviewer_id')
+PREDICTION_FIELDS = REVIEWER_FIELDS + ('asin', 'label', 'confidence', 'fraud_probability')
+
+
+def fraud_probability(p):
+    """Probability that a review is fraud, from whatever the model returned."""
+    value = p.get('fraud_probability')
+    if value is not None:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            pass
+    try:
+        confidence = float(p.get('confidence'))
+    except (TypeError, ValueError):
+        return 1.0 if p.get('label') == 'Fraud' else 0.0
+    return confidence if p.get('label') == 'Fraud' else 1.0 - confidence
+
+
+def load_edges(db, classification):
+    """Return (reviewer ids, product ids, fraud scores) for one run's predictions."""
+    source = iter_run_predictions(db, classification, PREDICTION_FIELDS)
+
+    reviewers, products, scores = [], [], []
+    for p in source:
+        reviewer = next((p[f] for f in REVIEWER_FIELDS if p.get(f)), None)
+        product = p.get('asin')
+        if reviewer is None or product is None:
+            continue
+        reviewers.append(str(reviewer))
+        products.append(str(product))
+        scores.append(fraud_probability(p))
+    return (np.asarray(reviewers, dtype=object), np.asarray(products, dtype=object),
+            np.asarray(scores, dtype=np.float64))
+
+
+class ReviewGraph:
+    """Bipartite reviewer-product graph; reviewers are nodes [0, n_reviewers)."""
+
+    def __init__(self, reviewers, products, scores):
+        self.reviewer_ids, r = np.unique(reviewers, return_inverse=True)
+        self.product_ids, p = np.unique(products, return_inverse=True)
+        self.n_reviewers = len(self.reviewer_ids)
+        self.n_nodes = self.n_reviewers + len(self.product_ids)
+        self.n_reviews = len(scores)
+        p = p + self.n_reviewers
+
+        # Per-node review counts and mean fraud score
+        nodes_of_review = np.concatenate([r, p])
+        review_scores = np.concatenate([scores, scores])
+        self.reviews = np.bincount(nodes_of_review, minlength=self.n_nodes)
+        score_sum = np.bincount(nodes_of_review, weights=review_scores, minlength=self.n_nodes)
+        self.fraud_score = np.divide(score_sum, self.reviews, out=np.zeros(self.n_nodes),
+                                     where=self.reviews > 0)
+
+        # Collapse repeated reviewer-product pairs into weighted edges, then
+        # store both directions so every node's neighbours are one CSR row.
+        pair = r.astype(np.int64) * self.n_nodes + p
+        unique_pairs, weights = np.unique(pair, return_counts=True)
+        src = unique_pairs // self.n_nodes
+        dst = unique_pairs % self.n_nodes
+        rows = np.concatenate([src, dst])
+        cols = np.concatenate([dst, src])
+        w = np.concatenate([weights, weights])
+        order = np.lexsort((cols, rows))
+        self.indices = cols[order]
+        self.weights = w[order]
+        self.degree = np.bincount(rows, minlength=self.n_nodes)
+        self.indptr = np.zeros(self.n_nodes + 1, dtype=np.int64)
+        np.cumsum(self.degree, out=self.indptr[1:])
+        self.n_edges = len(unique_pairs)
+
+        # Fraud-neighbour statistics straight from the CSR arrays
+        is_fraud = self.fraud_score >= FRAUD_THRESHOLD
+        edge_rows = np.repeat(np.arange(self.n_nodes), self.degree)
+        self.fraud_neighbors = np.bincount(edge_rows, weights=is_fraud[self.indices],
+                                           minlength=self.n_nodes).astype(np.int64)
+        self.fraud_neighbor_ratio = np.divide(self.fraud_neighbors, self.degree,
+                                              out=np.zeros(self.n_nodes), where=self.degree > 0)
+
+    @classmethod
+    def from_predictions(cls, db, classification):
+        return cls(*load_edges(db, classification))
+
+    def node_id(self, i):
+        if i < self.n_reviewers:
+            return f'u:{self.reviewer_ids[i]}'
+        return f'p:{self.product_ids[i - self.n_reviewers]}'
+
+    def ranked_nodes(self, budget):
+        """Indices of the top `budget` nodes by fraud score, then degree."""
+        order = np.lexsort((-self.degree, -self.fraud_score))
+        return np.sort(order[:budget])
+
+    def induced_edges(self, keep):
+        """(src, dst, weight) of edges between `keep` nodes, each listed once reviewer -> product."""
+        mask = np.zeros(self.n_nodes, dtype=bool)
+        mask[keep] = True
+        edge_rows = np.repeat(np.arange(self.n_nodes), self.degree)
+        sel = mask[edge_rows] & mask[self.indices] & (edge_rows < self.n_reviewers)
+        return edge_rows[sel], self.indices[sel], self.weights[sel]
+
+    def subgraph(self, budget, positions=None):
+        """Induced subgraph on the top-ranked nodes, shaped for NetworkGraph.js.
+
+        `positions` ({node_id: (x, y)}, see graph_layout.py) adds x/y to the nodes.
+        """
+        keep = self.ranked_nodes(budget)
+        e_src, e_dst, e_w = self.induced_edges(keep)
+
+        nodes = []
+        for i in keep.tolist():
+            reviewer = i < self.n_reviewers
+            score = float(self.fraud_score[i])
+            nodes.append({
+                'id': self.node_id(i),
+                'label': str(self.reviewer_ids[i] if reviewer else self.product_ids[i - self.n_reviewers]),
+                'kind': 'reviewer' if reviewer else 'product',
+                'group': 'user' if reviewer else ('fraud' if score >= FRAUD_THRESHOLD else 'benign'),
+                'degree': int(self.degree[i]),
+                'reviews': int(self.reviews[i]),
+                'fraud_score': round(score, 4),
+                'confidence': round(score, 4),
+                'fraud_neighbors': int(self.fraud_neighbors[i]),
+                'fraud_neighbor_ratio': round(float(self.fraud_neighbor_ratio[i]), 4),
+            })
+            xy = positions.get(nodes[-1]['id']) if positions else None
+            if xy is not None:
+                nodes[-1]['x'] = round(float(xy[0]), 4)
+                nodes[-1]['y'] = round(float(xy[1]), 4)
+        edges = [{'source': self.node_id(s), 'target': self.node_id(d), 'weight': int(w),
+                  'relationship': 'reviewed'}
+                 for s, d, w in zip(e_src.tolist(), e_dst.tolist(), e_w.tolist())]
+        return nodes, edges
+
+    def summary(self):
+        return {
+            'reviews': int(self.n_reviews),
+            'reviewers': int(self.n_reviewers),
+            'products': int(self.n_nodes - self.n_reviewers),
+            'edges': int(self.n_edges),
+            'fraud_nodes': int((self.fraud_score >= FRAUD_THRESHOLD).sum()),
+            'max_degree': int(self.degree.max()) if self.n_nodes else 0,
+        }
@@ -0,0 +1,305 @@
+"""Incrementally maintained fraud statistics.
+
+Every saved classification run adds its counts to small pre-aggregated
+documents in `classification_rollups`, one per (scope, key, granularity,
+bucket):
+
+  scope        all | user | product (asin) | category
+  granularity  hour | day (UTC buckets)
+
+Each rollup holds total / fraud / legitimate counts, the confidence sum and
+a 10-bin confidence histogram. `/api/classifications/stats` answers
+dashboard queries over any time range by reading only these documents, and
+never touches the raw runs.
+
+If a rollup update fails after its run was saved, the run is flagged
+`rollup_dirty` and aegis_rollup_update_failures_total is incremented.
+A failed bulk write may have been partly applied, so the flagged runs
+cannot simply be re-added. `rebuild` recomputes everything and clears the
+flags.
+
+`rebuild` fills a scratch collection and renames it over
+`classification_rollups`, so `/api/classifications/stats` keeps reading the old totals
+until the new ones are complete. Runs saved while it works are added
+after the swap. A run whose own rollup update lands in the instant of the
+swap can be missed or counted twice, so rebuild while saves are quiet.
+
+Usage:
+  python rollups.py rebuild              # recompute all rollups from stored runs
+  python rollups.py rebuild --if-dirty   # only when some run is flagged rollup_dirty (for cron)
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+
+from indexes import INDEXES
+from metrics import registry as metrics_registry
+from predictions import FRAUD_LABELS, LEGITIMATE_LABELS, iter_run_predictions, ArchivedRunUnavailable
+
+SCOPES = ('all', 'user', 'product', 'category')
+GRANULARITIES = ('hour', 'day')
+HIST_BINS = 10
+COUNT_FIELDS = ('total', 'fraud', 'legitimate', 'confidence_sum', 'confidence_n', 'runs')
+REBUILD_COLLECTION = 'classification_rollups_rebuild'
+REBUILD_BATCH_RUNS = 200
+
+
+def bucket_start(ts, granularity):
+    if granularity == 'day':
+        return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+
+def rollup_id(scope, key, granularity, bucket):
+    return f'{scope}|{key}|{granularity}|{bucket:%Y%m%d%H}'
+
+
+def _new_counts():
+    return {'total': 0, 'fraud': 0, 'legitimate': 0, 'confidence_sum': 0.0,
+            'confidence_n': 0, 'hist': [0] * HIST_BINS}
+
+
+def aggregate(predictions, username):
+    """Fold one run's predictions into {(scope, key): counts} in a single pass."""
+    groups = defaultdict(_new_counts)
+    for p in predictions:
+        if not isinstance(p, dict):
+            continue
+        label = p.get('label')
+        keys = [('all', '*'), ('user', username)]
+        if p.get('asin'):
+            keys.append(('product', str(p['asin'])))
+        if p.get('category'):
+            keys.append(('category', str(p['category'])))
+
+        confidence = p.get('confidence')
+        try:
+            confidence = min(max(float(confidence), 0.0), 1.0)
+        except (TypeError, ValueError):
+            confidence = None
+
+        for key in keys:
+            c = groups[key]
+            c['total'] += 1
+            if label in FRAUD_LABELS:
+                c['fraud'] += 1
+            elif label in LEGITIMATE_LABELS:
+                c['legitimate'] += 1
+            if confidence is not None:
+                c['confidence_sum'] += confidence
+                c['confidence_n'] += 1
+                c['hist'][min(int(confidence * HIST_BINS), HIST_BINS - 1)] += 1
+    return groups
+
+
+def merge_rollups(runs, docs=None):
+    """{rollup _id: document} for several runs (dicts with username, predictions, created_at).
+
+    Runs that share a bucket are merged in memory, so each rollup document is
+    written once per batch however many runs touch it. Pass `docs` to add to
+    an earlier result.
+    """
+    docs = {} if docs is None else docs
+    for run in runs:
+        for (scope, key), c in aggregate(run['predictions'], run.get('username')).items():
+            for granularity in GRANULARITIES:
+                bucket = bucket_start(run['created_at'], granularity)
+                _id = rollup_id(scope, key, granularity, bucket)
+                doc = docs.get(_id)
+                if doc is None:
+                    doc = docs[_id] = dict({field: 0 for field in COUNT_FIELDS}, _id=_id, scope=scope,
+                                           key=key, granularity=granularity, bucket=bucket, hist={})
+                for field in COUNT_FIELDS[:-1]:
+                    doc[field] += c[field]
+                doc['runs'] += 1
+                for i, n in enumerate(c['hist']):
+                    if n:
+                        # The shape $inc on 'hist.<i>' stores: string keys, empty bins absent
+                        doc['hist'][str(i)] = doc['hist'].get(str(i), 0) + n
+    return docs
+
+
+def rollup_operations(docs):
+    ops = []
+    for _id, doc in docs.items():
+        inc = {field: doc[field] for field in COUNT_FIELDS}
+        for i, n in doc['hist'].items():
+            inc[f'hist.{i}'] = n
+        ops.append(UpdateOne(
+            {'_id': _id},
+            {'$inc': inc,
+             '$setOnInsert': {'scope': doc['scope'], 'key': doc['key'], 'granularity': doc['granularity'],
+                              'bucket': doc['bucket']}},
+            upsert=True,
+        ))
+    return ops
+
+
+def update_rollups(db, username, predictions, created_at):
+    """Add one run to the rollups; returns the number of rollup documents touched."""
+    return update_rollups_many(db, [{'username': username, 'predictions': predictions,
+                                     'created_at': created_at}])
+
+
+def update_rollups_many(db, runs):
+    """Add several runs (dicts with username, predictions, created_at) in one bulk write."""
+    return write_rollups(db.classification_rollups, merge_rollups(runs))
+
+
+def write_rollups(collection, docs):
+    ops = rollup_operations(docs)
+    if not ops:
+        return 0
+    result = collection.bulk_write(ops, ordered=False)
+    return result.upserted_count + result.modified_count
+
+
+async def update_rollups_async(db, username, predictions, created_at):
+    """update_rollups on an async (motor) database (asgi_app.py)."""
+    ops = rollup_operations(merge_rollups([{'username': username, 'predictions': predictions,
+                                            'created_at': created_at}]))
+    if not ops:
+        return 0
+    result = await db.classification_rollups.bulk_write(ops, ordered=False)
+    return result.upserted_count + result.modified_count
+
+
+def rollup_failed(db, classification_ids, error, source):
+    """Record a failed rollup update for runs that are already saved.
+
+    Counts it in metrics and flags the runs `rollup_dirty`, so
+    `rebuild --if-dirty` knows a rebuild is due.
+    """
+    metrics_registry.rollup_failures.inc((source,))
+    print(f"Rollup update failed for {len(classification_ids)} run(s): {str(error)}")
+    try:
+        db.classifications.update_many({'_id': {'$in': list(classification_ids)}},
+                                       {'$set': {'rollup_dirty': True}})
+    except Exception as e:
+        print(f"Could not flag runs rollup_dirty: {str(e)}")
+
+
+def _summarize(docs):
+    totals = _new_counts()
+    for d in docs:
+        for field in ('total', 'fraud', 'legitimate', 'confidence_sum', 'confidence_n'):
+            totals[field] += d.get(field, 0)
+        for i, n in (d.get('hist') or {}).items():
+            totals['hist'][int(i)] += n
+    return _finish(totals)
+
+
+def _finish(c):
+    n = c.pop('confidence_n', 0)
+    confidence_sum = c.pop('confidence_sum', 0.0)
+    c['avg_confidence'] = round(confidence_sum / n, 4) if n else None
+    c['fraud_rate'] = round(c['fraud'] / c['total'], 4) if c['total'] else None
+    return c
+
+
+def query_stats(db, scope='all', key=None, granularity='day', start=None, end=None, top=20):
+    """Stats for [start, end) from rollups only.
+
+    With a key (or scope=all) the result is a time series plus totals. For
+    product/category without a key it is the top `top` keys by fraud count.
+    """
+    if scope not in SCOPES:
+        raise ValueError(f'scope must be one of {", ".join(SCOPES)}')
+    if granularity not in GRANULARITIES:
+        raise ValueError(f'granularity must be one of {", ".join(GRANULARITIES)}')
+    end = end or datetime.utcnow()
+    start = start or end - timedelta(days=30)
+
+    query = {'scope': scope, 'granularity': granularity,
+             'bucket': {'$gte': bucket_start(start, granularity), '$lt': end}}
+    if scope == 'all':
+        query['key'] = '*'
+    elif key:
+        query['key'] = key
+
+    docs = list(db.classification_rollups.find(query, {'_id': 0}).sort('bucket', 1))
+    result = {'scope': scope, 'key': key, 'granularity': granularity,
+              'from': start, 'to': end, 'totals': _summarize(docs)}
+
+    if scope in ('product', 'category') and not key:
+        per_key = defaultdict(list)
+        for d in docs:
+            per_key[d['key']].append(d)
+        ranked = sorted(((k, _summarize(v)) for k, v in per_key.items()),
+                        key=lambda item: (item[1]['fraud'], item[1]['total']), reverse=True)
+        result['top'] = [dict(key=k, **v) for k, v in ranked[:top]]
+        return result
+
+    series = defaultdict(list)
+    for d in docs:
+        series[d['bucket']].append(d)
+    result['series'] = [dict(bucket=b, **_summarize(v)) for b, v in sorted(series.items())]
+    return result
+
+
+def _add_runs(db, collection, query):
+    """Add every matching run to `collection` in merged batches; returns the number of runs."""
+    runs, docs = 0, {}
+    for run in db.classifications.find(query, {'predictions': 1, 'username': 1, 'created_at': 1,
+                                               'storage': 1, 'archive': 1}):
+        if not run.get('created_at'):
+            continue
+        predictions = iter_run_predictions(db, run, ('label', 'confidence', 'asin', 'category'))
+        try:
+            # aggregate() reads the whole run before merging, so a failure adds nothing
+            merge_rollups([{'username': run.get('username', 'Anonymous'), 'predictions': predictions,
+                            'created_at': run['created_at']}], docs)
+        except ArchivedRunUnavailable as e:
+            print(f"Skipped: {str(e)}")
+            continue
+        runs += 1
+        if runs % REBUILD_BATCH_RUNS == 0:
+            write_rollups(collection, docs)
+            docs = {}
+    write_rollups(collection, docs)
+    return runs
+
+
+def rebuild(db):
+    """Recompute every rollup from stored runs (for existing data or repairs).
+
+    Reads keep using the old rollups until the rebuilt collection is renamed
+    over them. Runs still being saved (`status: 'saving'`) are left out.
+    """
+    started = datetime.utcnow()
+    scratch = db[REBUILD_COLLECTION]
+    scratch.drop()
+    scratch.create_indexes(INDEXES['classification_rollups'])
+    complete = {'status': {'$ne': 'saving'}}
+    runs = _add_runs(db, scratch, dict(complete, created_at={'$lt': started}))
+
+    swapped = datetime.utcnow()
+    scratch.rename('classification_rollups', dropTarget=True)
+    # Runs saved during the rebuild updated the collection that was just replaced
+    runs += _add_runs(db, db.classification_rollups, dict(complete, created_at={'$gte': started, '$lt': swapped}))
+    db.classifications.update_many({'rollup_dirty': True, 'created_at': {'$lt': swapped}},
+                                   {'$unset': {'rollup_dirty': ''}})
+    return runs
+
+
+def dirty_runs(db):
+    return db.classifications.count_documents({'rollup_dirty': True})
+
+
+if __name__ == '__main__':
+    import sys
+    from db import manager
+
+    if len(sys.argv) < 2 or sys.argv[1] != 'rebuild' or sys.argv[2:] not in ([], ['--if-dirty']):
+        print('Usage: python rollups.py rebuild [--if-dirty]')
+        sys.exit(1)
+    db = manager.get_db()
+    if db is None:
+        print('Could not connect to MongoDB. Check MONGO_URL or run test_mongo.py.')
+        sys.exit(1)
+    dirty = dirty_runs(db)
+    if '--if-dirty' in sys.argv and not dirty:
+        print('No runs are flagged rollup_dirty; nothing to do')
+        sys.exit(0)
+    print(f'Rebuilt rollups from {rebuild(db)} classification runs ({dirty} were flagged rollup_dirty)')
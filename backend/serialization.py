@@ -0,0 +1,77 @@
+"""One JSON encoder for BSON documents, plus NDJSON streaming responses.
+
+`MongoJSONProvider` is installed as the app's JSON provider, so `jsonify`
+handles ObjectId, datetime and other BSON values anywhere in a document in
+the same pass that writes the JSON. Routes no longer convert fields by hand.
+
+List endpoints can also stream newline-delimited JSON straight from the Mongo
+cursor (`?format=ndjson` or `Accept: application/x-ndjson`). The first rows
+go out as soon as the first batch arrives, and memory use stays flat however
+large the export is.
+"""
+import json
+import os
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+
+from bson import ObjectId, Decimal128
+from flask import Response, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def bson_default(value):
+    """`default=` hook for json.dumps; only called for non-native types."""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal128):
+        return float(value.to_decimal())
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, bytes):
+        return value.hex()
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def dumps(obj, **kwargs):
+    return json.dumps(obj, default=bson_default, ensure_ascii=False, separators=(',', ':'), **kwargs)
+
+
+class MongoJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that understands BSON types (ISO 8601 datetimes)."""
+
+    default = staticmethod(bson_default)
+
+
+def ndjson_batch_size():
+    try:
+        return max(1, int(os.environ.get('NDJSON_BATCH_SIZE', 500)))
+    except ValueError:
+        return 500
+
+
+def wants_ndjson(req):
+    if req.args.get('format') == 'ndjson':
+        return True
+    accept = req.accept_mimetypes
+    return accept[NDJSON_MIMETYPE] > accept['application/json']
+
+
+def ndjson_response(cursor):
+    """Stream a pymongo cursor as one JSON document per line."""
+    def generate():
+        try:
+            for doc in cursor:
+                yield dumps(doc) + '\n'
+        finally:
+            cursor.close()
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
@@ -1,30 +1,29 @@
-import os
-from dotenv import load_dotenv
 import pymongo
 
-# Load environment variables
-load_dotenv()
+from db import manager
 
 def test_mongo_connection():
     """Test MongoDB connection and print detailed error if it fails."""
     try:
-        # Get MongoDB connection string
-        mongo_url = os.environ.get('MONGO_URL')
-        db_name = os.environ.get('MONGO_DB_NAME', 'fraud_detection')
-        
-        if not mongo_url:
+        db_name = manager.db_name
+
+        if not manager.url:
             print("Error: MONGO_URL not found in environment variables")
             return False
 
         print("Attempting to connect to MongoDB...")
-        client = pymongo.MongoClient(mongo_url)
-        
+        # Same pooled client the API uses, so pool/timeout settings are exercised too
+        client = manager.get_client()
+
         # Test the connection
         client.server_info()
-        db = client[db_name]
-        
+        client[db_name].list_collection_names()
+
         print("✅ Successfully connected to MongoDB")
         print(f"✅ Database '{db_name}' is accessible")
+        stats = manager.stats()
+        print(f"   Pool: maxPoolSize={stats['max_pool_size']} minPoolSize={stats['min_pool_size']} "
+              f"open={stats['pool']['open_connections']}")
         return True
         
     except pymongo.errors.ConfigurationError as e:
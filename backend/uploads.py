@@ -0,0 +1,298 @@
+"""Resumable chunked uploads for large review CSVs.
+
+A multi-hundred-MB export does not fit comfortably in one multipart request,
+and a failed request has to start over. Instead the client:
+
+  POST   /api/uploads                        {"filename", "size", "sha256"?}  -> upload_id
+  PUT    /api/uploads/<id>/chunk?offset=N    raw bytes, X-Chunk-SHA256: <hex>
+  GET    /api/uploads/<id>                   acknowledged offset, to resume after a failure
+  POST   /api/uploads/<id>/finalize          classify the assembled file
+  DELETE /api/uploads/<id>                   abort
+
+Each chunk is received into a spooled temporary file (memory up to
+UPLOAD_SPOOL_BYTES, then disk) while its SHA-256 is computed. It is only
+appended when the digest matches X-Chunk-SHA256 and `offset` equals the
+acknowledged offset. Anything else is rejected with the current offset, so a
+client that lost a response simply continues from there. The append and the
+new offset are flushed to disk before the response is sent.
+
+State lives in UPLOAD_DIR (`<id>.json` plus `<id>.part`), not in the
+process, so chunks may land on any gunicorn worker; with several hosts the
+directory must be shared. Appends and finalize hold an flock on the part
+file. Uploads untouched for UPLOAD_TTL_HOURS are removed when a new one
+starts.
+
+Finalize checks the size (and the whole-file SHA-256 when one was given
+at initiate), then hands the file to classification as a stream. A
+successful classification deletes the upload. If the model fails, the
+upload is kept and finalize can be retried.
+
+Configuration (environment variables):
+  UPLOAD_DIR              where uploads are assembled (default backend/uploads)
+  UPLOAD_MAX_BYTES        largest file accepted (default 2147483648)
+  UPLOAD_CHUNK_MAX_BYTES  largest chunk accepted (default 16777216)
+  UPLOAD_SPOOL_BYTES      chunk bytes kept in memory before spooling to disk (default 1048576)
+  UPLOAD_TTL_HOURS        idle uploads are removed after this long (default 24)
+"""
+import hashlib
+import json
+import os
+import re
+import secrets
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process dev server only
+    fcntl = None
+
+CHECKSUM_HEADER = 'X-Chunk-SHA256'
+READ_SIZE = 1 << 16
+_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+_SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+class UploadError(Exception):
+    """An upload request that cannot be applied; carries the HTTP status and extra body fields."""
+
+    def __init__(self, message, status=400, **extra):
+        super().__init__(message)
+        self.status = status
+        self.extra = extra
+
+    def body(self):
+        return dict({'error': str(self)}, **self.extra)
+
+
+class UploadStore:
+    def __init__(self, root=None):
+        self.root = root or os.environ.get('UPLOAD_DIR') or os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), 'uploads')
+        self.max_bytes = _env_int('UPLOAD_MAX_BYTES', 2 << 30)
+        self.chunk_max_bytes = _env_int('UPLOAD_CHUNK_MAX_BYTES', 16 << 20)
+        self.spool_bytes = _env_int('UPLOAD_SPOOL_BYTES', 1 << 20)
+        self.ttl = _env_float('UPLOAD_TTL_HOURS', 24) * 3600
+
+    # -- files -------------------------------------------------------------
+
+    def _path(self, upload_id, suffix):
+        return os.path.join(self.root, upload_id + suffix)
+
+    def _read_meta(self, upload_id):
+        try:
+            with open(self._path(upload_id, '.json'), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_meta(self, meta):
+        meta['updated_at'] = time.time()
+        path = self._path(meta['upload_id'], '.json')
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _remove(self, upload_id):
+        for suffix in ('.part', '.json', '.json.tmp'):
+            try:
+                os.remove(self._path(upload_id, suffix))
+            except FileNotFoundError:
+                pass
+
+    @contextmanager
+    def _locked(self, upload_id, wait=True):
+        """The part file opened r+b under an exclusive flock."""
+        try:
+            f = open(self._path(upload_id, '.part'), 'r+b')
+        except FileNotFoundError:
+            raise UploadError('Upload not found', 404)
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    raise UploadError('Upload is being finalized', 409)
+            yield f
+        finally:
+            f.close()  # releases the lock
+
+    def _load(self, upload_id, principal):
+        """Metadata of an upload the principal may use; other users' uploads look missing."""
+        meta = self._read_meta(upload_id) if _ID_RE.match(upload_id or '') else None
+        if meta is None:
+            raise UploadError('Upload not found', 404)
+        owner = meta.get('owner')
+        if owner and (principal is None or (principal['username'] != owner and principal['role'] != 'admin')):
+            raise UploadError('Upload not found', 404)
+        return meta
+
+    # -- protocol ----------------------------------------------------------
+
+    def create(self, principal, filename, size, sha256=None):
+        if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+            raise UploadError('size must be a positive integer')
+        if size > self.max_bytes:
+            raise UploadError(f'File too large (max {self.max_bytes} bytes)', 413)
+        if sha256 is not None and not _SHA256_RE.match(str(sha256).lower()):
+            raise UploadError('sha256 must be a hex SHA-256 digest')
+
+        os.makedirs(self.root, exist_ok=True)
+        self.purge_expired()
+        upload_id = secrets.token_hex(16)
+        open(self._path(upload_id, '.part'), 'xb').close()
+        meta = {
+            'upload_id': upload_id,
+            'owner': principal['username'] if principal else None,
+            'filename': os.path.basename(str(filename or 'upload.csv'))[:255],
+            'size': size,
+            'sha256': sha256.lower() if sha256 else None,
+            'offset': 0,
+            'chunks': 0,
+            'created_at': time.time(),
+        }
+        self._write_meta(meta)
+        print(f"Upload {upload_id} started: {meta['filename']} ({size} bytes) by {meta['owner'] or 'anonymous'}")
+        return self.describe(meta)
+
+    def status(self, upload_id, principal):
+        return self.describe(self._load(upload_id, principal))
+
+    def _receive(self, stream):
+        """Copy one chunk body into a spooled temp file; returns (file, length, sha256 hex)."""
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+        digest = hashlib.sha256()
+        length = 0
+        while True:
+            data = stream.read(READ_SIZE)
+            if not data:
+                break
+            length += len(data)
+            if length > self.chunk_max_bytes:
+                spool.close()
+                raise UploadError(f'Chunk too large (max {self.chunk_max_bytes} bytes)', 413)
+            digest.update(data)
+            spool.write(data)
+        spool.seek(0)
+        return spool, length, digest.hexdigest()
+
+    def append(self, upload_id, principal, offset, stream, checksum):
+        """Append one verified chunk at `offset`; returns the new status."""
+        meta = self._load(upload_id, principal)
+        if not checksum:
+            raise UploadError(f'{CHECKSUM_HEADER} header required')
+        spool, length, digest = self._receive(stream)
+        with spool:
+            if digest != checksum.strip().lower():
+                raise UploadError('Chunk checksum mismatch', 422, offset=meta['offset'])
+            if length == 0:
+                raise UploadError('Empty chunk', offset=meta['offset'])
+
+            with self._locked(upload_id) as part:
+                meta = self._read_meta(upload_id)
+                if meta is None:
+                    raise UploadError('Upload not found', 404)
+                if offset != meta['offset']:
+                    raise UploadError('Offset does not match the acknowledged offset', 409,
+                                      offset=meta['offset'])
+                if offset + length > meta['size']:
+                    raise UploadError('Chunk runs past the declared size', 400, offset=meta['offset'])
+                # Drop anything a crashed append left past the acknowledged offset
+                part.truncate(offset)
+                part.seek(offset)
+                shutil.copyfileobj(spool, part, READ_SIZE)
+                part.flush()
+                os.fsync(part.fileno())
+                meta['offset'] = offset + length
+                meta['chunks'] += 1
+                self._write_meta(meta)
+        return self.describe(meta)
+
+    @contextmanager
+    def assembled(self, upload_id, principal):
+        """The complete file, opened for reading, for the duration of finalize.
+
+        The upload is deleted when the block exits normally and kept, so
+        finalize can be retried, when it raises.
+        """
+        meta = self._load(upload_id, principal)
+        if meta['offset'] != meta['size']:
+            raise UploadError('Upload is incomplete', 409, offset=meta['offset'], size=meta['size'])
+        with self._locked(upload_id, wait=False) as part:
+            if meta['sha256']:
+                digest = hashlib.sha256()
+                for data in iter(lambda: part.read(READ_SIZE), b''):
+                    digest.update(data)
+                if digest.hexdigest() != meta['sha256']:
+                    self._remove(upload_id)
+                    raise UploadError('File checksum mismatch; upload discarded', 422)
+            part.seek(0)
+            yield part
+            self._remove(upload_id)
+        print(f"Upload {upload_id} finalized ({meta['size']} bytes in {meta['chunks']} chunks)")
+
+    def delete(self, upload_id, principal):
+        self._load(upload_id, principal)
+        with self._locked(upload_id, wait=False):
+            self._remove(upload_id)
+
+    def purge_expired(self):
+        """Remove uploads idle for longer than UPLOAD_TTL_HOURS; returns how many."""
+        cutoff = time.time() - self.ttl
+        removed = 0
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return 0
+        for name in names:
+            upload_id, ext = os.path.splitext(name)
+            if ext != '.json' or not _ID_RE.match(upload_id):
+                continue
+            meta = self._read_meta(upload_id)
+            if meta is None or meta.get('updated_at', 0) >= cutoff:
+                continue
+            try:
+                with self._locked(upload_id, wait=False):
+                    self._remove(upload_id)
+                removed += 1
+            except UploadError:
+                continue
+        if removed:
+            print(f"Removed {removed} expired upload(s) from {self.root}")
+        return removed
+
+    def describe(self, meta):
+        return {
+            'upload_id': meta['upload_id'],
+            'filename': meta['filename'],
+            'size': meta['size'],
+            'offset': meta['offset'],
+            'chunks': meta['chunks'],
+            'complete': meta['offset'] == meta['size'],
+            'chunk_max_bytes': self.chunk_max_bytes,
+            'created_at': datetime.utcfromtimestamp(meta['created_at']).isoformat() + 'Z',
+            'expires_at': datetime.utcfromtimestamp(meta['updated_at'] + self.ttl).isoformat() + 'Z',
+        }
+
+
+upload_store = UploadStore()
@@ -4,6 +4,9 @@ import { Card, CardContent, CardDescription, CardHeader, CardTitle } from './ui/
 import { Upload, FileText, X, CheckCircle } from 'lucide-react';
 import { toast } from '../hooks/use-toast';
 
+// Only this much of a large file is read in the browser, for the preview
+const PREVIEW_BYTES = 1024 * 1024;
+
 const CSVUpload = ({ onUploadComplete }) => {
   const [file, setFile] = useState(null);
   const [uploading, setUploading] = useState(false);
@@ -91,6 +94,9 @@ const CSVUpload = ({ onUploadComplete }) => {
       reader.onload = (e) => {
         const csvText = e.target.result;
         const lines = csvText.split('\n');
+        if (file.size > PREVIEW_BYTES) {
+          lines.pop(); // the slice usually ends mid-line
+        }
         
         const reviews = [];
         for (let i = 1; i < lines.length; i++) {
@@ -115,14 +121,17 @@ const CSVUpload = ({ onUploadComplete }) => {
           setUploadProgress(0);
           toast({
             title: 'Upload successful',
-            description: `Successfully parsed ${reviews.length} reviews from CSV`,
+            description: file.size > PREVIEW_BYTES
+              ? `Previewed ${reviews.length} reviews; the full file is uploaded when you classify`
+              : `Successfully parsed ${reviews.length} reviews from CSV`,
             variant: 'success'
           });
           onUploadComplete(reviews, file);
         }, 500);
       };
 
-      reader.readAsText(file);
+      // Large exports are only previewed here; the full file is uploaded in chunks on classify
+      reader.readAsText(file.size > PREVIEW_BYTES ? file.slice(0, PREVIEW_BYTES) : file);
     } catch (error) {
       setUploading(false);
       setUploadProgress(0);
@@ -162,7 +171,7 @@ const CSVUpload = ({ onUploadComplete }) => {
               </div>
               <div>
                 <p className="text-slate-300 mb-2">Drop your CSV file here, or click to browse</p>
-                <p className="text-xs text-slate-500">Supported format: .csv (max 10MB)</p>
+                <p className="text-xs text-slate-500">Supported format: .csv (large files upload in resumable chunks)</p>
               </div>
               <input
                 ref={fileInputRef}
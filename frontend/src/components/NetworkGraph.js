@@ -25,8 +25,23 @@ const NetworkGraph = ({ graphData }) => {
     const width = canvas.width;
     const height = canvas.height;
 
+    // Use the backend's precomputed layout (unit-square x/y) when it sent one
+    const margin = 40;
+    const hasLayout = graphData.nodes.length > 0 && graphData.nodes.every(node => node.x != null && node.y != null);
+
     // Initialize node positions with better layout
     const initialNodes = graphData.nodes.map((node, i) => {
+      if (hasLayout) {
+        return {
+          ...node,
+          x: margin + node.x * (width - 2 * margin),
+          y: margin + node.y * (height - 2 * margin),
+          vx: 0,
+          vy: 0,
+          fx: null,
+          fy: null
+        };
+      }
       const angle = (i / graphData.nodes.length) * 2 * Math.PI;
       const radius = node.group === 'user' ? 150 : 250;
       return {
@@ -42,6 +57,7 @@ const NetworkGraph = ({ graphData }) => {
 
     console.log('Initializing nodes:', initialNodes.length);
     setNodes(initialNodes);
+    setIsSimulating(!hasLayout);
   }, [graphData]);
 
   useEffect(() => {
@@ -47,7 +47,9 @@ export const AuthProvider = ({ children }) => {
         throw new Error(data.error || 'Login failed');
       }
 
-      // Store user data only - no token needed
+      // Signed session token; sent as `Authorization: Bearer <token>` on API calls
+      localStorage.setItem('token', data.token);
+
       const userData = {
         username: data.user.username,
         email: data.user.email,
@@ -66,6 +68,7 @@ export const AuthProvider = ({ children }) => {
   const logout = () => {
     setUser(null);
     localStorage.removeItem('user');
+    localStorage.removeItem('token');
   };
 
   const value = {
@@ -6,6 +6,7 @@ import FraudChart from '../components/FraudChart';
 import { Button } from '../components/ui/button';
 import { mockReviews, mockClassifyReviews } from '../mock/mockData';
 import { toast } from '../hooks/use-toast';
+import { uploadAndClassify, CHUNKED_UPLOAD_THRESHOLD } from '../utils/chunkedUpload';
 import { TrendingUp, AlertCircle } from 'lucide-react';
 
 const Dashboard = () => {
@@ -37,7 +38,7 @@ const Dashboard = () => {
     });
 
     try {
-      const BACKEND_URL = 'https://ivylike-jestine-roentgenopaque.ngrok-free.dev';
+      const BACKEND_URL = process.env.REACT_APP_BACKEND_URL || 'http://localhost:5000';
       
       // Use the ORIGINAL uploaded file directly - don't regenerate CSV
       if (!uploadedFile) {
@@ -49,20 +50,32 @@ const Dashboard = () => {
       console.log('File size:', uploadedFile.size);
       console.log('============================================');
       
-      const formData = new FormData();
-      formData.append('file', uploadedFile); // Upload original file
+      let responseText;
+      if (uploadedFile.size > CHUNKED_UPLOAD_THRESHOLD) {
+        // Large exports go up in resumable, checksummed chunks
+        const body = await uploadAndClassify(uploadedFile, (fraction) => {
+          console.log(`Uploaded ${(fraction * 100).toFixed(1)}%`);
+        });
+        responseText = JSON.stringify(body);
+      } else {
+        const formData = new FormData();
+        formData.append('file', uploadedFile); // Upload original file
 
-      // Send to Flask backend for classification
-      const response = await fetch(`${BACKEND_URL}/api/classify`, {
-        method: 'POST',
-        body: formData
-      });
+        // Send to Flask backend for classification
+        const response = await fetch(`${BACKEND_URL}/api/classify`, {
+          method: 'POST',
+          headers: {
+            'Authorization': `Bearer ${localStorage.getItem('token') || ''}`
+          },
+          body: formData
+        });
 
-      if (!response.ok) {
-        throw new Error('Failed to classify reviews');
-      }
+        if (!response.ok) {
+          throw new Error('Failed to classify reviews');
+        }
 
-      const responseText = await response.text();
+        responseText = await response.text();
+      }
       console.log('========== RAW RESPONSE ==========');
       console.log(responseText);
       console.log('==================================');
@@ -111,6 +124,7 @@ const Dashboard = () => {
           method: 'POST',
           headers: {
             'Content-Type': 'application/json',
+            'Authorization': `Bearer ${localStorage.getItem('token') || ''}`
           },
           body: JSON.stringify({
             predictions: predictions,
@@ -172,9 +186,12 @@ R003,U003,P002,User3,"[0,0]","Not satisfied with the quality","Not good",1640995
     formData.append('file', file);
 
     try {
-      const BACKEND_URL = 'https://ivylike-jestine-roentgenopaque.ngrok-free.dev';
+      const BACKEND_URL = process.env.REACT_APP_BACKEND_URL || 'http://localhost:5000';
       const response = await fetch(`${BACKEND_URL}/api/classify`, {
         method: 'POST',
+        headers: {
+          'Authorization': `Bearer ${localStorage.getItem('token') || ''}`
+        },
         body: formData
       });
 
@@ -0,0 +1,116 @@
+// Resumable chunked upload + classify (backend/uploads.py).
+//
+// The file is sent in CHUNK_SIZE slices, each with its SHA-256, so only one
+// slice is ever held in memory. The upload id is remembered in localStorage
+// per file, so a retry after a network failure or a page reload resumes from
+// the offset the server acknowledged instead of starting over. A new upload
+// first hashes the whole file (slice by slice) and sends that SHA-256 too, so
+// finalize can check the assembled file.
+
+import { createSha256 } from './sha256';
+
+const BACKEND_URL = process.env.REACT_APP_BACKEND_URL || 'http://localhost:5000';
+const CHUNK_SIZE = 8 * 1024 * 1024;
+const CHUNK_RETRIES = 3;
+
+// Files above this go through the chunked protocol instead of one multipart POST
+export const CHUNKED_UPLOAD_THRESHOLD = 8 * 1024 * 1024;
+
+const authHeaders = () => ({
+  Authorization: `Bearer ${localStorage.getItem('token') || ''}`
+});
+
+const storageKey = (file) => `upload:${file.name}:${file.size}:${file.lastModified}`;
+
+const toHex = (buffer) =>
+  Array.from(new Uint8Array(buffer))
+    .map((b) => b.toString(16).padStart(2, '0'))
+    .join('');
+
+const sha256 = async (blob) => toHex(await crypto.subtle.digest('SHA-256', await blob.arrayBuffer()));
+
+const fileSha256 = async (file) => {
+  const hash = createSha256();
+  for (let offset = 0; offset < file.size; offset += CHUNK_SIZE) {
+    hash.update(new Uint8Array(await file.slice(offset, offset + CHUNK_SIZE).arrayBuffer()));
+  }
+  return hash.hex();
+};
+
+const request = async (path, options = {}) => {
+  const response = await fetch(`${BACKEND_URL}/api/uploads${path}`, {
+    ...options,
+    headers: { ...authHeaders(), ...(options.headers || {}) }
+  });
+  const body = await response.json().catch(() => ({}));
+  return { status: response.status, ok: response.ok, body };
+};
+
+const startOrResume = async (file) => {
+  const saved = localStorage.getItem(storageKey(file));
+  if (saved) {
+    const { ok, body } = await request(`/${saved}`);
+    if (ok) return body;
+    localStorage.removeItem(storageKey(file));
+  }
+  const { ok, body } = await request('', {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ filename: file.name, size: file.size, sha256: await fileSha256(file) })
+  });
+  if (!ok) throw new Error(body.error || 'Could not start upload');
+  localStorage.setItem(storageKey(file), body.upload_id);
+  return body;
+};
+
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+const sendChunk = async (uploadId, file, offset, chunkSize) => {
+  const chunk = file.slice(offset, offset + chunkSize);
+  const checksum = await sha256(chunk);
+  for (let attempt = 1; ; attempt++) {
+    let response;
+    try {
+      response = await request(`/${uploadId}/chunk?offset=${offset}`, {
+        method: 'PUT',
+        headers: { 'Content-Type': 'application/octet-stream', 'X-Chunk-SHA256': checksum },
+        body: chunk
+      });
+    } catch (error) {
+      // Network failure: retry
+      if (attempt >= CHUNK_RETRIES) throw error;
+      await sleep(500 * attempt);
+      continue;
+    }
+    const { ok, status, body } = response;
+    if (ok) return body.offset;
+    // 409: the server already has more (or less) than we thought; continue from its offset
+    if (status === 409 && body.offset !== undefined) return body.offset;
+    if (status === 429) {
+      // Rate limited: wait as told, without using up an attempt
+      await sleep(1000 * (body.retry_after || 1));
+      attempt--;
+      continue;
+    }
+    // Only a corrupted chunk (422) is worth sending again; other errors are permanent
+    if (status !== 422 || attempt >= CHUNK_RETRIES) throw new Error(body.error || 'Chunk upload failed');
+    await sleep(500 * attempt);
+  }
+};
+
+// Upload `file` in chunks, then classify it; resolves to the /api/classify response body
+export const uploadAndClassify = async (file, onProgress = () => {}) => {
+  const upload = await startOrResume(file);
+  const chunkSize = Math.min(CHUNK_SIZE, upload.chunk_max_bytes || CHUNK_SIZE);
+  let offset = upload.offset;
+  onProgress(offset / file.size);
+  while (offset < file.size) {
+    offset = await sendChunk(upload.upload_id, file, offset, chunkSize);
+    onProgress(offset / file.size);
+  }
+
+  const { ok, body } = await request(`/${upload.upload_id}/finalize`, { method: 'POST' });
+  if (!ok) throw new Error(body.error || 'Failed to classify reviews');
+  localStorage.removeItem(storageKey(file));
+  return body;
+};